@@ -0,0 +1,334 @@
+import logging
+from typing import NamedTuple, Optional
+
+from formatacao import dividir_mensagem
+from registro_logs import por_mensagem
+from refinamento import iniciar_conversa, registrar_turno
+
+logger = logging.getLogger(__name__)
+
+
+# Ações que o fluxo de atendimento pede ao executor. O mesmo fluxo roda no
+# modo síncrono (TeleBot) e no assíncrono (AsyncTeleBot): cada executor
+# realiza a ação e devolve o resultado ao gerador com send().
+class Responder(NamedTuple):
+    texto: str
+
+
+class Enviar(NamedTuple):
+    texto: str
+
+
+class Diagnosticar(NamedTuple):
+    equipamento: str
+    problema: str
+
+
+class Salvar(NamedTuple):
+    equipamento: str
+    problema: str
+    solucao: str
+
+
+# A IA recusou o atendimento (cota esgotada, descrição longa demais): a
+# mensagem vai ao técnico, mas não é diagnóstico, não é salva e não muda
+# a etapa. entregue indica que o executor já a exibiu (ex.: transmissão)
+class AtendimentoRecusado(Exception):
+    def __init__(self, mensagem: str, entregue: bool = False):
+        super().__init__(mensagem)
+        self.mensagem = mensagem
+        self.entregue = entregue
+
+
+# Gera e entrega o diagnóstico aos poucos, editando as mensagens conforme
+# o texto chega; devolve a solução final já formatada
+class TransmitirDiagnostico(NamedTuple):
+    equipamento: str
+    problema: str
+    cabecalho: Optional[str]
+    responder: bool
+
+
+# Nova rodada da conversa de refinamento: só a informação nova vai junto do
+# histórico compacto; transmitir indica o envio com edições (streaming)
+class Refinar(NamedTuple):
+    equipamento: str
+    problema: str
+    conversa: dict
+    informacao: str
+    transmitir: bool
+
+
+# Modo anterior ao refinamento em conversa: o pedido inteiro vira o
+# "problema" de um diagnóstico novo
+def prompt_refinamento(equipamento, problema_original, informacao_adicional):
+    return f"""
+CONTEXTO ANTERIOR:
+Equipamento: {equipamento}
+Problema Original: {problema_original}
+
+NOVA INFORMAÇÃO DO TÉCNICO:
+{informacao_adicional}
+
+Por favor, gere uma solução técnica ATUALIZADA e MAIS ESPECÍFICA considerando 
+as novas informações fornecidas.
+"""
+
+
+def iniciar_atendimento(user_state, user_id, username):
+    logger.info("Comando /start recebido de %s", username, extra=por_mensagem(user_id))
+    
+    # Resetar o estado do usuário
+    user_state[user_id] = {'stage': 'intro'}
+    
+    yield Responder(
+        "🚧 Assistente Técnico de Manutenção 🚧\n\n"
+        "Vamos começar: Por favor, informe detalhes do equipamento:\n"
+        "• Marca\n"
+        "• Modelo\n"
+        "• Versão/Ano\n\n"
+        "Exemplo: Transpaleteira elétrica Linde T20 SP - 2022"
+    )
+
+
+def conduzir_atendimento(user_state, user_id, texto, streaming=False, refinamento_chat=False):
+    # Se o usuário não tiver estado definido, inicializar
+    if user_id not in user_state:
+        user_state[user_id] = {'stage': 'intro'}
+    
+    # Adicionar log para debug
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(
+            "Mensagem recebida. User ID: %s, Stage: %s", user_id, user_state[user_id].get('stage'),
+            extra=por_mensagem(user_id)
+        )
+    
+    try:
+        current_stage = user_state[user_id].get('stage', 'intro')
+        
+        if current_stage == 'intro':
+            # Capturar informações do equipamento
+            equipamento = texto.strip()
+            
+            # Validar se a mensagem não está vazia
+            if not equipamento:
+                yield Responder("❌ Por favor, informe os detalhes do equipamento.")
+                return
+            
+            # Log de debug
+            logger.info("Equipamento capturado: %.80s", equipamento, extra=por_mensagem(user_id))
+            
+            # Salvar informações do equipamento e mudar para próximo estágio
+            user_state[user_id] = {
+                'stage': 'problem_description',
+                'equipamento': equipamento
+            }
+            
+            # Solicitar descrição do problema
+            yield Responder(
+                f"✅ Equipamento registrado: <b>{equipamento}</b>\n\n"
+                "Agora, descreva detalhadamente o problema que você está enfrentando. "
+                "Seja o mais específico possível sobre os sintomas, comportamentos incomuns, "
+                "sons, ou qualquer outra observação relevante."
+            )
+        
+        elif current_stage == 'problem_description':
+            # Capturar descrição do problema
+            problema = texto.strip()
+            
+            # Validar se a descrição não está vazia
+            if not problema:
+                yield Responder("❌ Por favor, descreva o problema em detalhes.")
+                return
+            
+            # Log de debug
+            logger.info(
+                "Problema capturado (%d caracteres): %.80s", len(problema), problema,
+                extra=por_mensagem(user_id)
+            )
+            
+            # Buscar solução via IA
+            equipamento = user_state[user_id]['equipamento']
+            
+            # Criar primeira mensagem com cabeçalho
+            primeira_mensagem = f"🔧 Diagnóstico para {equipamento}"
+            
+            if streaming:
+                solucao = yield TransmitirDiagnostico(
+                    equipamento, problema, primeira_mensagem, responder=True
+                )
+            else:
+                solucao = yield Diagnosticar(equipamento, problema)
+                
+                # Dividir mensagem
+                mensagens = dividir_mensagem(solucao)
+                
+                # Enviar primeira mensagem (cabeçalho + primeiro conteúdo)
+                if mensagens:
+                    yield Responder(f"{primeira_mensagem}\n\n{mensagens[0]}")
+                
+                # Enviar mensagens subsequentes
+                for msg_adicional in mensagens[1:]:
+                    yield Enviar(msg_adicional)
+            
+            # Solicitar feedback
+            user_state[user_id] = {
+                'stage': 'feedback',
+                'equipamento': equipamento,
+                'problema': problema,
+                'solucao': solucao  # Manter solução atual
+            }
+            
+            yield Enviar(
+                "A solução foi útil?\n"
+                "Responda:\n"
+                "✅ SIM - se a solução resolveu o problema\n"
+                "❌ NÃO - se precisou de outras ações"
+            )
+        
+        elif current_stage == 'feedback':
+            feedback = texto.strip().lower()
+            
+            if feedback in ['✅', 'sim']:
+                # Aqui salva no Firestore somente com feedback positivo
+                solucao = user_state[user_id]['solucao']
+                equipamento = user_state[user_id]['equipamento']
+                problema = user_state[user_id]['problema']
+                
+                yield Salvar(equipamento, problema, solucao)
+                
+                yield Responder(
+                    "Ótimo! Fico feliz em ter ajudado. 👍\n"
+                    "Solução salva para futuras consultas.\n"
+                    "Se precisar de mais alguma coisa, use /start."
+                )
+                # Resetar estado
+                user_state[user_id] = {'stage': 'intro'}
+            
+            elif feedback in ['❌', 'não']:
+                yield Responder(
+                    "Peço desculpas que a solução não foi completamente efetiva. 🤔\n"
+                    "Por favor, descreva:\n"
+                    "1. Qual era o DEFEITO ESPECÍFICO?\n"
+                    "2. Qual SOLUÇÃO VOCÊ ENCONTROU?"
+                )
+                # Preparar para registrar informação adicional
+                user_state.atualizar(user_id, stage='solution_refinement')
+            
+            else:
+                yield Responder(
+                    "Desculpe, não entendi sua resposta. 🤨\n"
+                    "Por favor, responda com ✅ SIM ou ❌ NÃO"
+                )
+        
+        elif current_stage == 'solution_refinement':
+            # Processar texto com detalhes da solução refinada
+            informacao_adicional = texto.strip()
+            
+            # Tentar gerar nova solução com informações adicionais
+            try:
+                estado = user_state[user_id]
+                equipamento = estado['equipamento']
+                problema_original = estado['problema']
+                conversa = None
+                
+                if refinamento_chat:
+                    conversa = estado.get('conversa') or iniciar_conversa(
+                        equipamento, problema_original, estado.get('solucao', '')
+                    )
+                
+                if streaming:
+                    yield Responder("🔍 Solução Refinada:")
+                    if conversa is not None:
+                        solucao_refinada = yield Refinar(
+                            equipamento, problema_original, conversa, informacao_adicional, transmitir=True
+                        )
+                    else:
+                        solucao_refinada = yield TransmitirDiagnostico(
+                            equipamento, prompt_refinamento(equipamento, problema_original, informacao_adicional),
+                            None, responder=False
+                        )
+                    yield Salvar(equipamento, problema_original, solucao_refinada)
+                else:
+                    # Gerar solução refinada
+                    if conversa is not None:
+                        solucao_refinada = yield Refinar(
+                            equipamento, problema_original, conversa, informacao_adicional, transmitir=False
+                        )
+                    else:
+                        solucao_refinada = yield Diagnosticar(
+                            equipamento, prompt_refinamento(equipamento, problema_original, informacao_adicional)
+                        )
+                    
+                    # Salvar solução refinada no Firestore
+                    yield Salvar(equipamento, problema_original, solucao_refinada)
+                    
+                    # Dividir mensagem refinada
+                    mensagens_refinadas = dividir_mensagem(solucao_refinada)
+                    
+                    # Enviar mensagens
+                    yield Responder("🔍 Solução Refinada:")
+                    for msg in mensagens_refinadas:
+                        yield Enviar(msg)
+                
+                yield Enviar(
+                    "Esta solução atende suas necessidades?\n"
+                    "✅ SIM - solução satisfatória\n"
+                    "❌ NÃO - precisamos revisar novamente"
+                )
+                
+                # Atualizar estado
+                novo_estado = {
+                    'stage': 'feedback_refinado',
+                    'equipamento': equipamento,
+                    'problema': problema_original,
+                    'solucao': solucao_refinada
+                }
+                if conversa is not None:
+                    novo_estado['conversa'] = registrar_turno(conversa, informacao_adicional, solucao_refinada)
+                user_state[user_id] = novo_estado
+            
+            except AtendimentoRecusado:
+                raise
+            
+            except Exception as e:
+                logger.error(f"Erro no refinamento da solução: {e}")
+                yield Responder("Desculpe, não foi possível refinar a solução no momento.")
+                user_state[user_id] = {'stage': 'intro'}
+        
+        elif current_stage == 'feedback_refinado':
+            feedback = texto.strip().lower()
+            
+            if feedback in ['✅', 'sim']:
+                yield Responder(
+                    "Ótimo! Solução refinada salva. 👍\n"
+                    "Se precisar de mais alguma coisa, use /start."
+                )
+                # Resetar estado
+                user_state[user_id] = {'stage': 'intro'}
+            
+            elif feedback in ['❌', 'não']:
+                yield Responder(
+                    "Entendi que a solução ainda não atende completamente. 🤔\n"
+                    "Por favor, descreva novamente o problema específico."
+                )
+                # Voltar para refinamento
+                user_state.atualizar(user_id, stage='solution_refinement')
+            
+            else:
+                yield Responder(
+                    "Desculpe, não entendi sua resposta. 🤨\n"
+                    "Por favor, responda com ✅ SIM ou ❌ NÃO"
+                )
+    
+    except AtendimentoRecusado as recusa:
+        # Estado intacto: o técnico pode resumir a descrição ou tentar mais tarde
+        logger.info("Atendimento recusado pela IA", extra=por_mensagem(user_id))
+        if not recusa.entregue:
+            yield Responder(recusa.mensagem)
+    
+    except Exception as e:
+        logger.error(f"Erro detalhado ao processar: {e}", exc_info=True)
+        yield Responder(f"Desculpe, ocorreu um erro: {str(e)}")
+        # Resetar estado em caso de erro
+        user_state[user_id] = {'stage': 'intro'}
@@ -0,0 +1,85 @@
+import sys
+import logging
+import argparse
+
+from conexao_firestore import TAMANHO_PAGINA, configurar_firestore, ler_paginas
+from registro_logs import configurar_logging
+from equipamentos import RegistroEquipamentos
+
+logger = logging.getLogger(__name__)
+
+LIMITE_LOTE_FIRESTORE = 500
+
+
+# Preenche 'equipamento_id' nos documentos de 'manutencoes' gravados antes
+# do registro de equipamentos canônicos
+def executar_backfill(db, tamanho_lote=LIMITE_LOTE_FIRESTORE, simular=False, tamanho_pagina=TAMANHO_PAGINA):
+    registro = RegistroEquipamentos(db)
+    registro.carregar()
+    if simular:
+        # Resolve normalmente, mas sem gravar novos equipamentos
+        registro.db = None
+
+    batch = db.batch()
+    pendentes = 0
+    atualizados = 0
+    ignorados = 0
+
+    for doc in ler_paginas(db, 'manutencoes', tamanho_pagina):
+        dados = doc.to_dict()
+        if dados.get('equipamento_id'):
+            ignorados += 1
+            continue
+
+        equipamento_id = registro.resolver(dados.get('equipamento', ''))
+        if not equipamento_id:
+            logger.warning(f"Documento {doc.id} sem equipamento reconhecível")
+            ignorados += 1
+            continue
+
+        atualizados += 1
+        if simular:
+            logger.info(f"{doc.id}: '{dados.get('equipamento')}' -> {equipamento_id}")
+            continue
+
+        batch.update(doc.reference, {'equipamento_id': equipamento_id})
+        pendentes += 1
+        if pendentes >= tamanho_lote:
+            batch.commit()
+            logger.info(f"Lote de {pendentes} documentos gravado ({atualizados} até agora)")
+            batch = db.batch()
+            pendentes = 0
+
+    if pendentes:
+        batch.commit()
+    # Grava os modelos e variantes novos que ainda estão na fila do registro
+    registro.encerrar()
+
+    logger.info(
+        f"Backfill concluído: {atualizados} atualizados, {ignorados} ignorados, "
+        f"{len(registro)} equipamentos canônicos"
+    )
+    return atualizados
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill de equipamento_id na coleção manutencoes")
+    parser.add_argument('--lote', type=int, default=LIMITE_LOTE_FIRESTORE,
+                        help="Documentos por batch de escrita (máx. 500)")
+    parser.add_argument('--pagina', type=int, default=TAMANHO_PAGINA, help="Documentos lidos por página")
+    parser.add_argument('--simular', action='store_true',
+                        help="Apenas mostra a resolução, sem gravar")
+    args = parser.parse_args()
+
+    # Sem o bot.py ninguém configura o logging: progresso e resumo saem no stdout
+    configurar_logging('sincrono', arquivo=None)
+
+    db = configurar_firestore()
+    if db is None:
+        sys.exit(1)
+
+    executar_backfill(db, min(args.lote, LIMITE_LOTE_FIRESTORE), args.simular, args.pagina)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,302 @@
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+from harness_webhook import GeradorUpdates, percentil
+from simuladores import TelegramFalso, GeminiFalso, FirestoreMemoria
+
+DIRETORIO_REPOSITORIO = os.path.dirname(os.path.abspath(__file__))
+
+EQUIPAMENTOS = [
+    'Transpaleteira elétrica Linde T20 SP - 2022',
+    'Empilhadeira Toyota 8FBE15 2019',
+    'Rebocador Still CX-T 2021',
+    'Empilhadeira retrátil Yale MR16 2020',
+    'Paleteira Jungheinrich EJE 116 - 2018',
+    'Empilhadeira Hyster H50FT 2017',
+]
+SINTOMAS = [
+    'não levanta a carga', 'perde tração em rampa', 'desliga sozinha após alguns minutos',
+    'apresenta vazamento de óleo', 'não liga ao girar a chave', 'o freio não segura',
+    'a bateria descarrega rápido', 'exibe código de erro no painel',
+]
+DETALHES = [
+    'e faz um ruído na bomba hidráulica', 'depois de carregar a bateria', 'só com carga acima de 1 tonelada',
+    'com cheiro de queimado perto do motor', 'quando está frio pela manhã', 'e o display pisca',
+]
+REFINAMENTOS = [
+    'O defeito era o relé da bomba; troquei o relé e voltou a funcionar',
+    'Encontrei o conector do sensor de velocidade oxidado, limpei e resolveu',
+    'Era o fusível principal queimado, substituído por um de 355A',
+    'O retentor do cilindro estava danificado e foi trocado',
+]
+
+
+# Conversa completa de um técnico: intro → problem_description → feedback,
+# e, quando a primeira resposta não resolve, solution_refinement → feedback_refinado
+def roteiro_tecnico(aleatorio: random.Random, taxa_sim: float) -> List[str]:
+    roteiro = [
+        '/start',
+        aleatorio.choice(EQUIPAMENTOS),
+        f"A máquina {aleatorio.choice(SINTOMAS)} {aleatorio.choice(DETALHES)}",
+    ]
+    if aleatorio.random() < taxa_sim:
+        return roteiro + ['sim']
+    return roteiro + ['não', aleatorio.choice(REFINAMENTOS), 'sim']
+
+
+def popular_historico(db: FirestoreMemoria, quantidade: int, aleatorio: random.Random):
+    agora = datetime.now(timezone.utc)
+    lote = db.batch()
+    colecao = db.collection('manutencoes')
+    for i in range(quantidade):
+        lote.set(colecao.document(), {
+            'equipamento': aleatorio.choice(EQUIPAMENTOS),
+            'equipamento_id': None,
+            'problema': f"{aleatorio.choice(SINTOMAS)} {aleatorio.choice(DETALHES)}",
+            'solucao': aleatorio.choice(REFINAMENTOS),
+            'data': agora - timedelta(minutes=i),
+        })
+    lote.commit()
+
+
+def versao_codigo() -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=DIRETORIO_REPOSITORIO,
+            capture_output=True, text=True, timeout=10
+        ).stdout.strip()
+    except Exception:
+        commit = ''
+    return {'commit': commit or None, 'data': datetime.now(timezone.utc).isoformat(timespec='seconds')}
+
+
+# Importa o bot dentro de um diretório temporário: os arquivos locais
+# (bot.log, índice, diário de escrita, sessões) não tocam os do deploy.
+# Só o Telegram, o Gemini e o Firestore são substituídos; todo o resto do
+# caminho (sessões, cache, índice, pool do histórico, envio) é o real.
+def preparar_bot(args, diretorio: str, telegram: TelegramFalso, db: FirestoreMemoria):
+    os.chdir(diretorio)
+    os.environ['TELEGRAM_BOT_TOKEN'] = '123456:carga'
+    os.environ['STREAMING_ATIVO'] = '1' if args.streaming else '0'
+
+    import telebot
+    import bot
+
+    logging.getLogger().setLevel(getattr(logging, args.log_nivel))
+    telebot.apihelper.API_URL = telegram.api_url
+
+    aleatorio = random.Random(args.semente)
+    bot.db = db
+    bot.model = bot.criar_governador(lambda nome: GeminiFalso(
+        nome,
+        latencia=args.gemini_latencia * (args.gemini_fator_flash if 'flash' in nome else 1.0),
+        dispersao=args.gemini_dispersao,
+        taxa_falhas=args.gemini_taxa_falhas,
+        semente=aleatorio.random()
+    ))
+    bot.configurar_escrita_diferida()
+    bot.configurar_sessoes()
+    bot.configurar_cache_diagnosticos()
+    bot.configurar_cache_historico()
+    bot.configurar_equipamentos()
+    if not args.sem_indice:
+        bot.configurar_indice()
+    bot.configurar_tokens()
+    # Rastros por update (RASTROS_ARQUIVO), sem abrir o servidor de métricas
+    bot.configurar_metricas(abrir_servidor=False)
+    if args.preaquecer:
+        preaquecer_antes_da_carga(bot, db, args.preaquecer)
+    return bot, telebot
+
+
+# Rodada fora do pico antes da carga: o armazém recebe os pares mais
+# frequentes do histórico simulado e o bot passa a consultá-lo primeiro
+def preaquecer_antes_da_carga(bot, db: FirestoreMemoria, quantidade: int):
+    import preaquecer_respostas
+
+    cache_recentes = bot.cache_diagnosticos
+    bot.cache_diagnosticos = bot.abrir_respostas_preaquecidas()
+    inicio = time.perf_counter()
+    pares = preaquecer_respostas.minerar_pares(db, limite=quantidade)
+    progresso = {'pares': pares, 'concluidos': []}
+    contagem = preaquecer_respostas.preaquecer(pares, progresso, preaquecer_respostas.ARQUIVO_PROGRESSO, 4)
+    # Como em produção, o bot consulta o armazém sem gravar nele
+    bot.cache_diagnosticos.fechar()
+    bot.respostas_preaquecidas = bot.abrir_respostas_preaquecidas(somente_leitura=True)
+    bot.cache_diagnosticos = cache_recentes
+    print(
+        f"Pré-aquecimento: {len(pares)} pares, {contagem} em {time.perf_counter() - inicio:.1f}s",
+        file=sys.stderr
+    )
+
+
+# Um técnico envia a mensagem seguinte só depois de receber a resposta da
+# anterior, como no chat; a latência de cada mensagem é atribuída à etapa
+# em que a conversa estava quando ela chegou
+def simular_tecnico(bot, telebot, gerador, user_id, roteiros, pausa, atraso_inicial):
+    time.sleep(atraso_inicial)
+    resultados = []
+    for roteiro in roteiros:
+        for texto in roteiro:
+            mensagem = telebot.types.Update.de_json(gerador.criar(user_id, texto)).message
+            if texto == '/start':
+                etapa, handler = 'start', bot.mensagem_inicial
+            else:
+                etapa, handler = bot.user_state.get(user_id, {}).get('stage', 'intro'), bot.handle_message
+
+            inicio = time.perf_counter()
+            erro = None
+            try:
+                handler(mensagem)
+            except Exception as e:
+                erro = repr(e)
+            resultados.append({'etapa': etapa, 'latencia': time.perf_counter() - inicio, 'erro': erro})
+            if pausa:
+                time.sleep(pausa)
+    return resultados
+
+
+def resumir_etapas(resultados: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    por_etapa: Dict[str, List[float]] = {}
+    for resultado in resultados:
+        por_etapa.setdefault(resultado['etapa'], []).append(resultado['latencia'])
+    por_etapa['total'] = [r['latencia'] for r in resultados]
+
+    etapas = {}
+    for etapa, latencias in por_etapa.items():
+        etapas[etapa] = {
+            'contagem': len(latencias),
+            'media_ms': round(sum(latencias) / len(latencias) * 1000, 1),
+            'p50_ms': round(percentil(latencias, 50) * 1000, 1),
+            'p95_ms': round(percentil(latencias, 95) * 1000, 1),
+            'p99_ms': round(percentil(latencias, 99) * 1000, 1),
+            'maximo_ms': round(max(latencias) * 1000, 1),
+        }
+    return etapas
+
+
+def comparar(anterior: Dict[str, Any], atual: Dict[str, Any]):
+    def variacao(antes, depois):
+        if not antes:
+            return '    n/d'
+        return f"{(depois - antes) / antes * 100:+6.1f}%"
+
+    print(f"\nComparação com {anterior['versao'].get('commit')} ({anterior['versao'].get('data')})")
+    antes, depois = anterior['resumo']['mensagens_por_s'], atual['resumo']['mensagens_por_s']
+    print(f"{'mensagens/s':<22} {antes:>10} → {depois:<10} {variacao(antes, depois)}")
+    for etapa, dados in atual['etapas'].items():
+        dados_anteriores = anterior['etapas'].get(etapa)
+        if dados_anteriores is None:
+            continue
+        for campo in ('p50_ms', 'p95_ms', 'p99_ms'):
+            antes, depois = dados_anteriores[campo], dados[campo]
+            print(f"{etapa + ' ' + campo:<22} {antes:>10} → {depois:<10} {variacao(antes, depois)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark de carga do fluxo de atendimento com Telegram, Gemini e Firestore simulados"
+    )
+    parser.add_argument('--tecnicos', type=int, default=20, help="Técnicos simultâneos")
+    parser.add_argument('--atendimentos', type=int, default=3, help="Conversas completas por técnico")
+    parser.add_argument('--pausa', type=float, default=0.0, help="Segundos entre mensagens de um técnico")
+    parser.add_argument('--rampa', type=float, default=1.0, help="Segundos para todos os técnicos começarem")
+    parser.add_argument('--taxa-sim', type=float, default=0.5, help="Fração que aprova o primeiro diagnóstico")
+    parser.add_argument('--streaming', action='store_true', help="Usa o envio do diagnóstico em streaming")
+    parser.add_argument('--gemini-latencia', type=float, default=2.0, help="Mediana em segundos (modelos pro)")
+    parser.add_argument('--gemini-dispersao', type=float, default=0.5, help="Sigma da log-normal")
+    parser.add_argument('--gemini-fator-flash', type=float, default=0.4, help="Latência dos flash / pro")
+    parser.add_argument('--gemini-taxa-falhas', type=float, default=0.02)
+    parser.add_argument('--telegram-latencia', type=float, default=0.05, help="Mediana em segundos")
+    parser.add_argument('--telegram-taxa-429', type=float, default=0.0)
+    parser.add_argument('--firestore-latencia', type=float, default=0.03, help="Mediana em segundos")
+    parser.add_argument('--historico', type=int, default=200, help="Manutenções pré-carregadas no Firestore")
+    parser.add_argument('--sem-indice', action='store_true',
+                        help="Busca o histórico no Firestore (e no cache de histórico) em vez do índice local")
+    parser.add_argument('--preaquecer', type=int, default=0,
+                        help="Pares pré-gerados por preaquecer_respostas.py antes da carga (0 = não)")
+    parser.add_argument('--semente', type=int, default=42)
+    parser.add_argument('--log-nivel', default='WARNING', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    parser.add_argument('--saida', default=None, help="Arquivo JSON para gravar os resultados")
+    parser.add_argument('--comparar', default=None, help="Resultado JSON de outra versão para comparação")
+    args = parser.parse_args()
+
+    saida = os.path.abspath(args.saida) if args.saida else None
+    anterior = None
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as arquivo:
+            anterior = json.load(arquivo)
+    versao = versao_codigo()
+
+    aleatorio = random.Random(args.semente)
+    telegram = TelegramFalso(
+        latencia=args.telegram_latencia, taxa_429=args.telegram_taxa_429, semente=args.semente
+    ).iniciar()
+    db = FirestoreMemoria(latencia=args.firestore_latencia, semente=args.semente)
+    popular_historico(db, args.historico, aleatorio)
+
+    with tempfile.TemporaryDirectory(prefix='carga_bot_') as diretorio:
+        bot, telebot = preparar_bot(args, diretorio, telegram, db)
+        gerador = GeradorUpdates()
+
+        inicio = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.tecnicos, thread_name_prefix='tecnico') as executor:
+            futuros = [
+                executor.submit(
+                    simular_tecnico, bot, telebot, gerador, 900000000 + i,
+                    [roteiro_tecnico(aleatorio, args.taxa_sim) for _ in range(args.atendimentos)],
+                    args.pausa, args.rampa * i / max(args.tecnicos, 1)
+                )
+                for i in range(args.tecnicos)
+            ]
+            resultados = [r for futuro in futuros for r in futuro.result()]
+        duracao = time.perf_counter() - inicio
+
+        # Encerrar antes de medir o Firestore: a escrita diferida grava o que falta
+        bot.encerrar_servicos()
+        relatorio = {
+            'versao': versao,
+            'parametros': vars(args),
+            'resumo': {
+                'tecnicos': args.tecnicos,
+                'mensagens': len(resultados),
+                'erros': sum(1 for r in resultados if r['erro']),
+                'duracao_s': round(duracao, 3),
+                'mensagens_por_s': round(len(resultados) / duracao, 2) if duracao else 0.0,
+            },
+            'etapas': resumir_etapas(resultados),
+            'internos': bot.tempos.resumo(),
+            'telegram': telegram.metricas(),
+            'gemini': bot.model.metricas(),
+            'firestore': db.metricas(),
+            'coalescencia': bot.voos_diagnostico.estatisticas(),
+            'tokens': bot.orcamento_tokens.metricas(),
+            'preaquecidas': (
+                bot.respostas_preaquecidas.estatisticas() if bot.respostas_preaquecidas is not None else {}
+            ),
+            'historico': bot.cache_historico.estatisticas() if bot.cache_historico is not None else {},
+            'envio': bot.agendador_envios.metricas(),
+        }
+    telegram.parar()
+
+    print(json.dumps({'resumo': relatorio['resumo'], 'etapas': relatorio['etapas']}, indent=2, ensure_ascii=False))
+    if anterior is not None:
+        comparar(anterior, relatorio)
+    if saida:
+        with open(saida, 'w', encoding='utf-8') as arquivo:
+            json.dump(relatorio, arquivo, ensure_ascii=False, indent=2, default=str)
+        print(f"\nResultados gravados em {saida}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
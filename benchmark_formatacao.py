@@ -0,0 +1,176 @@
+import re
+import html
+import random
+import argparse
+import timeit
+
+from formatacao import sanitizar_html, dividir_mensagem, TAGS_PERMITIDAS
+
+PADRAO_TAG = re.compile(r'<(/?)(\w+)>')
+
+
+# Implementações anteriores, mantidas aqui apenas para comparação
+def sanitizar_html_anterior(texto):
+    texto = texto.replace('**', '')
+    linhas = texto.split('\n')
+    texto_formatado = []
+    em_lista = False
+    em_procedimento = False
+    paragrafo_atual = []
+
+    for linha in linhas:
+        linha = linha.strip()
+        if not linha:
+            if paragrafo_atual:
+                texto_formatado.append('\n'.join(paragrafo_atual))
+                paragrafo_atual = []
+            texto_formatado.append('')
+            continue
+        if linha.startswith(('*', '-', '•')):
+            linha_limpa = linha.lstrip('*-•').strip()
+            paragrafo_atual.append(f'🔹 {linha_limpa}')
+            em_lista = True
+        elif re.match(r'^\d+\.', linha):
+            paragrafo_atual.append(f'{linha}')
+            em_procedimento = True
+        else:
+            if em_lista or em_procedimento:
+                texto_formatado.append('\n'.join(paragrafo_atual))
+                paragrafo_atual = []
+                em_lista = False
+                em_procedimento = False
+            paragrafo_atual.append(linha)
+
+    if paragrafo_atual:
+        texto_formatado.append('\n'.join(paragrafo_atual))
+
+    texto_final = '\n\n'.join(texto_formatado)
+    texto_final = html.escape(texto_final, quote=False)
+    for tag in ['b', 'i', 'u', 'code', 'pre']:
+        texto_final = texto_final.replace(f'&lt;{tag}&gt;', f'<{tag}>')
+        texto_final = texto_final.replace(f'&lt;/{tag}&gt;', f'</{tag}>')
+    texto_final = re.sub(r'\n{3,}', '\n\n', texto_final)
+    texto_final += '\n\n<i>🚨 RELATÓRIO GERADO POR SISTEMA DE DIAGNÓSTICO AUTOMATIZADO</i>'
+    return texto_final
+
+
+def dividir_mensagem_anterior(texto, max_length=4000):
+    paragrafos = texto.split('\n')
+    mensagens = []
+    mensagem_atual = ""
+    for paragrafo in paragrafos:
+        if len(mensagem_atual) + len(paragrafo) + 2 > max_length:
+            mensagens.append(mensagem_atual.strip())
+            mensagem_atual = ""
+        if mensagem_atual:
+            mensagem_atual += "\n"
+        mensagem_atual += paragrafo
+    if mensagem_atual:
+        mensagens.append(mensagem_atual.strip())
+    return mensagens
+
+
+# Resposta sintética no formato que o prompt pede ao Gemini
+def gerar_resposta(secoes: int, semente: int = 42) -> str:
+    aleatorio = random.Random(semente)
+    palavras = (
+        'bomba hidráulica relé contator motor tração bateria fusível sensor válvula '
+        'pressão óleo vazamento cabo conector placa controlador & <diagnóstico> 24V'
+    ).split()
+
+    def frase(minimo=6, maximo=18):
+        return ' '.join(aleatorio.choice(palavras) for _ in range(aleatorio.randint(minimo, maximo)))
+
+    linhas = []
+    for i in range(secoes):
+        linhas.append(f'**<b>SEÇÃO {i + 1}</b>**')
+        linhas.append(frase())
+        linhas.append('')
+        for _ in range(aleatorio.randint(2, 5)):
+            linhas.append(f'* {frase()} <i>{frase(2, 4)}</i>')
+        for passo in range(1, aleatorio.randint(3, 6)):
+            linhas.append(f'{passo}. {frase()} <code>{frase(1, 3)}</code>')
+        linhas.append(frase(20, 60))
+        linhas.append('')
+    return '\n'.join(linhas)
+
+
+def tags_equilibradas(mensagem: str) -> bool:
+    pilha = []
+    for fechamento, tag in PADRAO_TAG.findall(mensagem):
+        if tag not in TAGS_PERMITIDAS:
+            continue
+        if not fechamento:
+            pilha.append(tag)
+        elif not pilha or pilha.pop() != tag:
+            return False
+    return not pilha
+
+
+def verificar(texto: str, max_length: int):
+    anterior = sanitizar_html_anterior(texto)
+    novo = sanitizar_html(texto)
+    # A versão anterior podia deixar \n\n\n\n antes do rodapé; fora isso o texto é o mesmo
+    assert re.sub(r'\n{3,}', '\n\n', anterior) == novo, "sanitizar_html diverge da versão anterior"
+
+    mensagens = dividir_mensagem(novo, max_length)
+    assert all(len(m) <= max_length for m in mensagens), "mensagem acima do limite"
+    assert all(tags_equilibradas(m) for m in mensagens), "mensagem com tags desequilibradas"
+
+    quebradas = sum(not tags_equilibradas(m) for m in dividir_mensagem_anterior(anterior, max_length))
+    return len(mensagens), quebradas
+
+
+# Entradas em que reabrir a pilha de tags não cabia na mensagem e a divisão
+# deixava de avançar; o problema digitado pelo técnico volta no contexto do histórico
+CASOS_DEGENERADOS = (
+    ('<pre>bloco\n<b>aberto\n<pre>bloco\n<pre>bloco\n<code>x</code>', 50),
+    (sanitizar_html('Problema: ' + '<b>' * 1400 + ' bomba\n• causa'), 4000),
+    (sanitizar_html('<i><b>' * 3000 + ' palavra' * 2000), 4000),
+)
+
+
+def verificar_degenerados():
+    for texto, max_length in CASOS_DEGENERADOS:
+        mensagens = dividir_mensagem(texto, max_length)
+        assert mensagens, "caso degenerado sem mensagens"
+        assert all(len(m) <= max_length for m in mensagens), "mensagem acima do limite"
+        assert all(tags_equilibradas(m) for m in mensagens), "mensagem com tags desequilibradas"
+
+
+def medir(funcao, repeticoes: int) -> float:
+    return min(timeit.repeat(funcao, number=repeticoes, repeat=5)) / repeticoes * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compara o formatador atual com a implementação anterior")
+    parser.add_argument('--secoes', type=int, nargs='+', default=[2, 5, 40, 200])
+    parser.add_argument('--limite', type=int, default=4000)
+    parser.add_argument('--repeticoes', type=int, default=50)
+    args = parser.parse_args()
+
+    verificar_degenerados()
+
+    print(f"{'tamanho':>9} {'msgs':>5} {'quebradas ant.':>15} "
+          f"{'sanitizar ant.':>15} {'sanitizar':>10} {'dividir ant.':>13} {'dividir':>9} "
+          f"{'total ant.':>11} {'total':>9}  (µs)")
+    for secoes in args.secoes:
+        texto = gerar_resposta(secoes)
+        mensagens, quebradas = verificar(texto, args.limite)
+        sanitizado_anterior = sanitizar_html_anterior(texto)
+        sanitizado = sanitizar_html(texto)
+
+        tempos = (
+            medir(lambda: sanitizar_html_anterior(texto), args.repeticoes),
+            medir(lambda: sanitizar_html(texto), args.repeticoes),
+            medir(lambda: dividir_mensagem_anterior(sanitizado_anterior, args.limite), args.repeticoes),
+            medir(lambda: dividir_mensagem(sanitizado, args.limite), args.repeticoes),
+        )
+        tempos += (tempos[0] + tempos[2], tempos[1] + tempos[3])
+        print(f"{len(texto):>9} {mensagens:>5} {quebradas:>15} " + ' '.join(
+            f"{t:>{w}.1f}" for t, w in zip(tempos, (15, 10, 13, 9, 11, 9))
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,28 +2,43 @@ import os
 import logging
 import time
 import threading
+import asyncio
 import telebot
 import google.generativeai as genai
 from google.cloud import firestore
 from dotenv import load_dotenv
 from datetime import datetime
 import sys
-import re
-import html
-from google.oauth2 import service_account
-import json
-from difflib import SequenceMatcher
+import functools
+import contextvars
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturoTimeoutError
 from typing import List, Dict, Any
-
-# Configurar logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout),
-        logging.FileHandler('bot.log')
-    ]
+from indice_similaridade import IndiceSimilaridade, carregar_ou_construir
+from caracteristicas import extrair_caracteristicas, caracteristicas_comparaveis, similaridade_assinaturas
+from equipamentos import RegistroEquipamentos
+import conexao_firestore
+from cache_historico import CacheHistorico
+from cache_diagnostico import BackendSQLite, CacheDiagnostico, criar_cache_diagnostico
+from pool_trabalho import PoolOrdenado
+from escrita_diferida import EscritaDiferida
+from sessoes import EstadoUsuarios, criar_estado_usuarios
+from formatacao import sanitizar_html, dividir_mensagem
+from atendimento import (
+    Responder, Enviar, Diagnosticar, Salvar, TransmitirDiagnostico, Refinar, AtendimentoRecusado,
+    iniciar_atendimento, conduzir_atendimento, prompt_refinamento
 )
+from refinamento import montar_conteudos
+from orcamento_tokens import ContadorTokens, LimiteRequisicaoExcedido, OrcamentoTokens
+from selecao_modelo import escolher_modelo
+from governador_gemini import GovernadorGemini
+from streaming import PlanoTransmissao, tempo_espera_telegram, edicao_sem_alteracao
+from servidor_webhook import ServidorWebhook
+from metricas import tempos, ServidorMetricas
+from registro_logs import configurar_logging, encerrar_logging, metricas_logging, por_mensagem
+from envio import AgendadorEnvios
+from coalescencia import VooUnico, chave_coalescencia
+
 logger = logging.getLogger(__name__)
 
 # Carregar variáveis de ambiente
@@ -32,81 +47,260 @@ load_dotenv()
 # Configurações
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
+INDICE_DIRETORIO = os.getenv('INDICE_DIRETORIO', 'indice_manutencoes')
+INDICE_DIMENSAO = int(os.getenv('INDICE_DIMENSAO', '1024'))
+INDICE_SALVAR_A_CADA = int(os.getenv('INDICE_SALVAR_A_CADA', '20'))
+INDICE_VERIFICAR_A_CADA = float(os.getenv('INDICE_VERIFICAR_A_CADA', '30'))  # segundos entre checagens da geração em disco
+CACHE_DIAGNOSTICO_BACKEND = os.getenv('CACHE_DIAGNOSTICO_BACKEND', 'memoria')  # memoria, sqlite ou desligado
+CACHE_DIAGNOSTICO_TAMANHO = int(os.getenv('CACHE_DIAGNOSTICO_TAMANHO', '500'))
+CACHE_DIAGNOSTICO_TTL = float(os.getenv('CACHE_DIAGNOSTICO_TTL', str(6 * 3600)))
+CACHE_DIAGNOSTICO_SIMILARIDADE = float(os.getenv('CACHE_DIAGNOSTICO_SIMILARIDADE', '0'))  # 0 desativa
+CACHE_DIAGNOSTICO_ARQUIVO = os.getenv('CACHE_DIAGNOSTICO_ARQUIVO', 'cache_diagnosticos.sqlite3')
+PREAQUECIDAS_ARQUIVO = os.getenv('PREAQUECIDAS_ARQUIVO', 'respostas_preaquecidas.sqlite3')  # vazio desativa
+PREAQUECIDAS_TAMANHO = int(os.getenv('PREAQUECIDAS_TAMANHO', '2000'))
+PREAQUECIDAS_TTL = float(os.getenv('PREAQUECIDAS_TTL', str(7 * 24 * 3600)))  # vale até a próxima rodada noturna
+PREAQUECIDAS_SIMILARIDADE = float(os.getenv('PREAQUECIDAS_SIMILARIDADE', '0.75'))
+HISTORICO_CACHE_TAMANHO = int(os.getenv('HISTORICO_CACHE_TAMANHO', '100'))  # equipamentos com listener; 0 desativa
+HISTORICO_CACHE_TTL = float(os.getenv('HISTORICO_CACHE_TTL', '3600'))  # validade sem notícias do listener
+POOL_WORKERS = int(os.getenv('POOL_WORKERS', '4'))  # 0 processa as mensagens na thread do telebot
+POOL_CAPACIDADE_FILA = int(os.getenv('POOL_CAPACIDADE_FILA', '0'))  # 0 = sem limite
+MODO_EXECUCAO = os.getenv('MODO_EXECUCAO', 'sync')  # sync (TeleBot + threads) ou async (AsyncTeleBot)
+MODO_RECEBIMENTO = os.getenv('MODO_RECEBIMENTO', 'polling')  # polling ou webhook (modo sync)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # URL pública base, ex.: https://meu-bot.up.railway.app
+WEBHOOK_CAMINHO = os.getenv('WEBHOOK_CAMINHO', '/telegram/webhook')
+WEBHOOK_SEGREDO = os.getenv('WEBHOOK_SEGREDO')
+WEBHOOK_PORTA = int(os.getenv('PORT', '8080'))
+WEBHOOK_CAPACIDADE_FILA = int(os.getenv('WEBHOOK_CAPACIDADE_FILA', '100'))
+WEBHOOK_CONSUMIDORES = int(os.getenv('WEBHOOK_CONSUMIDORES', '2'))  # filas por remetente; a ordem por técnico é mantida
+WEBHOOK_MAX_CONEXOES = int(os.getenv('WEBHOOK_MAX_CONEXOES', '1'))  # entregas simultâneas do Telegram; 1 preserva a ordem de chegada
+STREAMING_ATIVO = os.getenv('STREAMING_ATIVO', '0') == '1'  # Editar a mensagem conforme o Gemini gera
+STREAMING_INTERVALO_EDICAO = float(os.getenv('STREAMING_INTERVALO_EDICAO', '1.0'))  # segundos por chat
+MODELO_CACHE_ARQUIVO = os.getenv('MODELO_CACHE_ARQUIVO', 'modelo_gemini.json')
+MODELO_CACHE_TTL = float(os.getenv('MODELO_CACHE_TTL', str(6 * 3600)))
+MODELO_SONDA_TIMEOUT = float(os.getenv('MODELO_SONDA_TIMEOUT', '10'))
+GEMINI_MAX_EM_VOO = int(os.getenv('GEMINI_MAX_EM_VOO', '8'))  # chamadas simultâneas ao Gemini
+GEMINI_LIMIAR_FALHAS = int(os.getenv('GEMINI_LIMIAR_FALHAS', '3'))  # falhas seguidas que abrem o disjuntor
+GEMINI_TEMPO_DISJUNTOR = float(os.getenv('GEMINI_TEMPO_DISJUNTOR', '30'))  # segundos até testar de novo
+HEDGE_ATIVO = os.getenv('HEDGE_ATIVO', '0') == '1'  # Segunda chamada a um modelo rápido quando o principal demora
+HEDGE_MODELO = os.getenv('HEDGE_MODELO')  # Padrão: o primeiro modelo flash de MODELOS_PREFERIDOS
+HEDGE_PERCENTIL = float(os.getenv('HEDGE_PERCENTIL', '95'))
+HEDGE_ATRASO_INICIAL = float(os.getenv('HEDGE_ATRASO_INICIAL', '8'))  # segundos, até haver amostras suficientes
+SESSOES_BACKEND = os.getenv('SESSOES_BACKEND', 'memoria')  # memoria ou sqlite (sobrevive a reinícios)
+SESSOES_ARQUIVO = os.getenv('SESSOES_ARQUIVO', 'sessoes.sqlite3')
+SESSOES_TTL_INATIVIDADE = float(os.getenv('SESSOES_TTL_INATIVIDADE', str(24 * 3600)))
+SESSOES_MAXIMO = int(os.getenv('SESSOES_MAXIMO', '10000'))
+ESCRITA_DIFERIDA_ATIVA = os.getenv('ESCRITA_DIFERIDA_ATIVA', '1') == '1'  # 0 grava cada manutenção na hora
+ESCRITA_DIARIO_ARQUIVO = os.getenv('ESCRITA_DIARIO_ARQUIVO', 'manutencoes_pendentes.jsonl')
+ESCRITA_JANELA = float(os.getenv('ESCRITA_JANELA', '2.0'))  # segundos até gravar um lote incompleto
+ESCRITA_TAMANHO_LOTE = int(os.getenv('ESCRITA_TAMANHO_LOTE', '500'))
+DIAGNOSTICO_PRAZO = float(os.getenv('DIAGNOSTICO_PRAZO', '30'))  # segundos para Gemini + histórico
+REFINAMENTO_CHAT = os.getenv('REFINAMENTO_CHAT', '1') == '1'  # 0 volta ao prompt de diagnóstico aninhado
+REFINAMENTO_ORCAMENTO_TOKENS = int(os.getenv('REFINAMENTO_ORCAMENTO_TOKENS', '450'))  # entrada por rodada; 0 = sem limite
+TOKENS_CONTAGEM = os.getenv('TOKENS_CONTAGEM', 'calibrada')  # api, calibrada (count_tokens só no prefixo fixo) ou local
+TOKENS_MAXIMO_REQUISICAO = int(os.getenv('TOKENS_MAXIMO_REQUISICAO', '4000'))  # entrada por chamada; 0 = sem limite
+TOKENS_ORCAMENTO_USUARIO = int(os.getenv('TOKENS_ORCAMENTO_USUARIO', '100000'))  # entrada + saída na janela; 0 = sem limite
+TOKENS_JANELA_USUARIO = float(os.getenv('TOKENS_JANELA_USUARIO', '3600'))  # segundos
+ENVIO_TAXA_GLOBAL = float(os.getenv('ENVIO_TAXA_GLOBAL', '30'))  # mensagens/s para todo o bot
+ENVIO_TAXA_POR_CHAT = float(os.getenv('ENVIO_TAXA_POR_CHAT', '1'))  # mensagens/s por chat, após a rajada
+ENVIO_RAJADA_POR_CHAT = int(os.getenv('ENVIO_RAJADA_POR_CHAT', '3'))
+METRICAS_PORTA = int(os.getenv('METRICAS_PORTA', '0'))  # 0 desativa; /metrics e /rastros nunca saem na porta pública do webhook
+METRICAS_HOST = os.getenv('METRICAS_HOST', '127.0.0.1')  # /rastros expõe user_id e message_id por update
+RASTROS_ARQUIVO = os.getenv('RASTROS_ARQUIVO')  # JSON por linha com os spans de cada update
+RASTROS_LIMIAR = float(os.getenv('RASTROS_LIMIAR', '0'))  # grava só updates mais lentos que isso (segundos)
+LOG_MODO = os.getenv('LOG_MODO', 'fila')  # fila (thread dedicada escreve) ou sincrono
+LOG_NIVEL = os.getenv('LOG_NIVEL', 'INFO')
+LOG_FORMATO = os.getenv('LOG_FORMATO', 'texto')  # texto ou json (um objeto por linha)
+LOG_ARQUIVO = os.getenv('LOG_ARQUIVO', 'bot.log')  # vazio desativa o arquivo
+LOG_ARQUIVO_TAMANHO_MAXIMO = int(os.getenv('LOG_ARQUIVO_TAMANHO_MAXIMO', str(10 * 1024 * 1024)))  # 0 = sem rotação
+LOG_ARQUIVO_BACKUPS = int(os.getenv('LOG_ARQUIVO_BACKUPS', '5'))
+LOG_AMOSTRAGEM = float(os.getenv('LOG_AMOSTRAGEM', '1.0'))  # fração dos usuários com as linhas por mensagem
+
+# Configurar logging
+configurar_logging(
+    LOG_MODO,
+    LOG_NIVEL,
+    LOG_ARQUIVO or None,
+    LOG_ARQUIVO_TAMANHO_MAXIMO,
+    LOG_ARQUIVO_BACKUPS,
+    LOG_FORMATO,
+    LOG_AMOSTRAGEM
+)
 
 # Variáveis globais
-model = None
+model = None  # GovernadorGemini: mesma interface do GenerativeModel, com failover entre modelos
+saude_modelos = {}  # Resultado da última sondagem de modelos do Gemini
 db = None
+db_async = None  # firestore.AsyncClient, usado apenas no modo assíncrono
+bot_assincrono = None
+indice_historico = None  # Índice vetorial local sobre toda a coleção 'manutencoes'
+indice_verificado_em = 0.0
+trava_recarga_indice = threading.Lock()
+registro_equipamentos = None  # Resolve o texto livre do equipamento para um ID canônico
+cache_diagnosticos = None  # Respostas recentes por (equipamento, problema)
+respostas_preaquecidas = None  # Diagnósticos pré-gerados fora do pico (preaquecer_respostas.py)
+cache_historico = None  # Histórico recente por equipamento, mantido em dia por listeners do Firestore
+escrita_manutencoes = None  # Grava as manutenções em lotes, fora do caminho da resposta
 bot_running = threading.Event()
-user_state = {}  # Dicionário para rastrear o estado do usuário
+user_state = EstadoUsuarios()  # Estado da conversa por usuário; substituído em configurar_sessoes
+pool_atendimento = None  # Workers que processam as mensagens em ordem por usuário
+servidor_webhook = None
+servidor_metricas = None  # Endpoint Prometheus numa porta própria
+# Toda chamada de saída ao Telegram passa pelos limites global e por chat
+agendador_envios = AgendadorEnvios(ENVIO_TAXA_GLOBAL, ENVIO_TAXA_POR_CHAT, ENVIO_RAJADA_POR_CHAT)
+# Contagem local até configurar_tokens ligar o count_tokens do Gemini
+orcamento_tokens = OrcamentoTokens(
+    ContadorTokens(), TOKENS_MAXIMO_REQUISICAO, TOKENS_ORCAMENTO_USUARIO, TOKENS_JANELA_USUARIO
+)
+voos_diagnostico = VooUnico()  # Diagnósticos idênticos em andamento compartilham a mesma chamada
+executor_historico = ThreadPoolExecutor(max_workers=max(POOL_WORKERS, 2), thread_name_prefix='historico')
+travas_usuarios = {}  # Modo assíncrono: uma trava por usuário mantém a ordem das mensagens
 
 class KnowledgeBaseSolver:
-    def __init__(self, firestore_client):
+    def __init__(
+        self, 
+        firestore_client, 
+        indice: IndiceSimilaridade = None, 
+        registro: RegistroEquipamentos = None,
+        cache: CacheHistorico = None
+    ):
         self.db = firestore_client
+        self.indice = indice
+        self.registro = registro
+        self.cache = cache
         self.max_historical_solutions = 5
         self.similarity_threshold = 0.6
+        self.index_similarity_threshold = 0.35
 
-    def calcular_similaridade_textual(self, texto1: str, texto2: str) -> float:
-        return SequenceMatcher(None, texto1.lower(), texto2.lower()).ratio()
+    def indice_disponivel(self) -> bool:
+        return self.indice is not None and len(self.indice) > 0
 
-    def extrair_palavras_chave(self, texto: str) -> List[str]:
-        texto_limpo = re.sub(r'[^\w\s]', '', texto.lower())
-        
-        termos_irrelevantes = {
-            'o', 'a', 'de', 'da', 'do', 'em', 'para', 'com', 'por', 
-            'que', 'um', 'uma', 'e', 'ou', 'se', 'mas', 'então'
-        }
-        
-        palavras_chave = [
-            palavra for palavra in texto_limpo.split() 
-            if palavra not in termos_irrelevantes and len(palavra) > 2
-        ]
-        
-        return list(set(palavras_chave))
+    def buscar_no_indice(self, equipamento_id: str, problema: str) -> List[Dict[str, Any]]:
+        return self.indice.buscar(
+            problema,
+            top_k=self.max_historical_solutions,
+            equipamento=equipamento_id,
+            limiar=self.index_similarity_threshold
+        )
+
+    # Funciona tanto com firestore.Client quanto com firestore.AsyncClient
+    def consulta_historico(self, equipamento_id: str, equipamento: str):
+        manutencoes_ref = self.db.collection('manutencoes')
+        if equipamento_id:
+            filtro = manutencoes_ref.where('equipamento_id', '==', equipamento_id)
+        else:
+            filtro = manutencoes_ref.where('equipamento', '==', equipamento)
+        return (
+            filtro
+            .order_by('data', direction=firestore.Query.DESCENDING)
+            .limit(self.max_historical_solutions)
+        )
+
+    # Candidatos do índice local, que cobre todo o histórico sem ida ao Firestore
+    def candidatos_indice(self, equipamento_id: str, equipamento: str, problema: str) -> List[Dict[str, Any]]:
+        if not self.indice_disponivel():
+            return []
+        with tempos.medir('historico.indice'):
+            return self.buscar_no_indice(equipamento_id or equipamento, problema)
 
+    # Os candidatos do índice e os documentos recentes (cache com listeners
+    # ou consulta) passam pela mesma pontuação por características; um
+    # registro presente nas duas fontes conta uma vez
+    def ranquear(self, problema: str, candidatos, documentos) -> List[Dict[str, Any]]:
+        vistos = set()
+        unicos = []
+        for documento in list(candidatos) + list(documentos):
+            chave = (documento.get('problema'), documento.get('solucao'))
+            if chave not in vistos:
+                vistos.add(chave)
+                unicos.append(documento)
+        return self.selecionar_relevantes(problema, unicos)
+
+    # Com o índice, o histórico recente vem só do cache (que acompanha as
+    # gravações de outras instâncias); sem cache, o índice dispensa a
+    # consulta ao Firestore. Sem índice, cache ou consulta direta.
     def buscar_solucoes_contextualizadas(
         self, 
         equipamento: str, 
         problema: str
     ) -> List[Dict[str, Any]]:
         try:
-            palavras_chave_problema = self.extrair_palavras_chave(problema)
-            
-            manutencoes_ref = self.db.collection('manutencoes')
-            query = (
-                manutencoes_ref
-                .where('equipamento', '==', equipamento)
-                .order_by('data', direction=firestore.Query.DESCENDING)
-                .limit(self.max_historical_solutions)
-            )
+            equipamento_id = self.registro.resolver(equipamento) if self.registro else None
+            candidatos = self.candidatos_indice(equipamento_id, equipamento, problema)
             
-            solucoes_historicas = []
-            
-            for doc in query.stream():
-                solucao = doc.to_dict()
-                
-                prob_historico = solucao.get('problema', '')
-                similaridade = self.calcular_similaridade_textual(problema, prob_historico)
-                
-                palavras_historicas = self.extrair_palavras_chave(prob_historico)
-                intersecao_palavras = set(palavras_chave_problema) & set(palavras_historicas)
-                
-                score = (
-                    (similaridade * 0.6) + 
-                    (len(intersecao_palavras) / len(palavras_chave_problema) * 0.4)
-                )
-                
-                if score >= self.similarity_threshold:
-                    solucao['relevancia'] = score
-                    solucoes_historicas.append(solucao)
-            
-            solucoes_historicas.sort(key=lambda x: x['relevancia'], reverse=True)
+            if self.cache is not None:
+                documentos = self.cache.obter(equipamento_id, equipamento)
+                if documentos is None:
+                    with tempos.medir('firestore.consulta_historico'):
+                        documentos = self.cache.carregar(equipamento_id, equipamento)
+            elif self.indice_disponivel():
+                documentos = []
+            else:
+                query = self.consulta_historico(equipamento_id, equipamento)
+                with tempos.medir('firestore.consulta_historico'):
+                    documentos = [doc.to_dict() for doc in query.stream()]
+            return self.ranquear(problema, candidatos, documentos)
+        
+        except Exception as e:
+            logger.error(f"Erro na busca contextual: {e}")
+            return []
+
+    async def buscar_solucoes_contextualizadas_async(
+        self, 
+        equipamento: str, 
+        problema: str
+    ) -> List[Dict[str, Any]]:
+        try:
+            equipamento_id = None
+            if self.registro:
+                equipamento_id = await asyncio.to_thread(self.registro.resolver, equipamento)
+            candidatos = self.candidatos_indice(equipamento_id, equipamento, problema)
             
-            return solucoes_historicas
+            # Listeners só existem no cliente síncrono; o acerto não sai do loop
+            if self.cache is not None:
+                documentos = self.cache.obter(equipamento_id, equipamento)
+                if documentos is None:
+                    with tempos.medir('firestore.consulta_historico'):
+                        documentos = await asyncio.to_thread(self.cache.carregar, equipamento_id, equipamento)
+            elif self.indice_disponivel():
+                documentos = []
+            else:
+                query = self.consulta_historico(equipamento_id, equipamento)
+                with tempos.medir('firestore.consulta_historico'):
+                    documentos = [doc.to_dict() async for doc in query.stream()]
+            return self.ranquear(problema, candidatos, documentos)
         
         except Exception as e:
             logger.error(f"Erro na busca contextual: {e}")
             return []
 
+    # As características dos documentos vêm gravadas (caracteristicas.py):
+    # aqui só há interseção de radicais e similaridade entre assinaturas
+    def selecionar_relevantes(
+        self, 
+        problema: str, 
+        documentos
+    ) -> List[Dict[str, Any]]:
+        palavras_chave_problema, assinatura_problema = caracteristicas_comparaveis({'problema': problema})
+        
+        solucoes_historicas = []
+        
+        for solucao in documentos:
+            palavras_historicas, assinatura_historica = caracteristicas_comparaveis(solucao)
+            similaridade = similaridade_assinaturas(assinatura_problema, assinatura_historica)
+            
+            intersecao_palavras = palavras_chave_problema & palavras_historicas
+            cobertura = len(intersecao_palavras) / len(palavras_chave_problema) if palavras_chave_problema else 0.0
+            
+            score = (similaridade * 0.6) + (cobertura * 0.4)
+            
+            if score >= self.similarity_threshold:
+                solucao['relevancia'] = score
+                solucoes_historicas.append(solucao)
+        
+        solucoes_historicas.sort(key=lambda x: x['relevancia'], reverse=True)
+        
+        return solucoes_historicas
+
     def enriquecer_diagnostico(
         self, 
         diagnostico_ia: str, 
@@ -118,145 +312,69 @@ class KnowledgeBaseSolver:
         contexto_historico = "\n\n🕰️ <b>CONTEXTO HISTÓRICO DE MANUTENÇÕES</b>\n"
         
         for i, solucao in enumerate(solucoes_historicas[:3], 1):
+            # Registros fundidos pelo compactar_manutencoes.py contam as repetições
+            ocorrencias = solucao.get('ocorrencias') or 1
+            repeticoes = f", {ocorrencias} ocorrências" if ocorrencias > 1 else ""
             contexto_historico += (
-                f"📍 Registro {i} (Relevância: {solucao['relevancia']*100:.1f}%):\n"
+                f"📍 Registro {i} (Relevância: {solucao['relevancia']*100:.1f}%{repeticoes}):\n"
                 f"• Problema: {solucao.get('problema', 'N/A')}\n"
                 f"• Solução: {solucao.get('solucao', 'N/A')}\n\n"
             )
         
         return diagnostico_ia + contexto_historico
 
-def sanitizar_html(texto):
-    try:
-        # Remover marcações redundantes
-        texto = texto.replace('**', '')
-        
-        # Dividir o texto em seções mantendo quebras de linha
-        linhas = texto.split('\n')
-        texto_formatado = []
-        
-        # Flags de controle
-        em_lista = False
-        em_procedimento = False
-        paragrafo_atual = []
-        
-        for linha in linhas:
-            linha = linha.strip()
-            
-            # Pular linhas completamente vazias
-            if not linha:
-                # Adicionar parágrafo atual se existir
-                if paragrafo_atual:
-                    texto_formatado.append('\n'.join(paragrafo_atual))
-                    paragrafo_atual = []
-                # Adicionar linha em branco para manter espaçamento
-                texto_formatado.append('')
-                continue
-            
-            # Processamento de listas
-            if linha.startswith(('*', '-', '•')):
-                linha_limpa = linha.lstrip('*-•').strip()
-                paragrafo_atual.append(f'🔹 {linha_limpa}')
-                em_lista = True
-            
-            # Processamento de procedimentos numerados
-            elif re.match(r'^\d+\.', linha):
-                paragrafo_atual.append(f'{linha}')
-                em_procedimento = True
-            
-            # Conteúdo normal
-            else:
-                # Se estávamos em uma lista ou procedimento, fechamos
-                if em_lista or em_procedimento:
-                    texto_formatado.append('\n'.join(paragrafo_atual))
-                    paragrafo_atual = []
-                    em_lista = False
-                    em_procedimento = False
-                
-                paragrafo_atual.append(linha)
-        
-        # Adicionar último parágrafo se existir
-        if paragrafo_atual:
-            texto_formatado.append('\n'.join(paragrafo_atual))
-        
-        # Juntar o texto formatado
-        texto_final = '\n\n'.join(texto_formatado)
-        
-        # Tratamento HTML
-        texto_final = html.escape(texto_final, quote=False)
-        tags_permitidas = ['b', 'i', 'u', 'code', 'pre']
-        for tag in tags_permitidas:
-            texto_final = texto_final.replace(f'&lt;{tag}&gt;', f'<{tag}>')
-            texto_final = texto_final.replace(f'&lt;/{tag}&gt;', f'</{tag}>')
-        
-        # Remover espaços em branco excessivos, mas manter pelo menos duas quebras de linha
-        texto_final = re.sub(r'\n{3,}', '\n\n', texto_final)
-        
-        # Adicionar rodapé técnico
-        texto_final += '\n\n<i>🚨 RELATÓRIO GERADO POR SISTEMA DE DIAGNÓSTICO AUTOMATIZADO</i>'
-        
-        return texto_final
-    
-    except Exception as e:
-        logger.error(f"Erro na sanitização HTML: {e}")
-        return "Erro ao processar resposta técnica."
-
+# Lista de modelos recomendados, em ordem de preferência
+MODELOS_PREFERIDOS = [
+    'gemini-1.5-pro-latest',
+    'gemini-1.5-pro',
+    'gemini-1.5-flash-latest', 
+    'gemini-1.5-flash',
+    'gemini-pro'
+]
 
-def dividir_mensagem(texto, max_length=4000):
-    paragrafos = texto.split('\n')
-    mensagens = []
-    mensagem_atual = ""
-    
-    for paragrafo in paragrafos:
-        # Se a próxima linha ultrapassar o limite, criar nova mensagem
-        if len(mensagem_atual) + len(paragrafo) + 2 > max_length:
-            mensagens.append(mensagem_atual.strip())
-            mensagem_atual = ""
-        
-        # Adicionar linha à mensagem atual
-        if mensagem_atual:
-            mensagem_atual += "\n"
-        mensagem_atual += paragrafo
-    
-    # Adicionar última mensagem
-    if mensagem_atual:
-        mensagens.append(mensagem_atual.strip())
-    
-    return mensagens
+# criar_modelo recebe o nome do modelo; o benchmark de carga passa um
+# substituto local no lugar do genai.GenerativeModel
+def criar_governador(criar_modelo, indisponiveis=None):
+    modelo_hedge = None
+    if HEDGE_ATIVO:
+        modelo_hedge = HEDGE_MODELO or next(
+            (nome for nome in MODELOS_PREFERIDOS if 'flash' in nome), None
+        )
+    return GovernadorGemini(
+        MODELOS_PREFERIDOS,
+        criar_modelo,
+        max_em_voo=GEMINI_MAX_EM_VOO,
+        limiar_falhas=GEMINI_LIMIAR_FALHAS,
+        tempo_abertura=GEMINI_TEMPO_DISJUNTOR,
+        indisponiveis=indisponiveis,
+        modelo_hedge=modelo_hedge,
+        atraso_hedge_inicial=HEDGE_ATRASO_INICIAL
+    )
 
 # Configuração do Gemini
 def configurar_gemini():
-    global model
+    global model, saude_modelos
     try:
         logger.info("Iniciando configuração do Gemini")
         genai.configure(api_key=GOOGLE_API_KEY)
         
-        # Lista de modelos recomendados para substituição
-        modelos_preferidos = [
-            'gemini-1.5-pro-latest',
-            'gemini-1.5-pro',
-            'gemini-1.5-flash-latest', 
-            'gemini-1.5-flash',
-            'gemini-pro'
-        ]
-        
-        modelo_funcionando = None
-        
-        for nome_modelo in modelos_preferidos:
-            try:
-                logger.info(f"Tentando configurar modelo: {nome_modelo}")
-                model = genai.GenerativeModel(nome_modelo)
-                
-                # Teste rápido de geração de conteúdo
-                teste_resposta = model.generate_content("Sistema de empilhadeira")
-                
-                logger.info(f"Modelo {nome_modelo} configurado com sucesso!")
-                modelo_funcionando = nome_modelo
-                break
-            except Exception as e:
-                logger.warning(f"Falha ao configurar {nome_modelo}: {e}")
+        # Sondagem concorrente por metadados, com o resultado guardado em disco
+        selecao = escolher_modelo(
+            MODELOS_PREFERIDOS,
+            MODELO_CACHE_ARQUIVO,
+            MODELO_CACHE_TTL,
+            MODELO_SONDA_TIMEOUT
+        )
         
-        if modelo_funcionando:
+        if selecao:
+            modelo_funcionando = selecao['modelo']
+            saude_modelos = selecao.get('saude', {})
+            # Todos os modelos ficam disponíveis para failover; os que falharam
+            # na sondagem começam com o disjuntor aberto e são testados depois
+            model = criar_governador(genai.GenerativeModel, [
+                nome for nome in MODELOS_PREFERIDOS
+                if not saude_modelos.get(nome, {}).get('saudavel', nome == modelo_funcionando)
+            ])
             logger.info(f"Modelo final configurado: {modelo_funcionando}")
             return True
         else:
@@ -270,53 +388,309 @@ def configurar_gemini():
 # Configuração do Firestore
 def configurar_firestore():
     global db
+    db = conexao_firestore.configurar_firestore()
+    return db
+
+# Cliente assíncrono do Firestore para o modo asyncio
+def configurar_firestore_async():
+    global db_async
+    db_async = conexao_firestore.configurar_firestore_async()
+    return db_async
+
+# Carregar o registro de equipamentos canônicos
+def configurar_equipamentos():
+    global registro_equipamentos
     try:
-        # Usar variável de ambiente para credenciais
-        credentials_json = os.getenv('GOOGLE_APPLICATION_CREDENTIALS_JSON')
-        
-        if credentials_json:
-            # Converter string JSON para dicionário
-            creds_dict = json.loads(credentials_json)
-            
-            # Configurar credenciais
-            credentials = service_account.Credentials.from_service_account_info(creds_dict)
-            
-            # Inicializar Firestore com credenciais
-            db = firestore.Client(
-                project=os.getenv('GOOGLE_PROJECT_ID'), 
-                credentials=credentials
-            )
-            
-            logger.info("Conexão com Firestore estabelecida com sucesso!")
-            return db
-        else:
-            logger.error("Credenciais do Firestore não encontradas")
-            return None
-    
+        registro_equipamentos = RegistroEquipamentos(db)
+        registro_equipamentos.carregar()
+        return True
     except Exception as e:
-        logger.error(f"Erro na conexão com Firestore: {e}", exc_info=True)
+        logger.error(f"Erro ao carregar registro de equipamentos: {e}", exc_info=True)
+        registro_equipamentos = RegistroEquipamentos()
+        return False
+
+def resolver_equipamento(equipamento):
+    if registro_equipamentos is None:
         return None
+    return registro_equipamentos.resolver(equipamento)
+
+# Configurar o cache de diagnósticos na frente do Gemini
+def configurar_cache_diagnosticos():
+    global cache_diagnosticos
+    try:
+        cache_diagnosticos = criar_cache_diagnostico(
+            CACHE_DIAGNOSTICO_BACKEND,
+            CACHE_DIAGNOSTICO_TAMANHO,
+            CACHE_DIAGNOSTICO_TTL,
+            CACHE_DIAGNOSTICO_SIMILARIDADE or None,
+            CACHE_DIAGNOSTICO_ARQUIVO
+        )
+        return True
+    except Exception as e:
+        logger.error(f"Erro ao configurar cache de diagnósticos: {e}", exc_info=True)
+        cache_diagnosticos = None
+        return False
+
+# Armazém em disco das respostas pré-geradas pelo preaquecer_respostas.py; o
+# bot só lê (somente_leitura), e problemas parecidos com o do grupo também
+# são atendidos
+def abrir_respostas_preaquecidas(somente_leitura=False):
+    return CacheDiagnostico(
+        BackendSQLite(PREAQUECIDAS_ARQUIVO, somente_leitura),
+        PREAQUECIDAS_TAMANHO,
+        PREAQUECIDAS_TTL,
+        PREAQUECIDAS_SIMILARIDADE or None
+    )
+
+def configurar_respostas_preaquecidas():
+    global respostas_preaquecidas
+    if not PREAQUECIDAS_ARQUIVO:
+        return True
+    if not os.path.exists(PREAQUECIDAS_ARQUIVO):
+        logger.info(f"Sem respostas pré-geradas em {PREAQUECIDAS_ARQUIVO}")
+        return True
+    try:
+        respostas_preaquecidas = abrir_respostas_preaquecidas(somente_leitura=True)
+        return True
+    except Exception as e:
+        logger.error(f"Erro ao abrir respostas pré-geradas: {e}", exc_info=True)
+        respostas_preaquecidas = None
+        return False
+
+# Histórico por equipamento em memória; usa o cliente síncrono, o único com on_snapshot
+def configurar_cache_historico():
+    global cache_historico
+    if HISTORICO_CACHE_TAMANHO <= 0:
+        return True
+    try:
+        cache_historico = CacheHistorico(
+            KnowledgeBaseSolver(db).consulta_historico, HISTORICO_CACHE_TAMANHO, HISTORICO_CACHE_TTL
+        )
+        return True
+    except Exception as e:
+        logger.error(f"Erro ao configurar cache de histórico: {e}", exc_info=True)
+        cache_historico = None
+        return False
+
+# Sessões limitadas por inatividade e quantidade, opcionalmente persistidas em disco
+def configurar_sessoes():
+    global user_state
+    try:
+        user_state = criar_estado_usuarios(
+            SESSOES_BACKEND, SESSOES_TTL_INATIVIDADE, SESSOES_MAXIMO, SESSOES_ARQUIVO
+        )
+        return True
+    except Exception as e:
+        logger.error(f"Erro ao configurar sessões: {e}", exc_info=True)
+        user_state = EstadoUsuarios(SESSOES_TTL_INATIVIDADE, SESSOES_MAXIMO)
+        return False
+
+# Fila de gravação em lote; reenvia o que ficou no diário após uma queda
+def configurar_escrita_diferida():
+    global escrita_manutencoes
+    if not ESCRITA_DIFERIDA_ATIVA:
+        return True
+    try:
+        escrita_manutencoes = EscritaDiferida(
+            db, ESCRITA_DIARIO_ARQUIVO, tamanho_lote=ESCRITA_TAMANHO_LOTE, janela=ESCRITA_JANELA
+        )
+        return True
+    except Exception as e:
+        logger.error(f"Erro ao configurar escrita diferida: {e}", exc_info=True)
+        escrita_manutencoes = None
+        return False
+
+# Contagem de tokens pelo count_tokens do modelo ativo, com a estimativa
+# local como reserva; o prefixo fixo do diagnóstico é contado já aqui
+def configurar_tokens():
+    global orcamento_tokens
+    try:
+        contar_api = None
+        if model is not None and TOKENS_CONTAGEM != 'local':
+            contar_api = lambda texto: model.count_tokens(texto).total_tokens
+        orcamento_tokens = OrcamentoTokens(
+            ContadorTokens(contar_api, TOKENS_CONTAGEM),
+            TOKENS_MAXIMO_REQUISICAO,
+            TOKENS_ORCAMENTO_USUARIO,
+            TOKENS_JANELA_USUARIO
+        )
+        prefixo = orcamento_tokens.contador.contar(INSTRUCOES_DIAGNOSTICO, memorizar=True)
+        logger.info(f"Prefixo fixo do diagnóstico: {prefixo} tokens ({orcamento_tokens.contador.modo})")
+        return True
+    except Exception as e:
+        logger.error(f"Erro ao configurar contagem de tokens: {e}", exc_info=True)
+        return False
+
+# Fontes instantâneas do endpoint de métricas, rastros por update e o
+# servidor dedicado de métricas, numa porta separada da do webhook
+def configurar_metricas(abrir_servidor=True):
+    global servidor_metricas
+    tempos.registrar_coletor('envio', agendador_envios.metricas)
+    tempos.registrar_coletor('coalescencia', voos_diagnostico.estatisticas)
+    tempos.registrar_coletor('sessoes', lambda: user_state.estatisticas())
+    tempos.registrar_coletor('gemini', lambda: model.metricas() if model is not None else {})
+    tempos.registrar_coletor(
+        'cache', lambda: cache_diagnosticos.estatisticas() if cache_diagnosticos is not None else {}
+    )
+    tempos.registrar_coletor(
+        'preaquecidas', lambda: respostas_preaquecidas.estatisticas() if respostas_preaquecidas is not None else {}
+    )
+    tempos.registrar_coletor(
+        'historico', lambda: cache_historico.estatisticas() if cache_historico is not None else {}
+    )
+    tempos.registrar_coletor(
+        'escrita', lambda: escrita_manutencoes.metricas() if escrita_manutencoes is not None else {}
+    )
+    tempos.registrar_coletor(
+        'equipamentos', lambda: registro_equipamentos.metricas() if registro_equipamentos is not None else {}
+    )
+    tempos.registrar_coletor('pool', lambda: pool_atendimento.metricas() if pool_atendimento is not None else {})
+    tempos.registrar_coletor('webhook', lambda: servidor_webhook.metricas() if servidor_webhook is not None else {})
+    tempos.registrar_coletor('logs', metricas_logging)
+    tempos.registrar_coletor('tokens', lambda: orcamento_tokens.metricas())
+    try:
+        tempos.configurar_rastros(RASTROS_ARQUIVO, RASTROS_LIMIAR)
+        if METRICAS_PORTA and abrir_servidor:
+            servidor_metricas = ServidorMetricas(tempos, host=METRICAS_HOST, porta=METRICAS_PORTA)
+            servidor_metricas.iniciar()
+        return True
+    except Exception as e:
+        logger.error(f"Erro ao configurar métricas: {e}", exc_info=True)
+        return False
+
+# Carregar o índice de similaridade do disco ou construí-lo a partir do Firestore
+def configurar_indice():
+    global indice_historico
+    try:
+        indice_historico = carregar_ou_construir(
+            db, INDICE_DIRETORIO, INDICE_DIMENSAO, resolver_equipamento
+        )
+        return True
+    except Exception as e:
+        logger.error(f"Erro ao configurar índice de similaridade: {e}", exc_info=True)
+        indice_historico = None
+        return False
+
+def persistir_indice():
+    if indice_historico is None or not indice_historico.alteracoes_pendentes:
+        return
+    try:
+        indice_historico.salvar(INDICE_DIRETORIO)
+    except Exception as e:
+        logger.error(f"Erro ao persistir índice de similaridade: {e}")
+
+# O compactar_manutencoes.py reconstrói o índice em disco e avança a
+# geração; o índice em memória ainda sugere os registros apagados, então é
+# trocado pelo novo numa thread, sem segurar a busca em andamento
+def verificar_geracao_indice():
+    global indice_verificado_em
+    agora = time.monotonic()
+    if indice_historico is None or agora - indice_verificado_em < INDICE_VERIFICAR_A_CADA:
+        return
+    indice_verificado_em = agora
+    if indice_historico.desatualizado(INDICE_DIRETORIO) and trava_recarga_indice.acquire(blocking=False):
+        threading.Thread(target=recarregar_indice, name='recarga-indice', daemon=True).start()
+
+def recarregar_indice():
+    global indice_historico
+    try:
+        logger.info("Índice de similaridade reconstruído por outro processo; recarregando")
+        indice_historico = carregar_ou_construir(
+            db, INDICE_DIRETORIO, INDICE_DIMENSAO, resolver_equipamento
+        )
+    except Exception as e:
+        logger.error(f"Erro ao recarregar índice de similaridade: {e}", exc_info=True)
+    finally:
+        trava_recarga_indice.release()
+
+# Documento de 'manutencoes' com as características de busca calculadas
+# uma vez, na gravação, em vez de a cada consulta
+def montar_manutencao(equipamento, equipamento_id, problema, solucao):
+    return {
+        'equipamento': equipamento,
+        'equipamento_id': equipamento_id,
+        'problema': problema,
+        'solucao': solucao,
+        **extrair_caracteristicas(problema)
+    }
 
 # Salvar manutenção no Firestore
+@tempos.cronometrar('manutencao.salvar')
 def salvar_manutencao(equipamento, problema, solucao):
+    if escrita_manutencoes is not None:
+        return enfileirar_manutencao(equipamento, resolver_equipamento(equipamento), problema, solucao)
     try:
+        equipamento_id = resolver_equipamento(equipamento)
         manutencoes_ref = db.collection('manutencoes')
         doc_ref = manutencoes_ref.document()
+        manutencao = montar_manutencao(equipamento, equipamento_id, problema, solucao)
         doc_ref.set({
-            'equipamento': equipamento,
-            'problema': problema,
-            'solucao': solucao,
+            **manutencao,
+            'data': firestore.SERVER_TIMESTAMP
+        })
+        logger.info("Registro salvo no Firestore", extra=por_mensagem())
+        
+        indexar_manutencao(doc_ref.id, manutencao)
+        if indice_historico is not None and indice_historico.alteracoes_pendentes >= INDICE_SALVAR_A_CADA:
+            persistir_indice()
+        return True
+    except Exception as e:
+        logger.error(f"Erro ao salvar no Firestore: {e}")
+        tempos.incrementar('erros', origem='salvar_manutencao')
+        return False
+
+@tempos.cronometrar('manutencao.salvar')
+async def salvar_manutencao_async(equipamento, problema, solucao):
+    if escrita_manutencoes is not None:
+        equipamento_id = await asyncio.to_thread(resolver_equipamento, equipamento)
+        return enfileirar_manutencao(equipamento, equipamento_id, problema, solucao)
+    try:
+        equipamento_id = await asyncio.to_thread(resolver_equipamento, equipamento)
+        doc_ref = db_async.collection('manutencoes').document()
+        manutencao = montar_manutencao(equipamento, equipamento_id, problema, solucao)
+        await doc_ref.set({
+            **manutencao,
             'data': firestore.SERVER_TIMESTAMP
         })
-        logger.info("Registro salvo no Firestore")
+        logger.info("Registro salvo no Firestore", extra=por_mensagem())
+        
+        indexar_manutencao(doc_ref.id, manutencao)
+        if indice_historico is not None and indice_historico.alteracoes_pendentes >= INDICE_SALVAR_A_CADA:
+            await asyncio.to_thread(persistir_indice)
         return True
     except Exception as e:
         logger.error(f"Erro ao salvar no Firestore: {e}")
+        tempos.incrementar('erros', origem='salvar_manutencao')
+        return False
+
+# Gravação diferida: o registro vai para o diário local e o Firestore é
+# atualizado em lote; o índice já recebe o ID definitivo do documento
+def enfileirar_manutencao(equipamento, equipamento_id, problema, solucao):
+    try:
+        manutencao = montar_manutencao(equipamento, equipamento_id, problema, solucao)
+        doc_id = escrita_manutencoes.enfileirar(manutencao)
+        logger.info("Registro %s enfileirado para o Firestore", doc_id, extra=por_mensagem())
+        
+        indexar_manutencao(doc_id, manutencao)
+        if indice_historico is not None and indice_historico.alteracoes_pendentes >= INDICE_SALVAR_A_CADA:
+            # Fora da thread do atendimento: salvar a matriz do índice leva tempo
+            threading.Thread(target=persistir_indice, daemon=True).start()
+        return True
+    except Exception as e:
+        logger.error(f"Erro ao enfileirar manutenção: {e}")
         return False
 
+# Manter o índice local em dia sem precisar reconstruí-lo; o documento já
+# traz as características de busca calculadas por montar_manutencao
+def indexar_manutencao(doc_id, manutencao):
+    if indice_historico is None:
+        return
+    indice_historico.adicionar(doc_id, manutencao)
+
 # Retorna mensagem de erro se a IA falhar
 def fallback_diagnostico(equipamento, problema):
     logger.warning(f"Gerando diagnóstico de fallback para {equipamento}")
+    tempos.incrementar('diagnostico.fallbacks')
     
     return f"""
 ❌ <b>Não foi possível processar sua consulta.</b>
@@ -330,24 +704,33 @@ Tente novamente iniciando um novo atendimento com o comando:
 # Buscar soluções anteriores no Firestore
 def buscar_solucoes_anteriores(equipamento):
     try:
-        manutencoes_ref = db.collection('manutencoes')
-        query = manutencoes_ref.where('equipamento', '==', equipamento).order_by('data', direction=firestore.Query.DESCENDING).limit(5)
+        equipamento_id = resolver_equipamento(equipamento)
+        if cache_historico is not None:
+            return cache_historico.buscar(equipamento_id, equipamento)
+        query = KnowledgeBaseSolver(db).consulta_historico(equipamento_id, equipamento)
         solucoes = [doc.to_dict() for doc in query.stream()]
         return solucoes
     except Exception as e:
         logger.error(f"Erro ao buscar soluções anteriores: {e}")
         return []
 
-def buscar_solucao_ia(equipamento, problema):
-    try:
-        if not model:
-            raise ValueError("Modelo Gemini não configurado")
-        
-        prompt = f"""
-DIAGNÓSTICO TÉCNICO DE EQUIPAMENTO
+CONFIGURACAO_SEGURANCA = [
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"}
+]
 
-📍 EQUIPAMENTO: {equipamento}
-❗ PROBLEMA DESCRITO: {problema}
+CONFIGURACAO_GERACAO = {
+    "max_output_tokens": 2048,
+    "temperature": 0.7,
+    "top_p": 0.9
+}
+
+# Parte fixa do prompt de diagnóstico, enviada primeiro e sempre idêntica:
+# é contada uma vez e forma um prefixo comum a todas as chamadas
+INSTRUCOES_DIAGNOSTICO = """
+DIAGNÓSTICO TÉCNICO DE EQUIPAMENTO
 
 INSTRUÇÕES PARA DIAGNÓSTICO:
 
@@ -398,269 +781,607 @@ Detalhamento técnico...
 1. Primeiro passo de diagnóstico
 2. Segundo passo... (citar no mínimo 3)
 """
+
+def dados_diagnostico(equipamento, problema):
+    return f"""
+DADOS DO ATENDIMENTO:
+📍 EQUIPAMENTO: {equipamento}
+❗ PROBLEMA DESCRITO: {problema}
+"""
+
+def montar_prompt_diagnostico(equipamento, problema):
+    return INSTRUCOES_DIAGNOSTICO + dados_diagnostico(equipamento, problema)
+
+# Conta os tokens antes do envio e registra a entrada da etapa; um problema
+# que estoure o limite por requisição é cortado, e uma parte fixa que não
+# deixe espaço para ele recusa a requisição (LimiteRequisicaoExcedido)
+def preparar_prompt_diagnostico(equipamento, problema):
+    contador = orcamento_tokens.contador
+    fixos = contador.contar(INSTRUCOES_DIAGNOSTICO, memorizar=True) + contador.contar(
+        dados_diagnostico(equipamento, '')
+    )
+    problema, tokens = orcamento_tokens.ajustar('diagnostico', fixos, problema)
+    orcamento_tokens.registrar_entrada('diagnostico', tokens)
+    return montar_prompt_diagnostico(equipamento, problema)
+
+# No modo 'api' a contagem vai à rede: no modo assíncrono ela roda numa
+# thread para não parar o loop de eventos
+async def contar_fora_do_loop(funcao, *args):
+    if orcamento_tokens.contador.usa_api:
+        return await asyncio.to_thread(funcao, *args)
+    return funcao(*args)
+
+# Recusas não são diagnóstico: chegam ao fluxo como AtendimentoRecusado,
+# que responde ao técnico sem salvar nem mudar a etapa
+def mensagem_requisicao_excedida():
+    return """
+📏 <b>Descrição longa demais para a IA.</b>
+
+Os dados do atendimento ocupam todo o limite de uma consulta.
+Resuma o equipamento e o problema e tente novamente.
+"""
+
+def mensagem_orcamento_esgotado():
+    return """
+⏳ <b>Limite de uso da IA atingido.</b>
+
+Você atingiu a cota de consultas ao assistente para este período.
+Tente novamente mais tarde ou fale com o supervisor.
+"""
+
+# Busca do histórico, executada em paralelo com a geração do Gemini
+def buscar_historico(equipamento, problema):
+    verificar_geracao_indice()
+    with tempos.medir('diagnostico.historico'):
+        knowledge_solver = KnowledgeBaseSolver(db, indice_historico, registro_equipamentos, cache_historico)
+        return knowledge_solver.buscar_solucoes_contextualizadas(equipamento, problema)
+
+async def buscar_historico_async(equipamento, problema):
+    verificar_geracao_indice()
+    with tempos.medir('diagnostico.historico'):
+        knowledge_solver = KnowledgeBaseSolver(db_async, indice_historico, registro_equipamentos, cache_historico)
+        return await knowledge_solver.buscar_solucoes_contextualizadas_async(equipamento, problema)
+
+# O contexto copiado leva o rastro do update para a thread do histórico
+def submeter_historico(equipamento, problema):
+    return executor_historico.submit(
+        contextvars.copy_context().run, buscar_historico, equipamento, problema
+    )
+
+# Espera o histórico só até o prazo compartilhado da etapa; None indica que
+# ele não chegou a tempo e a resposta segue sem o contexto histórico
+def aguardar_historico(futuro, prazo):
+    try:
+        return futuro.result(timeout=max(0.0, prazo - time.monotonic()))
+    except FuturoTimeoutError:
+        tempos.incrementar('diagnostico.historico_fora_do_prazo')
+        logger.warning("Busca do histórico excedeu o prazo; resposta enviada sem contexto histórico")
+        return None
+
+async def aguardar_historico_async(tarefa, prazo):
+    concluidas, _ = await asyncio.wait({tarefa}, timeout=max(0.0, prazo - time.monotonic()))
+    if not concluidas:
+        tarefa.cancel()
+        tempos.incrementar('diagnostico.historico_fora_do_prazo')
+        logger.warning("Busca do histórico excedeu o prazo; resposta enviada sem contexto histórico")
+        return None
+    return tarefa.result()
+
+# Comparar diagnostico.total com diagnostico.gemini + diagnostico.historico
+# mostra quanto a execução em paralelo economiza
+def registrar_tempos_diagnostico(inicio, tempo_gemini):
+    tempos.registrar('diagnostico.total', time.monotonic() - inicio)
+    tempos.registrar('diagnostico.gemini', tempo_gemini)
+
+# Critério de resposta útil do Gemini; respostas bloqueadas lançam ValueError em .text
+def resposta_aceitavel(resposta):
+    try:
+        return bool(resposta.text) and len(resposta.text.strip()) >= 100
+    except ValueError:
+        return False
+
+@tempos.cronometrar('gemini.geracao')
+def gerar_diagnostico(equipamento, problema):
+    prompt = preparar_prompt_diagnostico(equipamento, problema)
+    if HEDGE_ATIVO:
+        return model.gerar_com_hedge(
+            prompt,
+            aceitar=resposta_aceitavel,
+            percentil=HEDGE_PERCENTIL,
+            safety_settings=CONFIGURACAO_SEGURANCA,
+            generation_config=CONFIGURACAO_GERACAO
+        )
+    return model.generate_content(
+        prompt, 
+        safety_settings=CONFIGURACAO_SEGURANCA,
+        generation_config=CONFIGURACAO_GERACAO
+    )
+
+@tempos.cronometrar('gemini.geracao')
+async def gerar_diagnostico_async(equipamento, problema):
+    prompt = await contar_fora_do_loop(preparar_prompt_diagnostico, equipamento, problema)
+    if HEDGE_ATIVO:
+        return await model.gerar_com_hedge_async(
+            prompt,
+            aceitar=resposta_aceitavel,
+            percentil=HEDGE_PERCENTIL,
+            safety_settings=CONFIGURACAO_SEGURANCA,
+            generation_config=CONFIGURACAO_GERACAO
+        )
+    return await model.generate_content_async(
+        prompt, 
+        safety_settings=CONFIGURACAO_SEGURANCA,
+        generation_config=CONFIGURACAO_GERACAO
+    )
+
+# Respostas já prontas: primeiro as pré-geradas fora do pico, depois o
+# cache dos diagnósticos recentes
+def resposta_pronta(chave_equipamento, problema):
+    if respostas_preaquecidas is not None:
+        resposta = respostas_preaquecidas.obter(chave_equipamento, problema)
+        if resposta:
+            tempos.incrementar('diagnostico.preaquecido')
+            logger.info("Diagnóstico pré-gerado servido para %s", chave_equipamento, extra=por_mensagem())
+            return resposta
+    if cache_diagnosticos is not None:
+        resposta = cache_diagnosticos.obter(chave_equipamento, problema)
+        if resposta:
+            logger.info("Diagnóstico servido do cache para %s", chave_equipamento, extra=por_mensagem())
+            return resposta
+    return None
+
+def buscar_solucao_ia(equipamento, problema):
+    try:
+        if not model:
+            raise ValueError("Modelo Gemini não configurado")
+        
+        # Mesmo equipamento e sintoma pré-gerado ou diagnosticado há pouco
+        chave_equipamento = resolver_equipamento(equipamento) or equipamento
+        resposta_cache = resposta_pronta(chave_equipamento, problema)
+        if resposta_cache:
+            return resposta_cache
+        
+        # Geração e histórico são independentes: rodam juntos sob o mesmo prazo
+        inicio = time.monotonic()
+        prazo = inicio + DIAGNOSTICO_PRAZO
+        futuro_historico = submeter_historico(equipamento, problema)
         
-        resposta = model.generate_content(
-            prompt, 
-            safety_settings=[
-                {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"}
-            ],
-            generation_config={
-                "max_output_tokens": 2048,
-                "temperature": 0.7,
-                "top_p": 0.9
-            }
+        resposta = gerar_diagnostico(equipamento, problema)
+        tempo_gemini = time.monotonic() - inicio
+        
+        if not resposta_aceitavel(resposta):
+            logger.warning("Resposta do Gemini muito curta ou vazia")
+            return fallback_diagnostico(equipamento, problema)
+        orcamento_tokens.registrar_saida('diagnostico', resposta.text, resposta)
+        
+        solucoes_historicas = aguardar_historico(futuro_historico, prazo)
+        registrar_tempos_diagnostico(inicio, tempo_gemini)
+        return finalizar_diagnostico(
+            equipamento, problema, chave_equipamento, resposta.text, solucoes_historicas
         )
+    
+    except LimiteRequisicaoExcedido:
+        raise AtendimentoRecusado(mensagem_requisicao_excedida())
+    
+    except Exception as e:
+        logger.error(f"Erro na consulta de IA: {e}", exc_info=True)
+        return fallback_diagnostico(equipamento, problema)
+
+# Adicionar contexto histórico, formatar e guardar no cache. Respostas que
+# ficaram sem histórico (fora do prazo) não vão para o cache.
+def finalizar_diagnostico(equipamento, problema, chave_equipamento, texto_ia, solucoes_historicas):
+    knowledge_solver = KnowledgeBaseSolver(db, indice_historico, registro_equipamentos)
+    solucao_contextualizada = knowledge_solver.enriquecer_diagnostico(
+        texto_ia, solucoes_historicas or []
+    )
+    
+    texto_resposta = sanitizar_html(solucao_contextualizada)
+    
+    if cache_diagnosticos is not None and solucoes_historicas is not None:
+        cache_diagnosticos.armazenar(chave_equipamento, problema, texto_resposta)
+    
+    logger.info("Resposta do Gemini recebida com sucesso", extra=por_mensagem())
+    return texto_resposta
+
+# Variante com stream=True: ao_receber é chamado com o texto acumulado a cada trecho
+def buscar_solucao_ia_streaming(equipamento, problema, ao_receber):
+    try:
+        if not model:
+            raise ValueError("Modelo Gemini não configurado")
+        
+        chave_equipamento = resolver_equipamento(equipamento) or equipamento
+        resposta_cache = resposta_pronta(chave_equipamento, problema)
+        if resposta_cache:
+            return resposta_cache
+        
+        inicio = time.monotonic()
+        prazo = inicio + DIAGNOSTICO_PRAZO
+        futuro_historico = submeter_historico(equipamento, problema)
+        
+        with tempos.medir('gemini.geracao'):
+            resposta = model.generate_content(
+                preparar_prompt_diagnostico(equipamento, problema), 
+                safety_settings=CONFIGURACAO_SEGURANCA,
+                generation_config=CONFIGURACAO_GERACAO,
+                stream=True
+            )
+            
+            texto_ia = ''
+            for parte in resposta:
+                texto_ia += parte.text
+                ao_receber(texto_ia)
+        tempo_gemini = time.monotonic() - inicio
+        orcamento_tokens.registrar_saida('diagnostico', texto_ia)
         
-        if not resposta.text or len(resposta.text.strip()) < 100:
+        if len(texto_ia.strip()) < 100:
             logger.warning("Resposta do Gemini muito curta ou vazia")
             return fallback_diagnostico(equipamento, problema)
         
-        # Adicionar contexto histórico
-        knowledge_solver = KnowledgeBaseSolver(db)
-        solucoes_historicas = knowledge_solver.buscar_solucoes_contextualizadas(
-            equipamento, problema
+        solucoes_historicas = aguardar_historico(futuro_historico, prazo)
+        registrar_tempos_diagnostico(inicio, tempo_gemini)
+        return finalizar_diagnostico(
+            equipamento, problema, chave_equipamento, texto_ia, solucoes_historicas
         )
+    
+    except LimiteRequisicaoExcedido:
+        raise AtendimentoRecusado(mensagem_requisicao_excedida())
+    
+    except Exception as e:
+        logger.error(f"Erro na consulta de IA: {e}", exc_info=True)
+        return fallback_diagnostico(equipamento, problema)
+
+async def buscar_solucao_ia_streaming_async(equipamento, problema, ao_receber):
+    tarefa_historico = None
+    try:
+        if not model:
+            raise ValueError("Modelo Gemini não configurado")
+        
+        chave_equipamento = await asyncio.to_thread(resolver_equipamento, equipamento) or equipamento
+        resposta_cache = resposta_pronta(chave_equipamento, problema)
+        if resposta_cache:
+            return resposta_cache
+        
+        inicio = time.monotonic()
+        prazo = inicio + DIAGNOSTICO_PRAZO
+        tarefa_historico = asyncio.create_task(buscar_historico_async(equipamento, problema))
+        
+        with tempos.medir('gemini.geracao'):
+            resposta = await model.generate_content_async(
+                await contar_fora_do_loop(preparar_prompt_diagnostico, equipamento, problema), 
+                safety_settings=CONFIGURACAO_SEGURANCA,
+                generation_config=CONFIGURACAO_GERACAO,
+                stream=True
+            )
+            
+            texto_ia = ''
+            async for parte in resposta:
+                texto_ia += parte.text
+                await ao_receber(texto_ia)
+        tempo_gemini = time.monotonic() - inicio
+        orcamento_tokens.registrar_saida('diagnostico', texto_ia)
         
-        solucao_contextualizada = knowledge_solver.enriquecer_diagnostico(
-            resposta.text, solucoes_historicas
+        if len(texto_ia.strip()) < 100:
+            logger.warning("Resposta do Gemini muito curta ou vazia")
+            return fallback_diagnostico(equipamento, problema)
+        
+        solucoes_historicas = await aguardar_historico_async(tarefa_historico, prazo)
+        registrar_tempos_diagnostico(inicio, tempo_gemini)
+        return finalizar_diagnostico(
+            equipamento, problema, chave_equipamento, texto_ia, solucoes_historicas
         )
+    
+    except LimiteRequisicaoExcedido:
+        raise AtendimentoRecusado(mensagem_requisicao_excedida())
+    
+    except Exception as e:
+        logger.error(f"Erro na consulta de IA: {e}", exc_info=True)
+        return fallback_diagnostico(equipamento, problema)
+    
+    finally:
+        if tarefa_historico is not None and not tarefa_historico.done():
+            tarefa_historico.cancel()
+
+async def buscar_solucao_ia_async(equipamento, problema):
+    tarefa_historico = None
+    try:
+        if not model:
+            raise ValueError("Modelo Gemini não configurado")
+        
+        chave_equipamento = await asyncio.to_thread(resolver_equipamento, equipamento) or equipamento
+        resposta_cache = resposta_pronta(chave_equipamento, problema)
+        if resposta_cache:
+            return resposta_cache
+        
+        inicio = time.monotonic()
+        prazo = inicio + DIAGNOSTICO_PRAZO
+        tarefa_historico = asyncio.create_task(buscar_historico_async(equipamento, problema))
         
-        texto_resposta = sanitizar_html(solucao_contextualizada)
+        resposta = await gerar_diagnostico_async(equipamento, problema)
+        tempo_gemini = time.monotonic() - inicio
+        
+        if not resposta_aceitavel(resposta):
+            logger.warning("Resposta do Gemini muito curta ou vazia")
+            return fallback_diagnostico(equipamento, problema)
+        orcamento_tokens.registrar_saida('diagnostico', resposta.text, resposta)
         
-        logger.info("Resposta do Gemini recebida com sucesso")
-        return texto_resposta
+        solucoes_historicas = await aguardar_historico_async(tarefa_historico, prazo)
+        registrar_tempos_diagnostico(inicio, tempo_gemini)
+        return finalizar_diagnostico(
+            equipamento, problema, chave_equipamento, resposta.text, solucoes_historicas
+        )
+    
+    except LimiteRequisicaoExcedido:
+        raise AtendimentoRecusado(mensagem_requisicao_excedida())
     
     except Exception as e:
         logger.error(f"Erro na consulta de IA: {e}", exc_info=True)
         return fallback_diagnostico(equipamento, problema)
+    
+    finally:
+        if tarefa_historico is not None and not tarefa_historico.done():
+            tarefa_historico.cancel()
 
-# Telegram Bot - Configuração
-bot = telebot.TeleBot(TELEGRAM_BOT_TOKEN, parse_mode='HTML')
+# Single-flight na frente do diagnóstico: técnicos que descrevem o mesmo
+# problema no mesmo equipamento ao mesmo tempo recebem o resultado de uma
+# única consulta ao Gemini e ao histórico
+def chave_diagnostico(equipamento, problema):
+    return chave_coalescencia(resolver_equipamento(equipamento) or equipamento, problema)
 
-@bot.message_handler(commands=['start'])
-def mensagem_inicial(message):
-    logger.info(f"Comando /start recebido de {message.from_user.username}")
-    
-    # Resetar o estado do usuário
-    user_state[message.from_user.id] = {'stage': 'intro'}
-    
-    bot.reply_to(message, 
-        "🚧 Assistente Técnico de Manutenção 🚧\n\n"
-        "Vamos começar: Por favor, informe detalhes do equipamento:\n"
-        "• Marca\n"
-        "• Modelo\n"
-        "• Versão/Ano\n\n"
-        "Exemplo: Transpaleteira elétrica Linde T20 SP - 2022"
+# O orçamento de tokens é consultado antes da coalescência: quem entra no
+# voo de outro técnico não herda o limite dele
+def diagnosticar(equipamento, problema, funcao=None, *args):
+    if not orcamento_tokens.disponivel():
+        raise AtendimentoRecusado(mensagem_orcamento_esgotado())
+    return voos_diagnostico.executar(
+        chave_diagnostico(equipamento, problema),
+        funcao or buscar_solucao_ia, equipamento, problema, *args
     )
 
-@bot.message_handler(func=lambda message: True)
-def handle_message(message):
-    user_id = message.from_user.id
-    
-    # Adicionar log para debug
-    logger.info(f"Mensagem recebida. User ID: {user_id}, Stage: {user_state.get(user_id, {}).get('stage', 'Não definido')}")
-    
-    # Se o usuário não tiver estado definido, inicializar
-    if user_id not in user_state:
-        user_state[user_id] = {'stage': 'intro'}
+async def diagnosticar_async(equipamento, problema, funcao=None, *args):
+    if not orcamento_tokens.disponivel():
+        raise AtendimentoRecusado(mensagem_orcamento_esgotado())
+    chave = chave_coalescencia(
+        await asyncio.to_thread(resolver_equipamento, equipamento) or equipamento, problema
+    )
+    return await voos_diagnostico.executar_async(
+        chave, funcao or buscar_solucao_ia_async, equipamento, problema, *args
+    )
+
+# Refinamento em conversa (refinamento.py): o Gemini recebe o histórico
+# compacto da conversa e a informação nova, sem o modelo de diagnóstico
+def conteudos_refinamento(acao):
+    contador = orcamento_tokens.contador
+    conteudos = montar_conteudos(acao.conversa, acao.informacao, REFINAMENTO_ORCAMENTO_TOKENS)
+    fixos = sum(contador.contar(parte) for conteudo in conteudos[:-1] for parte in conteudo['parts'])
+    ultima, enviados = orcamento_tokens.ajustar('refinamento', fixos, conteudos[-1]['parts'][0])
+    conteudos[-1] = {'role': 'user', 'parts': [ultima]}
+    orcamento_tokens.registrar_entrada('refinamento', enviados)
     
+    # Comparação com o prompt aninhado que o modo anterior enviaria nesta rodada
+    sem_conversa = contador.estimar(montar_prompt_diagnostico(
+        acao.equipamento, prompt_refinamento(acao.equipamento, acao.problema, acao.informacao)
+    ))
+    tempos.incrementar('refinamento.rodadas')
+    tempos.incrementar('refinamento.tokens_entrada', enviados)
+    tempos.incrementar('refinamento.tokens_sem_conversa', sem_conversa)
+    logger.info(
+        "Refinamento: ~%d tokens de entrada, ~%d no prompt aninhado (economia ~%d)",
+        enviados, sem_conversa, sem_conversa - enviados, extra=por_mensagem()
+    )
+    return conteudos
+
+def concluir_refinamento(acao, texto_ia, resposta=None):
+    orcamento_tokens.registrar_saida('refinamento', texto_ia, resposta)
+    if len(texto_ia.strip()) < 100:
+        logger.warning("Resposta do Gemini muito curta ou vazia")
+        return fallback_diagnostico(acao.equipamento, acao.problema)
+    return sanitizar_html(texto_ia)
+
+# ao_receber presente: stream=True, chamado com o texto acumulado a cada trecho
+def refinar_solucao_ia(acao, ao_receber=None):
+    if not orcamento_tokens.disponivel():
+        raise AtendimentoRecusado(mensagem_orcamento_esgotado())
     try:
-        current_stage = user_state[user_id].get('stage', 'intro')
-        
-        if current_stage == 'intro':
-            # Capturar informações do equipamento
-            equipamento = message.text.strip()
-            
-            # Validar se a mensagem não está vazia
-            if not equipamento:
-                bot.reply_to(message, "❌ Por favor, informe os detalhes do equipamento.")
-                return
-            
-            # Log de debug
-            logger.info(f"Equipamento capturado: {equipamento}")
-            
-            # Salvar informações do equipamento e mudar para próximo estágio
-            user_state[user_id] = {
-                'stage': 'problem_description',
-                'equipamento': equipamento
-            }
-            
-            # Solicitar descrição do problema
-            bot.reply_to(message, 
-                f"✅ Equipamento registrado: <b>{equipamento}</b>\n\n"
-                "Agora, descreva detalhadamente o problema que você está enfrentando. "
-                "Seja o mais específico possível sobre os sintomas, comportamentos incomuns, "
-                "sons, ou qualquer outra observação relevante."
-            )
+        if not model:
+            raise ValueError("Modelo Gemini não configurado")
         
-        elif current_stage == 'problem_description':
-            # Capturar descrição do problema
-            problema = message.text.strip()
-            
-            # Validar se a descrição não está vazia
-            if not problema:
-                bot.reply_to(message, "❌ Por favor, descreva o problema em detalhes.")
-                return
-            
-            # Log de debug
-            logger.info(f"Problema capturado: {problema}")
-            
-            # Buscar solução via IA
-            equipamento = user_state[user_id]['equipamento']
-            solucao = buscar_solucao_ia(equipamento, problema)
-            
-            # Dividir mensagem
-            mensagens = dividir_mensagem(solucao)
-            
-            # Criar primeira mensagem com cabeçalho
-            primeira_mensagem = f"🔧 Diagnóstico para {equipamento}"
-            
-            # Enviar primeira mensagem (cabeçalho + primeiro conteúdo)
-            if mensagens:
-                bot.reply_to(message, f"{primeira_mensagem}\n\n{mensagens[0]}")
-            
-            # Enviar mensagens subsequentes
-            for msg_adicional in mensagens[1:]:
-                bot.send_message(message.chat.id, msg_adicional)
-            
-            # Solicitar feedback
-            user_state[user_id] = {
-                'stage': 'feedback',
-                'equipamento': equipamento,
-                'problema': problema,
-                'solucao': solucao  # Manter solução atual
-            }
-            
-            bot.send_message(message.chat.id, 
-                "A solução foi útil?\n"
-                "Responda:\n"
-                "✅ SIM - se a solução resolveu o problema\n"
-                "❌ NÃO - se precisou de outras ações"
+        conteudos = conteudos_refinamento(acao)
+        with tempos.medir('gemini.refinamento'):
+            resposta = model.generate_content(
+                conteudos,
+                safety_settings=CONFIGURACAO_SEGURANCA,
+                generation_config=CONFIGURACAO_GERACAO,
+                stream=ao_receber is not None
             )
-        
-        elif current_stage == 'feedback':
-            feedback = message.text.strip().lower()
-            
-            if feedback in ['✅', 'sim']:
-                # Aqui salva no Firestore somente com feedback positivo
-                solucao = user_state[user_id]['solucao']
-                equipamento = user_state[user_id]['equipamento']
-                problema = user_state[user_id]['problema']
-                
-                salvar_manutencao(equipamento, problema, solucao)
-                
-                bot.reply_to(message, 
-                    "Ótimo! Fico feliz em ter ajudado. 👍\n"
-                    "Solução salva para futuras consultas.\n"
-                    "Se precisar de mais alguma coisa, use /start."
-                )
-                # Resetar estado
-                user_state[user_id] = {'stage': 'intro'}
-            
-            elif feedback in ['❌', 'não']:
-                bot.reply_to(message, 
-                    "Peço desculpas que a solução não foi completamente efetiva. 🤔\n"
-                    "Por favor, descreva:\n"
-                    "1. Qual era o DEFEITO ESPECÍFICO?\n"
-                    "2. Qual SOLUÇÃO VOCÊ ENCONTROU?"
-                )
-                # Preparar para registrar informação adicional
-                user_state[user_id]['stage'] = 'solution_refinement'
-            
+            if ao_receber is None:
+                texto_ia = resposta.text if resposta_aceitavel(resposta) else ''
             else:
-                bot.reply_to(message, 
-                    "Desculpe, não entendi sua resposta. 🤨\n"
-                    "Por favor, responda com ✅ SIM ou ❌ NÃO"
-                )
-        
-        elif current_stage == 'solution_refinement':
-            # Processar texto com detalhes da solução refinada
-            informacao_adicional = message.text.strip()
-            
-            # Tentar gerar nova solução com informações adicionais
-            try:
-                equipamento = user_state[user_id]['equipamento']
-                problema_original = user_state[user_id]['problema']
-                
-                # Prompt para refinar a solução
-                prompt_refinamento = f"""
-CONTEXTO ANTERIOR:
-Equipamento: {equipamento}
-Problema Original: {problema_original}
-
-NOVA INFORMAÇÃO DO TÉCNICO:
-{informacao_adicional}
-
-Por favor, gere uma solução técnica ATUALIZADA e MAIS ESPECÍFICA considerando 
-as novas informações fornecidas.
-"""
-                
-                # Gerar solução refinada
-                solucao_refinada = buscar_solucao_ia(equipamento, prompt_refinamento)
-                
-                # Salvar solução refinada no Firestore
-                salvar_manutencao(equipamento, problema_original, solucao_refinada)
-                
-                # Dividir mensagem refinada
-                mensagens_refinadas = dividir_mensagem(solucao_refinada)
-                
-                # Enviar mensagens
-                bot.reply_to(message, "🔍 Solução Refinada:")
-                for msg in mensagens_refinadas:
-                    bot.send_message(message.chat.id, msg)
-                
-                bot.send_message(message.chat.id, 
-                    "Esta solução atende suas necessidades?\n"
-                    "✅ SIM - solução satisfatória\n"
-                    "❌ NÃO - precisamos revisar novamente"
-                )
-                
-                # Atualizar estado
-                user_state[user_id] = {
-                    'stage': 'feedback_refinado',
-                    'equipamento': equipamento,
-                    'problema': problema_original,
-                    'solucao': solucao_refinada
-                }
-            
-            except Exception as e:
-                logger.error(f"Erro no refinamento da solução: {e}")
-                bot.reply_to(message, "Desculpe, não foi possível refinar a solução no momento.")
-                user_state[user_id] = {'stage': 'intro'}
+                texto_ia = ''
+                for parte in resposta:
+                    texto_ia += parte.text
+                    ao_receber(texto_ia)
+        return concluir_refinamento(acao, texto_ia, resposta if ao_receber is None else None)
+    
+    except LimiteRequisicaoExcedido:
+        raise AtendimentoRecusado(mensagem_requisicao_excedida())
+    
+    except Exception as e:
+        logger.error(f"Erro no refinamento via Gemini: {e}", exc_info=True)
+        return fallback_diagnostico(acao.equipamento, acao.problema)
+
+async def refinar_solucao_ia_async(acao, ao_receber=None):
+    if not orcamento_tokens.disponivel():
+        raise AtendimentoRecusado(mensagem_orcamento_esgotado())
+    try:
+        if not model:
+            raise ValueError("Modelo Gemini não configurado")
         
-        elif current_stage == 'feedback_refinado':
-            feedback = message.text.strip().lower()
-            
-            if feedback in ['✅', 'sim']:
-                bot.reply_to(message, 
-                    "Ótimo! Solução refinada salva. 👍\n"
-                    "Se precisar de mais alguma coisa, use /start."
-                )
-                # Resetar estado
-                user_state[user_id] = {'stage': 'intro'}
-            
-            elif feedback in ['❌', 'não']:
-                bot.reply_to(message, 
-                    "Entendi que a solução ainda não atende completamente. 🤔\n"
-                    "Por favor, descreva novamente o problema específico."
-                )
-                # Voltar para refinamento
-                user_state[user_id]['stage'] = 'solution_refinement'
-            
+        conteudos = await contar_fora_do_loop(conteudos_refinamento, acao)
+        with tempos.medir('gemini.refinamento'):
+            resposta = await model.generate_content_async(
+                conteudos,
+                safety_settings=CONFIGURACAO_SEGURANCA,
+                generation_config=CONFIGURACAO_GERACAO,
+                stream=ao_receber is not None
+            )
+            if ao_receber is None:
+                texto_ia = resposta.text if resposta_aceitavel(resposta) else ''
             else:
-                bot.reply_to(message, 
-                    "Desculpe, não entendi sua resposta. 🤨\n"
-                    "Por favor, responda com ✅ SIM ou ❌ NÃO"
-                )
+                texto_ia = ''
+                async for parte in resposta:
+                    texto_ia += parte.text
+                    await ao_receber(texto_ia)
+        return concluir_refinamento(acao, texto_ia, resposta if ao_receber is None else None)
+    
+    except LimiteRequisicaoExcedido:
+        raise AtendimentoRecusado(mensagem_requisicao_excedida())
     
     except Exception as e:
-        logger.error(f"Erro detalhado ao processar: {e}", exc_info=True)
-        bot.reply_to(message, f"Desculpe, ocorreu um erro: {str(e)}")
-        # Resetar estado em caso de erro
-        user_state[user_id] = {'stage': 'intro'}
+        logger.error(f"Erro no refinamento via Gemini: {e}", exc_info=True)
+        return fallback_diagnostico(acao.equipamento, acao.problema)
+
+# Telegram Bot - Configuração
+# Com o pool ativo, o telebot só despacha; o processamento fica nos workers
+bot = telebot.TeleBot(TELEGRAM_BOT_TOKEN, parse_mode='HTML', threaded=POOL_WORKERS == 0)
+
+def despachar_por_usuario(handler):
+    @functools.wraps(handler)
+    def despachar(message):
+        if pool_atendimento is None:
+            return handler(message)
+        pool_atendimento.submeter(message.from_user.id, handler, message)
+    return despachar
+
+# Executa as ações pedidas pelo fluxo de atendimento (modo síncrono)
+def executar_acao(message, acao):
+    if isinstance(acao, Responder):
+        return agendador_envios.executar(message.chat.id, bot.reply_to, message, acao.texto)
+    if isinstance(acao, Enviar):
+        return agendador_envios.executar(message.chat.id, bot.send_message, message.chat.id, acao.texto)
+    if isinstance(acao, Diagnosticar):
+        return diagnosticar(acao.equipamento, acao.problema)
+    if isinstance(acao, Salvar):
+        return salvar_manutencao(acao.equipamento, acao.problema, acao.solucao)
+    if isinstance(acao, TransmitirDiagnostico):
+        return transmitir_diagnostico(message, acao)
+    if isinstance(acao, Refinar):
+        if not acao.transmitir:
+            return refinar_solucao_ia(acao)
+        return transmitir_diagnostico(
+            message, TransmitirDiagnostico(acao.equipamento, acao.problema, None, responder=False),
+            lambda ao_receber: refinar_solucao_ia(acao, ao_receber)
+        )
+    raise ValueError(f"Ação desconhecida: {acao!r}")
+
+# Envia/edita as mensagens planejadas. Edições intermediárias são descartadas
+# em caso de 429; envios e a versão final aguardam o retry_after do Telegram
+def executar_operacoes(message, acao, plano, operacoes, final=False):
+    chat_id = message.chat.id
+    for operacao in operacoes:
+        tipo, indice, texto = operacao
+        while True:
+            try:
+                if tipo == 'enviar':
+                    if indice == 0 and acao.responder:
+                        enviada = agendador_envios.executar(chat_id, bot.reply_to, message, texto)
+                    else:
+                        enviada = agendador_envios.executar(chat_id, bot.send_message, chat_id, texto)
+                    plano.registrar(operacao, enviada.message_id)
+                elif tipo == 'editar':
+                    agendador_envios.executar(
+                        chat_id, bot.edit_message_text, texto, chat_id, plano.ids[indice],
+                        repetir_429=final
+                    )
+                    plano.registrar(operacao)
+                else:
+                    agendador_envios.executar(chat_id, bot.delete_message, chat_id, plano.ids[indice])
+                break
+            except telebot.apihelper.ApiTelegramException as e:
+                if edicao_sem_alteracao(e):
+                    plano.registrar(operacao)
+                    break
+                espera = tempo_espera_telegram(e)
+                # Atualizações intermediárias podem ser puladas: a próxima refaz o estado
+                if espera is None and not final:
+                    logger.warning(f"Falha ao atualizar transmissão: {e}")
+                    return
+                if espera is None:
+                    raise
+                plano.adiar(espera, time.monotonic())
+                if tipo == 'editar' and not final:
+                    return
+                time.sleep(espera)
+
+# gerar substitui o diagnóstico coalescido (ex.: rodada de refinamento)
+def transmitir_diagnostico(message, acao, gerar=None):
+    plano = PlanoTransmissao(acao.cabecalho, intervalo=STREAMING_INTERVALO_EDICAO)
+    executar_operacoes(message, acao, plano, plano.inicio(), final=True)
+    
+    def ao_receber(texto_parcial):
+        executar_operacoes(message, acao, plano, plano.progresso(texto_parcial, time.monotonic()))
+    
+    # Quem entra num diagnóstico já em andamento fica com o aviso de espera
+    # até a versão final, sem as edições parciais do líder
+    try:
+        if gerar is not None:
+            solucao = gerar(ao_receber)
+        else:
+            solucao = diagnosticar(acao.equipamento, acao.problema, buscar_solucao_ia_streaming, ao_receber)
+    except AtendimentoRecusado as recusa:
+        # A recusa ocupa o lugar do aviso de espera; o fluxo não a reenvia
+        executar_operacoes(message, acao, plano, plano.final(dividir_mensagem(recusa.mensagem)), final=True)
+        raise AtendimentoRecusado(recusa.mensagem, entregue=True) from recusa
+    executar_operacoes(message, acao, plano, plano.final(dividir_mensagem(solucao)), final=True)
+    logger.info(
+        "Diagnóstico transmitido com %d edições em %d mensagens", plano.edicoes, len(plano.ids),
+        extra=por_mensagem(message.from_user.id)
+    )
+    return solucao
+
+def etapa_atual(user_id):
+    return user_state.get(user_id, {}).get('stage', 'intro')
+
+# Abre o rastro do update (os spans medidos durante o processamento entram
+# nele) e conta a transição de etapa que a mensagem provocou
+@contextmanager
+def rastrear_update(message):
+    user_id = message.from_user.id
+    etapa = etapa_atual(user_id)
+    with tempos.rastrear('update', user_id=user_id, etapa=etapa, message_id=message.message_id), \
+            orcamento_tokens.usuario(user_id):
+        yield
+    tempos.incrementar('atendimento.transicoes', de=etapa, para=etapa_atual(user_id))
+
+def executar_fluxo(message, fluxo):
+    with rastrear_update(message):
+        resultado, erro = None, None
+        while True:
+            try:
+                # Falhas do executor são devolvidas ao fluxo, que decide como reagir
+                acao = fluxo.throw(erro) if erro is not None else fluxo.send(resultado)
+            except StopIteration:
+                return
+            try:
+                resultado, erro = executar_acao(message, acao), None
+            except AtendimentoRecusado as e:
+                resultado, erro = None, e
+            except Exception as e:
+                tempos.incrementar('erros', origem=type(acao).__name__)
+                resultado, erro = None, e
+
+@bot.message_handler(commands=['start'])
+@despachar_por_usuario
+def mensagem_inicial(message):
+    executar_fluxo(message, iniciar_atendimento(
+        user_state, message.from_user.id, message.from_user.username
+    ))
+
+@bot.message_handler(func=lambda message: True)
+@despachar_por_usuario
+def handle_message(message):
+    executar_fluxo(message, conduzir_atendimento(
+        user_state, message.from_user.id, message.text, STREAMING_ATIVO, REFINAMENTO_CHAT
+    ))
 
 def start_bot():
     tentativas = 0
@@ -694,6 +1415,215 @@ def start_bot():
         logger.critical("Falha ao iniciar o bot após múltiplas tentativas")
         sys.exit(1)
 
+def processar_update_webhook(dados):
+    bot.process_new_updates([telebot.types.Update.de_json(dados)])
+
+# Recebe updates por webhook em vez de long polling: sem conexão presa
+# e sem o conflito 409 entre a instância antiga e a nova num redeploy
+def start_bot_webhook():
+    global servidor_webhook
+    servidor_webhook = servidor = ServidorWebhook(
+        processar_update_webhook,
+        caminho=WEBHOOK_CAMINHO,
+        porta=WEBHOOK_PORTA,
+        token_secreto=WEBHOOK_SEGREDO,
+        capacidade_fila=WEBHOOK_CAPACIDADE_FILA,
+        num_consumidores=WEBHOOK_CONSUMIDORES
+    )
+    
+    bot.set_webhook(
+        url=WEBHOOK_URL.rstrip('/') + WEBHOOK_CAMINHO,
+        secret_token=WEBHOOK_SEGREDO,
+        max_connections=WEBHOOK_MAX_CONEXOES
+    )
+    logger.info(f"Webhook registrado em {WEBHOOK_URL.rstrip('/')}{WEBHOOK_CAMINHO}")
+    
+    servidor.iniciar()
+    try:
+        servidor.servir()
+    finally:
+        servidor.encerrar()
+        logger.info(f"Métricas do webhook: {servidor.metricas()}")
+
+# Executa as ações pedidas pelo fluxo de atendimento (modo assíncrono)
+async def executar_acao_async(message, acao):
+    if isinstance(acao, Responder):
+        return await agendador_envios.executar_async(
+            message.chat.id, bot_assincrono.reply_to, message, acao.texto
+        )
+    if isinstance(acao, Enviar):
+        return await agendador_envios.executar_async(
+            message.chat.id, bot_assincrono.send_message, message.chat.id, acao.texto
+        )
+    if isinstance(acao, Diagnosticar):
+        return await diagnosticar_async(acao.equipamento, acao.problema)
+    if isinstance(acao, Salvar):
+        return await salvar_manutencao_async(acao.equipamento, acao.problema, acao.solucao)
+    if isinstance(acao, TransmitirDiagnostico):
+        return await transmitir_diagnostico_async(message, acao)
+    if isinstance(acao, Refinar):
+        if not acao.transmitir:
+            return await refinar_solucao_ia_async(acao)
+        return await transmitir_diagnostico_async(
+            message, TransmitirDiagnostico(acao.equipamento, acao.problema, None, responder=False),
+            lambda ao_receber: refinar_solucao_ia_async(acao, ao_receber)
+        )
+    raise ValueError(f"Ação desconhecida: {acao!r}")
+
+async def executar_operacoes_async(message, acao, plano, operacoes, final=False):
+    from telebot.asyncio_helper import ApiTelegramException
+    
+    chat_id = message.chat.id
+    for operacao in operacoes:
+        tipo, indice, texto = operacao
+        while True:
+            try:
+                if tipo == 'enviar':
+                    if indice == 0 and acao.responder:
+                        enviada = await agendador_envios.executar_async(
+                            chat_id, bot_assincrono.reply_to, message, texto
+                        )
+                    else:
+                        enviada = await agendador_envios.executar_async(
+                            chat_id, bot_assincrono.send_message, chat_id, texto
+                        )
+                    plano.registrar(operacao, enviada.message_id)
+                elif tipo == 'editar':
+                    await agendador_envios.executar_async(
+                        chat_id, bot_assincrono.edit_message_text, texto, chat_id, plano.ids[indice],
+                        repetir_429=final
+                    )
+                    plano.registrar(operacao)
+                else:
+                    await agendador_envios.executar_async(
+                        chat_id, bot_assincrono.delete_message, chat_id, plano.ids[indice]
+                    )
+                break
+            except ApiTelegramException as e:
+                if edicao_sem_alteracao(e):
+                    plano.registrar(operacao)
+                    break
+                espera = tempo_espera_telegram(e)
+                # Atualizações intermediárias podem ser puladas: a próxima refaz o estado
+                if espera is None and not final:
+                    logger.warning(f"Falha ao atualizar transmissão: {e}")
+                    return
+                if espera is None:
+                    raise
+                plano.adiar(espera, time.monotonic())
+                if tipo == 'editar' and not final:
+                    return
+                await asyncio.sleep(espera)
+
+async def transmitir_diagnostico_async(message, acao, gerar=None):
+    plano = PlanoTransmissao(acao.cabecalho, intervalo=STREAMING_INTERVALO_EDICAO)
+    await executar_operacoes_async(message, acao, plano, plano.inicio(), final=True)
+    
+    async def ao_receber(texto_parcial):
+        await executar_operacoes_async(
+            message, acao, plano, plano.progresso(texto_parcial, time.monotonic())
+        )
+    
+    try:
+        if gerar is not None:
+            solucao = await gerar(ao_receber)
+        else:
+            solucao = await diagnosticar_async(
+                acao.equipamento, acao.problema, buscar_solucao_ia_streaming_async, ao_receber
+            )
+    except AtendimentoRecusado as recusa:
+        await executar_operacoes_async(
+            message, acao, plano, plano.final(dividir_mensagem(recusa.mensagem)), final=True
+        )
+        raise AtendimentoRecusado(recusa.mensagem, entregue=True) from recusa
+    await executar_operacoes_async(
+        message, acao, plano, plano.final(dividir_mensagem(solucao)), final=True
+    )
+    logger.info(
+        "Diagnóstico transmitido com %d edições em %d mensagens", plano.edicoes, len(plano.ids),
+        extra=por_mensagem(message.from_user.id)
+    )
+    return solucao
+
+async def executar_fluxo_async(message, fluxo):
+    # Mensagens do mesmo usuário continuam em ordem, como no pool do modo síncrono
+    trava = travas_usuarios.setdefault(message.from_user.id, asyncio.Lock())
+    async with trava:
+        with rastrear_update(message):
+            resultado, erro = None, None
+            while True:
+                try:
+                    acao = fluxo.throw(erro) if erro is not None else fluxo.send(resultado)
+                except StopIteration:
+                    return
+                try:
+                    resultado, erro = await executar_acao_async(message, acao), None
+                except AtendimentoRecusado as e:
+                    resultado, erro = None, e
+                except Exception as e:
+                    tempos.incrementar('erros', origem=type(acao).__name__)
+                    resultado, erro = None, e
+
+async def mensagem_inicial_async(message):
+    await executar_fluxo_async(message, iniciar_atendimento(
+        user_state, message.from_user.id, message.from_user.username
+    ))
+
+async def handle_message_async(message):
+    await executar_fluxo_async(message, conduzir_atendimento(
+        user_state, message.from_user.id, message.text, STREAMING_ATIVO, REFINAMENTO_CHAT
+    ))
+
+async def start_bot_async():
+    global bot_assincrono
+    # Importado aqui para que o modo síncrono não dependa do aiohttp
+    from telebot.async_telebot import AsyncTeleBot
+    
+    bot_assincrono = AsyncTeleBot(TELEGRAM_BOT_TOKEN, parse_mode='HTML')
+    bot_assincrono.register_message_handler(mensagem_inicial_async, commands=['start'])
+    bot_assincrono.register_message_handler(handle_message_async, func=lambda message: True)
+    
+    await bot_assincrono.delete_webhook()
+    await bot_assincrono.infinity_polling(
+        timeout=90,
+        request_timeout=90,
+        skip_pending=True  # Ignorar updates pendentes
+    )
+
+def encerrar_servicos():
+    if pool_atendimento is not None:
+        pool_atendimento.encerrar()
+        logger.info(f"Métricas do pool de atendimento: {pool_atendimento.metricas()}")
+    if escrita_manutencoes is not None:
+        escrita_manutencoes.encerrar()
+        logger.info(f"Métricas da escrita diferida: {escrita_manutencoes.metricas()}")
+    if registro_equipamentos is not None:
+        registro_equipamentos.encerrar()
+        logger.info(f"Métricas do registro de equipamentos: {registro_equipamentos.metricas()}")
+    persistir_indice()
+    if cache_diagnosticos is not None:
+        logger.info(f"Estatísticas do cache de diagnósticos: {cache_diagnosticos.estatisticas()}")
+        cache_diagnosticos.fechar()
+    if respostas_preaquecidas is not None:
+        logger.info(f"Estatísticas das respostas pré-geradas: {respostas_preaquecidas.estatisticas()}")
+        respostas_preaquecidas.fechar()
+    if cache_historico is not None:
+        logger.info(f"Estatísticas do cache de histórico: {cache_historico.estatisticas()}")
+        cache_historico.fechar()
+    executor_historico.shutdown(wait=False)
+    logger.info(f"Métricas de envio ao Telegram: {agendador_envios.metricas()}")
+    if model is not None:
+        logger.info(f"Métricas do Gemini: {model.metricas()}")
+    logger.info(f"Coalescência de diagnósticos: {voos_diagnostico.estatisticas()}")
+    logger.info(f"Orçamento de tokens: {orcamento_tokens.metricas()}")
+    logger.info(f"Tempos do atendimento: {tempos.resumo()}")
+    tempos.fechar()
+    if servidor_metricas is not None:
+        servidor_metricas.encerrar()
+    logger.info(f"Estatísticas das sessões: {user_state.estatisticas()}")
+    user_state.fechar()
+    encerrar_logging()
+
 def main():
     # Configurações iniciais
     gemini_ok = configurar_gemini()
@@ -703,10 +1633,63 @@ def main():
         logger.critical("Falha em configurar serviços. Encerrando.")
         return
     
-    logger.info("Inicializando bot de suporte técnico...")
+    if MODO_EXECUCAO == 'async' and not configurar_firestore_async():
+        logger.critical("Falha em configurar o Firestore assíncrono. Encerrando.")
+        return
+    
+    usar_webhook = MODO_RECEBIMENTO == 'webhook'
+    if usar_webhook and not WEBHOOK_URL:
+        logger.critical("MODO_RECEBIMENTO=webhook exige WEBHOOK_URL. Encerrando.")
+        return
+    
+    if not configurar_escrita_diferida():
+        logger.warning("Escrita diferida indisponível; manutenções serão gravadas na hora")
+    
+    if not configurar_sessoes():
+        logger.warning("Persistência de sessões indisponível; conversas ficarão só em memória")
+    
+    if not configurar_cache_diagnosticos():
+        logger.warning("Cache de diagnósticos indisponível; todas as consultas irão ao Gemini")
+    
+    if not configurar_respostas_preaquecidas():
+        logger.warning("Respostas pré-geradas indisponíveis; o pico da manhã irá todo ao Gemini")
+    
+    if not configurar_cache_historico():
+        logger.warning("Cache de histórico indisponível; cada busca consultará o Firestore")
+    
+    if not configurar_equipamentos():
+        logger.warning("Registro de equipamentos indisponível; novos modelos ficarão só em memória")
+    
+    # Sem índice, a busca histórica volta a consultar o Firestore diretamente
+    if not configurar_indice():
+        logger.warning("Índice de similaridade indisponível; usando busca no Firestore")
+    
+    if not configurar_tokens():
+        logger.warning("Contagem de tokens pela API indisponível; usando estimativa local")
+    
+    if not configurar_metricas():
+        logger.warning("Endpoint de métricas indisponível; tempos seguem apenas no log de encerramento")
+    
+    logger.info(f"Inicializando bot de suporte técnico (modo {MODO_EXECUCAO})...")
+    
+    if MODO_EXECUCAO == 'async':
+        try:
+            asyncio.run(start_bot_async())
+        except KeyboardInterrupt:
+            logger.info("Encerrando bot...")
+        finally:
+            encerrar_servicos()
+        return
+    
+    global pool_atendimento
+    if POOL_WORKERS > 0:
+        pool_atendimento = PoolOrdenado(
+            POOL_WORKERS, POOL_CAPACIDADE_FILA, bloquear_quando_cheia=usar_webhook
+        )
+        logger.info(f"Pool de atendimento iniciado com {POOL_WORKERS} workers")
     
     # Inicia o bot em uma thread separada
-    bot_thread = threading.Thread(target=start_bot)
+    bot_thread = threading.Thread(target=start_bot_webhook if usar_webhook else start_bot)
     bot_thread.start()
 
     # Manter o programa principal rodando
@@ -715,7 +1698,11 @@ def main():
     except KeyboardInterrupt:
         logger.info("Encerrando bot...")
         bot_running.set()
+        if servidor_webhook is not None:
+            servidor_webhook.parar()
         bot_thread.join()
+    finally:
+        encerrar_servicos()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,276 @@
+import time
+import sqlite3
+import pathlib
+import logging
+import threading
+from collections import OrderedDict
+from difflib import SequenceMatcher
+from typing import Dict, Any, Optional, List, Tuple
+
+from indice_similaridade import normalizar_texto
+
+logger = logging.getLogger(__name__)
+
+
+# Backend em processo: LRU sobre OrderedDict com expiração por TTL
+class BackendMemoria:
+    somente_leitura = False
+
+    def __init__(self):
+        self._itens: 'OrderedDict[str, Dict[str, Any]]' = OrderedDict()
+        self._por_equipamento: Dict[str, set] = {}
+
+    def __len__(self):
+        return len(self._itens)
+
+    def obter(self, chave: str) -> Optional[Dict[str, Any]]:
+        item = self._itens.get(chave)
+        if item is not None:
+            self._itens.move_to_end(chave)
+        return item
+
+    def definir(self, chave: str, item: Dict[str, Any]):
+        self._itens[chave] = item
+        self._itens.move_to_end(chave)
+        self._por_equipamento.setdefault(item['equipamento'], set()).add(chave)
+
+    def remover(self, chave: str):
+        item = self._itens.pop(chave, None)
+        if item is not None:
+            chaves = self._por_equipamento.get(item['equipamento'])
+            if chaves is not None:
+                chaves.discard(chave)
+                if not chaves:
+                    del self._por_equipamento[item['equipamento']]
+
+    def mais_antiga(self) -> Optional[str]:
+        return next(iter(self._itens), None)
+
+    def candidatos(self, equipamento: str) -> List[Tuple[str, Dict[str, Any]]]:
+        return [(c, self._itens[c]) for c in self._por_equipamento.get(equipamento, ())]
+
+    def expirados(self, agora: float) -> List[str]:
+        return [c for c, item in self._itens.items() if item['expira_em'] <= agora]
+
+    def fechar(self):
+        pass
+
+
+# Backend em disco: sobrevive a reinícios do processo. somente_leitura abre
+# um arquivo mantido por outro processo (ex.: preaquecer_respostas.py) sem
+# gravar nada nele: sem registro de acesso e sem remover expirados
+class BackendSQLite:
+    def __init__(self, caminho: str, somente_leitura: bool = False):
+        self.somente_leitura = somente_leitura
+        if somente_leitura:
+            uri = f"{pathlib.Path(caminho).resolve().as_uri()}?mode=ro"
+            self._conexao = sqlite3.connect(uri, uri=True, check_same_thread=False, isolation_level=None)
+            return
+        self._conexao = sqlite3.connect(caminho, check_same_thread=False, isolation_level=None)
+        self._conexao.execute('PRAGMA journal_mode=WAL')
+        self._conexao.execute("""
+            CREATE TABLE IF NOT EXISTS diagnosticos (
+                chave TEXT PRIMARY KEY,
+                equipamento TEXT NOT NULL,
+                problema TEXT NOT NULL,
+                resposta TEXT NOT NULL,
+                expira_em REAL NOT NULL,
+                acessado_em REAL NOT NULL
+            )
+        """)
+        self._conexao.execute(
+            'CREATE INDEX IF NOT EXISTS idx_diagnosticos_equipamento ON diagnosticos (equipamento)'
+        )
+        self._conexao.execute(
+            'CREATE INDEX IF NOT EXISTS idx_diagnosticos_acesso ON diagnosticos (acessado_em)'
+        )
+
+    def __len__(self):
+        return self._conexao.execute('SELECT COUNT(*) FROM diagnosticos').fetchone()[0]
+
+    @staticmethod
+    def _item(linha) -> Dict[str, Any]:
+        equipamento, problema, resposta, expira_em = linha
+        return {
+            'equipamento': equipamento,
+            'problema': problema,
+            'resposta': resposta,
+            'expira_em': expira_em,
+        }
+
+    def obter(self, chave: str) -> Optional[Dict[str, Any]]:
+        linha = self._conexao.execute(
+            'SELECT equipamento, problema, resposta, expira_em FROM diagnosticos WHERE chave = ?',
+            (chave,)
+        ).fetchone()
+        if linha is None:
+            return None
+        if not self.somente_leitura:
+            self._conexao.execute(
+                'UPDATE diagnosticos SET acessado_em = ? WHERE chave = ?', (time.time(), chave)
+            )
+        return self._item(linha)
+
+    def definir(self, chave: str, item: Dict[str, Any]):
+        self._conexao.execute(
+            'INSERT OR REPLACE INTO diagnosticos VALUES (?, ?, ?, ?, ?, ?)',
+            (chave, item['equipamento'], item['problema'], item['resposta'],
+             item['expira_em'], time.time())
+        )
+
+    def remover(self, chave: str):
+        self._conexao.execute('DELETE FROM diagnosticos WHERE chave = ?', (chave,))
+
+    def mais_antiga(self) -> Optional[str]:
+        linha = self._conexao.execute(
+            'SELECT chave FROM diagnosticos ORDER BY acessado_em LIMIT 1'
+        ).fetchone()
+        return linha[0] if linha else None
+
+    def candidatos(self, equipamento: str) -> List[Tuple[str, Dict[str, Any]]]:
+        linhas = self._conexao.execute(
+            'SELECT chave, equipamento, problema, resposta, expira_em '
+            'FROM diagnosticos WHERE equipamento = ?',
+            (equipamento,)
+        ).fetchall()
+        return [(linha[0], self._item(linha[1:])) for linha in linhas]
+
+    def expirados(self, agora: float) -> List[str]:
+        linhas = self._conexao.execute(
+            'SELECT chave FROM diagnosticos WHERE expira_em <= ?', (agora,)
+        ).fetchall()
+        return [linha[0] for linha in linhas]
+
+    def fechar(self):
+        self._conexao.close()
+
+
+# Cache de diagnósticos chaveado por (equipamento, problema) normalizados.
+# Opcionalmente aceita problemas quase idênticos acima de um limiar.
+class CacheDiagnostico:
+    def __init__(
+        self,
+        backend=None,
+        tamanho_maximo: int = 500,
+        ttl: float = 6 * 3600,
+        limiar_similaridade: Optional[float] = None
+    ):
+        self.backend = backend if backend is not None else BackendMemoria()
+        self.tamanho_maximo = tamanho_maximo
+        self.ttl = ttl
+        self.limiar_similaridade = limiar_similaridade
+
+        self._lock = threading.Lock()
+        self._tamanho = len(self.backend)
+        self.acertos = 0
+        self.acertos_similares = 0
+        self.falhas = 0
+        self.despejos = 0
+        self.expiracoes = 0
+
+    def obter(self, equipamento: str, problema: str) -> Optional[str]:
+        equipamento_norm = normalizar_texto(equipamento)
+        problema_norm = normalizar_texto(problema)
+        chave = f"{equipamento_norm}|{problema_norm}"
+        agora = time.time()
+
+        with self._lock:
+            item = self.backend.obter(chave)
+            if item is not None:
+                if item['expira_em'] > agora:
+                    self.acertos += 1
+                    return item['resposta']
+                if not self.backend.somente_leitura:
+                    self._remover_expirado(chave)
+
+            if self.limiar_similaridade:
+                item = self._buscar_similar(equipamento_norm, problema_norm, agora)
+                if item is not None:
+                    self.acertos_similares += 1
+                    return item['resposta']
+
+            self.falhas += 1
+            return None
+
+    def _buscar_similar(self, equipamento: str, problema: str, agora: float) -> Optional[Dict[str, Any]]:
+        melhor, melhor_score = None, self.limiar_similaridade
+        for chave, item in self.backend.candidatos(equipamento):
+            if item['expira_em'] <= agora:
+                continue
+            matcher = SequenceMatcher(None, problema, item['problema'])
+            # quick_ratio é um limite superior barato para descartar candidatos
+            if matcher.quick_ratio() < melhor_score:
+                continue
+            score = matcher.ratio()
+            if score >= melhor_score:
+                melhor, melhor_score = item, score
+        return melhor
+
+    def armazenar(self, equipamento: str, problema: str, resposta: str):
+        equipamento_norm = normalizar_texto(equipamento)
+        problema_norm = normalizar_texto(problema)
+        chave = f"{equipamento_norm}|{problema_norm}"
+
+        with self._lock:
+            existente = self.backend.obter(chave) is not None
+            self.backend.definir(chave, {
+                'equipamento': equipamento_norm,
+                'problema': problema_norm,
+                'resposta': resposta,
+                'expira_em': time.time() + self.ttl,
+            })
+            if not existente:
+                self._tamanho += 1
+
+            if self._tamanho > self.tamanho_maximo:
+                for expirada in self.backend.expirados(time.time()):
+                    self._remover_expirado(expirada)
+
+            while self._tamanho > self.tamanho_maximo:
+                antiga = self.backend.mais_antiga()
+                if antiga is None:
+                    break
+                self.backend.remover(antiga)
+                self._tamanho -= 1
+                self.despejos += 1
+
+    def _remover_expirado(self, chave: str):
+        self.backend.remover(chave)
+        self._tamanho -= 1
+        self.expiracoes += 1
+
+    def estatisticas(self) -> Dict[str, Any]:
+        with self._lock:
+            consultas = self.acertos + self.acertos_similares + self.falhas
+            return {
+                'tamanho': self._tamanho,
+                'tamanho_maximo': self.tamanho_maximo,
+                'acertos': self.acertos,
+                'acertos_similares': self.acertos_similares,
+                'falhas': self.falhas,
+                'despejos': self.despejos,
+                'expiracoes': self.expiracoes,
+                'taxa_acerto': (self.acertos + self.acertos_similares) / consultas if consultas else 0.0,
+            }
+
+    def fechar(self):
+        with self._lock:
+            self.backend.fechar()
+
+
+def criar_cache_diagnostico(
+    backend: str,
+    tamanho_maximo: int,
+    ttl: float,
+    limiar_similaridade: Optional[float] = None,
+    caminho: str = 'cache_diagnosticos.sqlite3'
+) -> Optional[CacheDiagnostico]:
+    if backend == 'desligado':
+        return None
+    if backend == 'sqlite':
+        instancia = BackendSQLite(caminho)
+    elif backend == 'memoria':
+        instancia = BackendMemoria()
+    else:
+        raise ValueError(f"Backend de cache desconhecido: {backend}")
+    return CacheDiagnostico(instancia, tamanho_maximo, ttl, limiar_similaridade)
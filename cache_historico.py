@@ -0,0 +1,162 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+# Histórico recente por equipamento na frente da consulta ordenada de
+# 'manutencoes'. Cada entrada mantém um listener (on_snapshot) sobre a mesma
+# consulta, então manutenções gravadas depois chegam sozinhas e a próxima
+# leitura sai da memória. O TTL só limita quanto tempo uma entrada vale se
+# o listener cair sem que o cliente perceba.
+class CacheHistorico:
+    def __init__(
+        self,
+        criar_consulta: Callable[[Optional[str], str], Any],
+        tamanho_maximo: int = 100,
+        ttl: float = 3600
+    ):
+        self.criar_consulta = criar_consulta
+        self.tamanho_maximo = tamanho_maximo
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._entradas: 'OrderedDict[Tuple[Optional[str], Optional[str]], Dict[str, Any]]' = OrderedDict()
+        self.acertos = 0
+        self.falhas = 0
+        self.despejos = 0
+        self.expiracoes = 0
+        self.atualizacoes = 0
+        self.erros_listener = 0
+
+    @staticmethod
+    def _chave(equipamento_id: Optional[str], equipamento: str) -> Tuple[Optional[str], Optional[str]]:
+        # Mesmo critério da consulta: o ID canônico quando existe, senão o texto
+        return (equipamento_id, None) if equipamento_id else (None, equipamento)
+
+    @staticmethod
+    def _listener_ativo(entrada: Dict[str, Any]) -> bool:
+        vigia = entrada['vigia']
+        # None: o listener ainda está sendo criado por quem carregou a entrada
+        return vigia is None or getattr(vigia, 'is_active', True)
+
+    # Só memória: devolve None quando a entrada não existe, expirou ou perdeu
+    # o listener, e quem chamou decide como carregar (carregar() bloqueia)
+    def obter(self, equipamento_id: Optional[str], equipamento: str) -> Optional[List[Dict[str, Any]]]:
+        chave = self._chave(equipamento_id, equipamento)
+        cancelar = []
+        with self._lock:
+            entrada = self._entradas.get(chave)
+            if entrada is not None:
+                if entrada['expira_em'] > time.monotonic() and self._listener_ativo(entrada):
+                    self._entradas.move_to_end(chave)
+                    self.acertos += 1
+                    # Cópias: quem consome anota a relevância em cada documento
+                    return [dict(documento) for documento in entrada['documentos']]
+                del self._entradas[chave]
+                cancelar.append(entrada['vigia'])
+                self.expiracoes += 1
+            self.falhas += 1
+        self._cancelar(cancelar)
+        return None
+
+    def carregar(self, equipamento_id: Optional[str], equipamento: str) -> List[Dict[str, Any]]:
+        chave = self._chave(equipamento_id, equipamento)
+        consulta = self.criar_consulta(equipamento_id, equipamento)
+        documentos = [doc.to_dict() for doc in consulta.stream()]
+
+        cancelar = []
+        with self._lock:
+            entrada = self._entradas.get(chave)
+            if entrada is not None and self._listener_ativo(entrada):
+                # Outra thread carregou a mesma entrada e já cuida do listener
+                entrada['documentos'] = documentos
+                entrada['expira_em'] = time.monotonic() + self.ttl
+                return [dict(documento) for documento in documentos]
+            if entrada is not None:
+                cancelar.append(entrada['vigia'])
+
+            entrada = {'documentos': documentos, 'expira_em': time.monotonic() + self.ttl, 'vigia': None}
+            self._entradas[chave] = entrada
+            while len(self._entradas) > self.tamanho_maximo:
+                _, despejada = self._entradas.popitem(last=False)
+                cancelar.append(despejada['vigia'])
+                self.despejos += 1
+        self._cancelar(cancelar)
+
+        # Fora da trava: o primeiro snapshot pode chegar antes de on_snapshot retornar
+        try:
+            vigia = consulta.on_snapshot(
+                lambda docs, mudancas, lido_em: self._ao_alterar(chave, entrada, docs)
+            )
+        except Exception as e:
+            logger.warning(f"Listener do histórico indisponível para {chave}: {e}")
+            with self._lock:
+                self.erros_listener += 1
+                if self._entradas.get(chave) is entrada:
+                    del self._entradas[chave]
+            return [dict(documento) for documento in documentos]
+
+        with self._lock:
+            if self._entradas.get(chave) is entrada:
+                entrada['vigia'] = vigia
+                vigia = None
+        # Despejada enquanto o listener era criado
+        self._cancelar([vigia])
+        return [dict(documento) for documento in documentos]
+
+    def buscar(self, equipamento_id: Optional[str], equipamento: str) -> List[Dict[str, Any]]:
+        documentos = self.obter(equipamento_id, equipamento)
+        if documentos is None:
+            documentos = self.carregar(equipamento_id, equipamento)
+        return documentos
+
+    # Roda na thread do listener: nunca deixar uma exceção escapar
+    def _ao_alterar(self, chave, entrada: Dict[str, Any], docs):
+        try:
+            documentos = [doc.to_dict() for doc in docs]
+        except Exception as e:
+            logger.error(f"Erro ao ler snapshot do histórico {chave}: {e}")
+            with self._lock:
+                self.erros_listener += 1
+            return
+        with self._lock:
+            # Uma entrada substituída ou despejada ignora o listener antigo
+            if self._entradas.get(chave) is entrada:
+                entrada['documentos'] = documentos
+                entrada['expira_em'] = time.monotonic() + self.ttl
+                self.atualizacoes += 1
+
+    @staticmethod
+    def _cancelar(vigias):
+        for vigia in vigias:
+            if vigia is None:
+                continue
+            try:
+                vigia.unsubscribe()
+            except Exception as e:
+                logger.warning(f"Erro ao encerrar listener do histórico: {e}")
+
+    def estatisticas(self) -> Dict[str, Any]:
+        with self._lock:
+            consultas = self.acertos + self.falhas
+            return {
+                'tamanho': len(self._entradas),
+                'tamanho_maximo': self.tamanho_maximo,
+                'acertos': self.acertos,
+                'falhas': self.falhas,
+                'despejos': self.despejos,
+                'expiracoes': self.expiracoes,
+                'atualizacoes': self.atualizacoes,
+                'erros_listener': self.erros_listener,
+                'taxa_acerto': self.acertos / consultas if consultas else 0.0,
+            }
+
+    def fechar(self):
+        with self._lock:
+            vigias = [entrada['vigia'] for entrada in self._entradas.values()]
+            self._entradas.clear()
+        self._cancelar(vigias)
@@ -0,0 +1,97 @@
+import zlib
+from typing import Any, Dict, Set, Tuple
+
+from indice_similaridade import normalizar_texto, extrair_termos
+
+# Características de busca gravadas junto com cada manutenção, para que a
+# pontuação na consulta seja só interseção de conjuntos e contagem de bits.
+# Mudou o cálculo? Incremente a versão e rode migrar_caracteristicas.py.
+VERSAO_CARACTERISTICAS = 1
+BITS_ASSINATURA = 512
+
+CAMPOS_CARACTERISTICAS = ('problema_normalizado', 'palavras_chave', 'assinatura', 'caracteristicas_versao')
+
+# Radicalização leve para o português (inspirada no RSLP), aplicada sobre
+# o texto já sem acentos: plural, diminutivo, sufixos nominais e verbais
+# e a vogal final. Não busca o radical linguístico exato, só aproximar
+# variações da mesma palavra ("vazamento", "vazando", "vazamentos").
+_PLURAIS = (('oes', 'ao'), ('aes', 'ao'), ('ais', 'al'), ('eis', 'el'), ('ois', 'ol'), ('ns', 'm'), ('res', 'r'))
+_DIMINUTIVOS = ('zinho', 'zinha', 'inho', 'inha')
+_SUFIXOS_NOMINAIS = (
+    'amente', 'izacao', 'mente', 'acao', 'icao', 'idade', 'mento', 'ancia', 'encia',
+    'ismo', 'ista', 'avel', 'ivel', 'ador', 'edor', 'agem', 'oso', 'osa', 'ico', 'ica',
+)
+_SUFIXOS_VERBAIS = (
+    'ando', 'endo', 'indo', 'ado', 'ada', 'ido', 'ida', 'ava', 'iam', 'ar', 'er', 'ir', 'ia', 'ou', 'am', 'em',
+)
+_RADICAL_MINIMO = 3
+
+
+def _remover_sufixo(palavra: str, sufixos) -> Tuple[str, bool]:
+    for sufixo in sufixos:
+        if palavra.endswith(sufixo) and len(palavra) - len(sufixo) >= _RADICAL_MINIMO:
+            return palavra[:-len(sufixo)], True
+    return palavra, False
+
+
+def radical(palavra: str) -> str:
+    if len(palavra) <= _RADICAL_MINIMO:
+        return palavra
+
+    if palavra.endswith('s') and len(palavra) > _RADICAL_MINIMO + 1:
+        for sufixo, troca in _PLURAIS:
+            if palavra.endswith(sufixo):
+                palavra = palavra[:-len(sufixo)] + troca
+                break
+        else:
+            palavra = palavra[:-1]
+
+    palavra, _ = _remover_sufixo(palavra, _DIMINUTIVOS)
+    palavra, removido = _remover_sufixo(palavra, _SUFIXOS_NOMINAIS)
+    if not removido:
+        palavra, _ = _remover_sufixo(palavra, _SUFIXOS_VERBAIS)
+
+    if palavra[-1] in 'aeo' and len(palavra) > _RADICAL_MINIMO:
+        palavra = palavra[:-1]
+    return palavra
+
+
+# Conjunto de trigramas de caracteres projetado num mapa de bits. A
+# similaridade entre duas assinaturas (Dice: 2|A∩B| / (|A| + |B|)) faz o
+# papel do SequenceMatcher na pontuação, com custo de duas operações de bits.
+def assinatura(normalizado: str) -> int:
+    valor = 0
+    delimitado = f' {normalizado} '
+    for i in range(len(delimitado) - 2):
+        valor |= 1 << (zlib.crc32(delimitado[i:i + 3].encode('utf-8')) % BITS_ASSINATURA)
+    return valor
+
+
+def _contar_bits(valor: int) -> int:
+    return bin(valor).count('1')
+
+
+def similaridade_assinaturas(a: int, b: int) -> float:
+    total = _contar_bits(a) + _contar_bits(b)
+    if not total:
+        return 0.0
+    return 2 * _contar_bits(a & b) / total
+
+
+def extrair_caracteristicas(problema: str) -> Dict[str, Any]:
+    normalizado = normalizar_texto(problema)
+    return {
+        'problema_normalizado': normalizado,
+        'palavras_chave': sorted({radical(termo) for termo in extrair_termos(normalizado)}),
+        # Hex: o registro também passa pelo diário JSON da escrita diferida
+        'assinatura': format(assinatura(normalizado), f'0{BITS_ASSINATURA // 4}x'),
+        'caracteristicas_versao': VERSAO_CARACTERISTICAS,
+    }
+
+
+# Palavras-chave e assinatura prontas para comparar. Documentos ainda não
+# migrados (ou de outra versão) têm as características calculadas na hora.
+def caracteristicas_comparaveis(registro: Dict[str, Any]) -> Tuple[Set[str], int]:
+    if registro.get('caracteristicas_versao') != VERSAO_CARACTERISTICAS:
+        registro = extrair_caracteristicas(registro.get('problema', ''))
+    return set(registro.get('palavras_chave') or ()), int(registro.get('assinatura') or '0', 16)
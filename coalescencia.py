@@ -0,0 +1,99 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict
+
+from indice_similaridade import normalizar_texto, extrair_termos
+
+logger = logging.getLogger(__name__)
+
+
+# Chave de coalescência: equipamento canônico + conjunto de termos do
+# problema, de modo que variações de ordem, acento e pontuação coincidam
+def chave_coalescencia(equipamento: str, problema: str) -> str:
+    normalizado = normalizar_texto(problema)
+    termos = sorted(set(extrair_termos(normalizado))) or [normalizado]
+    return f"{normalizar_texto(equipamento)}|{' '.join(termos)}"
+
+
+# Single-flight: chamadas simultâneas com a mesma chave compartilham uma
+# única execução. A primeira (líder) executa; as demais esperam e recebem
+# o mesmo resultado, ou a mesma exceção.
+class VooUnico:
+    def __init__(self, nome: str = 'diagnostico'):
+        self.nome = nome
+        self._lock = threading.Lock()
+        self._voos: Dict[str, Future] = {}
+        self._voos_async: Dict[str, asyncio.Future] = {}
+        self.lideres = 0
+        self.seguidores = 0
+
+    def executar(self, chave: str, funcao: Callable[..., Any], *args, **kwargs) -> Any:
+        with self._lock:
+            voo = self._voos.get(chave)
+            lider = voo is None
+            if lider:
+                voo = Future()
+                self._voos[chave] = voo
+                self.lideres += 1
+            else:
+                self.seguidores += 1
+
+        if not lider:
+            logger.info(f"{self.nome}: aguardando chamada em andamento para '{chave}'")
+            return voo.result()
+
+        try:
+            resultado = funcao(*args, **kwargs)
+            voo.set_result(resultado)
+            return resultado
+        except BaseException as e:
+            voo.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._voos[chave]
+
+    async def executar_async(self, chave: str, funcao: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        with self._lock:
+            voo = self._voos_async.get(chave)
+            lider = voo is None
+            if lider:
+                voo = asyncio.get_running_loop().create_future()
+                self._voos_async[chave] = voo
+                self.lideres += 1
+            else:
+                self.seguidores += 1
+
+        if not lider:
+            logger.info(f"{self.nome}: aguardando chamada em andamento para '{chave}'")
+            # shield: um seguidor cancelado não cancela o resultado dos outros
+            return await asyncio.shield(voo)
+
+        try:
+            resultado = await funcao(*args, **kwargs)
+            voo.set_result(resultado)
+            return resultado
+        except asyncio.CancelledError:
+            voo.cancel()
+            raise
+        except BaseException as e:
+            voo.set_exception(e)
+            # Evita o aviso de exceção não recuperada quando não há seguidores
+            voo.exception()
+            raise
+        finally:
+            with self._lock:
+                del self._voos_async[chave]
+
+    def estatisticas(self) -> Dict[str, Any]:
+        with self._lock:
+            chamadas = self.lideres + self.seguidores
+            return {
+                'em_andamento': len(self._voos) + len(self._voos_async),
+                'chamadas': chamadas,
+                'chamadas_upstream': self.lideres,
+                'coalescidas': self.seguidores,
+                'taxa_coalescencia': self.seguidores / chamadas if chamadas else 0.0,
+            }
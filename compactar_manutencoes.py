@@ -0,0 +1,242 @@
+import os
+import sys
+import zlib
+import logging
+import argparse
+from datetime import datetime, timezone
+from typing import Dict, List
+
+import numpy as np
+from google.cloud import firestore
+
+from conexao_firestore import configurar_firestore, ler_paginas
+from indice_similaridade import IndiceSimilaridade, carregar_ou_construir, normalizar_texto
+from refinamento import PADRAO_TAG
+from registro_logs import configurar_logging
+
+logger = logging.getLogger(__name__)
+
+LIMITE_LOTE_FIRESTORE = 500
+TAMANHO_PAGINA = 500
+PERMUTACOES = 64  # por campo: a assinatura tem 64 do problema + 64 da solução
+LINHAS_FAIXA = 8  # 16 faixas de 8 linhas: pares com Jaccard ~0,7 já viram candidatos
+LIMIAR_PROBLEMA = 0.6
+LIMIAR_SOLUCAO = 0.8
+MAX_COMPARACOES_BALDE = 50
+PRIMO = np.uint64(4294967311)  # primo logo acima de 2^32: a*x + b cabe em uint64
+DATA_MINIMA = datetime.min.replace(tzinfo=timezone.utc)
+
+
+# Problemas são curtos: n-gramas de caracteres. Soluções são HTML longo e
+# repetitivo: trigramas de palavras, sem as tags.
+def telhas_problema(texto: str, n: int = 5) -> set:
+    texto = normalizar_texto(texto)
+    return {texto[i:i + n] for i in range(max(1, len(texto) - n + 1))}
+
+
+def telhas_solucao(texto: str, n: int = 3) -> set:
+    palavras = normalizar_texto(PADRAO_TAG.sub(' ', texto or '')).split()
+    return {' '.join(palavras[i:i + n]) for i in range(max(1, len(palavras) - n + 1))}
+
+
+# MinHash por hashing universal (a*x + b mod p) sobre o crc32 das telhas; a
+# fração de posições iguais entre duas assinaturas estima o Jaccard
+class AssinadorMinHash:
+    def __init__(self, permutacoes: int = PERMUTACOES, semente: int = 1):
+        aleatorio = np.random.default_rng(semente)
+        self.permutacoes = permutacoes
+        self._a = aleatorio.integers(1, 2 ** 32, size=(2, permutacoes, 1), dtype=np.uint64)
+        self._b = aleatorio.integers(0, 2 ** 32, size=(2, permutacoes, 1), dtype=np.uint64)
+
+    def _minhash(self, telhas: set, campo: int) -> np.ndarray:
+        hashes = np.fromiter(
+            (zlib.crc32(telha.encode('utf-8')) for telha in telhas), dtype=np.uint64, count=len(telhas)
+        )
+        return ((self._a[campo] * hashes + self._b[campo]) % PRIMO).min(axis=1).astype(np.uint32)
+
+    def assinar(self, problema: str, solucao: str) -> np.ndarray:
+        return np.concatenate([
+            self._minhash(telhas_problema(problema), 0),
+            self._minhash(telhas_solucao(solucao), 1),
+        ])
+
+
+# Agrupamento incremental por LSH: cada faixa da assinatura é um balde por
+# equipamento, e os documentos que caem no mesmo balde são confirmados pelo
+# Jaccard estimado do problema e da solução antes de entrar no mesmo grupo
+# (union-find). Só ficam em memória a assinatura e poucos campos de cada
+# documento, nunca os textos.
+class AgrupadorLSH:
+    def __init__(
+        self,
+        permutacoes: int = PERMUTACOES,
+        linhas_faixa: int = LINHAS_FAIXA,
+        limiar_problema: float = LIMIAR_PROBLEMA,
+        limiar_solucao: float = LIMIAR_SOLUCAO,
+        max_comparacoes: int = MAX_COMPARACOES_BALDE
+    ):
+        self.permutacoes = permutacoes
+        self.linhas_faixa = linhas_faixa
+        self.limiar_problema = limiar_problema
+        self.limiar_solucao = limiar_solucao
+        self.max_comparacoes = max_comparacoes
+
+        self.ids: List[str] = []
+        self.datas: List[datetime] = []
+        self.primeiras_datas: List[datetime] = []
+        self.ocorrencias: List[int] = []
+        self._assinaturas: List[np.ndarray] = []
+        self._pais: List[int] = []
+        self._baldes: Dict[tuple, List[int]] = {}
+        self.comparacoes = 0
+
+    def _raiz(self, i: int) -> int:
+        while self._pais[i] != i:
+            self._pais[i] = self._pais[self._pais[i]]
+            i = self._pais[i]
+        return i
+
+    def _semelhantes(self, i: int, j: int) -> bool:
+        self.comparacoes += 1
+        a, b = self._assinaturas[i], self._assinaturas[j]
+        p = self.permutacoes
+        return (
+            np.mean(a[:p] == b[:p]) >= self.limiar_problema
+            and np.mean(a[p:] == b[p:]) >= self.limiar_solucao
+        )
+
+    def adicionar(self, doc_id: str, equipamento: str, assinatura: np.ndarray, dados: Dict):
+        i = len(self.ids)
+        self.ids.append(doc_id)
+        self.datas.append(dados.get('data') or DATA_MINIMA)
+        self.primeiras_datas.append(dados.get('primeira_data') or dados.get('data') or DATA_MINIMA)
+        self.ocorrencias.append(int(dados.get('ocorrencias') or 1))
+        self._assinaturas.append(assinatura)
+        self._pais.append(i)
+
+        for inicio in range(0, len(assinatura), self.linhas_faixa):
+            faixa = assinatura[inicio:inicio + self.linhas_faixa].tobytes()
+            balde = self._baldes.setdefault((equipamento, inicio, hash(faixa)), [])
+            for j in balde[:self.max_comparacoes]:
+                if self._raiz(i) != self._raiz(j) and self._semelhantes(i, j):
+                    self._pais[self._raiz(j)] = self._raiz(i)
+            balde.append(i)
+
+    def grupos(self) -> List[List[int]]:
+        por_raiz: Dict[int, List[int]] = {}
+        for i in range(len(self.ids)):
+            por_raiz.setdefault(self._raiz(i), []).append(i)
+        return [membros for membros in por_raiz.values() if len(membros) > 1]
+
+
+def agrupar_manutencoes(db, agrupador: AgrupadorLSH, assinador: AssinadorMinHash, tamanho_pagina: int):
+    for lidos, doc in enumerate(ler_paginas(db, 'manutencoes', tamanho_pagina), 1):
+        dados = doc.to_dict()
+        equipamento = dados.get('equipamento_id') or normalizar_texto(dados.get('equipamento', ''))
+        assinatura = assinador.assinar(dados.get('problema', ''), dados.get('solucao', ''))
+        agrupador.adicionar(doc.id, equipamento, assinatura, dados)
+        if lidos % 5000 == 0:
+            logger.info(f"{lidos} documentos assinados")
+    return agrupador.grupos()
+
+
+# Cada grupo vira o seu registro mais recente, com a soma das ocorrências e
+# a data da primeira; os demais são apagados. Um grupo inteiro vai no mesmo
+# lote sempre que cabe nele.
+def executar_compactacao(db, grupos, agrupador: AgrupadorLSH, tamanho_lote=LIMITE_LOTE_FIRESTORE, simular=False):
+    colecao = db.collection('manutencoes')
+    batch = db.batch()
+    pendentes = 0
+    removidos = 0
+
+    for membros in grupos:
+        canonico = max(membros, key=lambda i: agrupador.datas[i])
+        outros = [i for i in membros if i != canonico]
+        ocorrencias = sum(agrupador.ocorrencias[i] for i in membros)
+        removidos += len(outros)
+        if simular:
+            logger.info(
+                f"{agrupador.ids[canonico]}: {ocorrencias} ocorrências, "
+                f"apagaria {[agrupador.ids[i] for i in outros]}"
+            )
+            continue
+
+        if pendentes and pendentes + len(membros) > tamanho_lote:
+            batch.commit()
+            batch = db.batch()
+            pendentes = 0
+
+        atualizacao = {'ocorrencias': ocorrencias, 'compactado_em': firestore.SERVER_TIMESTAMP}
+        primeira_data = min(agrupador.primeiras_datas[i] for i in membros)
+        if primeira_data != DATA_MINIMA:
+            atualizacao['primeira_data'] = primeira_data
+        batch.update(colecao.document(agrupador.ids[canonico]), atualizacao)
+        pendentes += 1
+        for i in outros:
+            batch.delete(colecao.document(agrupador.ids[i]))
+            pendentes += 1
+            if pendentes >= tamanho_lote:
+                batch.commit()
+                batch = db.batch()
+                pendentes = 0
+
+    if pendentes:
+        batch.commit()
+
+    logger.info(
+        f"Compactação{' (simulada)' if simular else ''}: {len(agrupador.ids)} documentos, "
+        f"{len(grupos)} grupos de quase-duplicatas, {removidos} removidos, "
+        f"{agrupador.comparacoes} comparações"
+    )
+    return removidos
+
+
+# O índice persistido ainda aponta para os documentos apagados: é refeito
+# a partir da coleção compactada. A geração avançada faz o bot em execução
+# recarregar o índice novo e deixar de salvar a cópia antiga por cima dele.
+def reconstruir_indice(db, diretorio, dimensao):
+    for arquivo in (IndiceSimilaridade.ARQUIVO_MATRIZ, IndiceSimilaridade.ARQUIVO_METADADOS):
+        caminho = os.path.join(diretorio, arquivo)
+        if os.path.exists(caminho):
+            os.remove(caminho)
+    geracao = IndiceSimilaridade.avancar_geracao(diretorio)
+    carregar_ou_construir(db, diretorio, dimensao)
+    logger.info(f"Índice de similaridade reconstruído na geração {geracao}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Funde as manutenções quase duplicadas (MinHash/LSH)")
+    parser.add_argument('--pagina', type=int, default=TAMANHO_PAGINA, help="Documentos lidos por página")
+    parser.add_argument('--lote', type=int, default=LIMITE_LOTE_FIRESTORE,
+                        help="Operações por batch de escrita (máx. 500)")
+    parser.add_argument('--limiar-problema', type=float, default=LIMIAR_PROBLEMA,
+                        help="Jaccard mínimo entre os problemas")
+    parser.add_argument('--limiar-solucao', type=float, default=LIMIAR_SOLUCAO,
+                        help="Jaccard mínimo entre as soluções")
+    parser.add_argument('--manter-indice', action='store_true',
+                        help="Não reconstrói o índice de similaridade local")
+    parser.add_argument('--simular', action='store_true',
+                        help="Apenas mostra o que seria fundido")
+    args = parser.parse_args()
+
+    configurar_logging('sincrono', arquivo=None)
+
+    db = configurar_firestore()
+    if db is None:
+        sys.exit(1)
+
+    agrupador = AgrupadorLSH(limiar_problema=args.limiar_problema, limiar_solucao=args.limiar_solucao)
+    grupos = agrupar_manutencoes(db, agrupador, AssinadorMinHash(), args.pagina)
+    removidos = executar_compactacao(db, grupos, agrupador, min(args.lote, LIMITE_LOTE_FIRESTORE), args.simular)
+
+    if removidos and not args.simular and not args.manter_indice:
+        # Mesmas variáveis e padrões do bot
+        reconstruir_indice(
+            db,
+            os.getenv('INDICE_DIRETORIO', 'indice_manutencoes'),
+            int(os.getenv('INDICE_DIMENSAO', '1024'))
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+import os
+import json
+import logging
+
+from dotenv import load_dotenv
+from google.cloud import firestore
+from google.oauth2 import service_account
+
+logger = logging.getLogger(__name__)
+
+# Documentos por página nas leituras completas de uma coleção
+TAMANHO_PAGINA = 500
+
+
+# Conexão com o Firestore sem efeitos colaterais de importação, para que os
+# scripts de manutenção (backfill, migração, compactação) não carreguem o bot
+def _credenciais():
+    load_dotenv()
+    credentials_json = os.getenv('GOOGLE_APPLICATION_CREDENTIALS_JSON')
+    if not credentials_json:
+        return None
+    return service_account.Credentials.from_service_account_info(json.loads(credentials_json))
+
+
+def configurar_firestore():
+    try:
+        credentials = _credenciais()
+        if credentials is None:
+            logger.error("Credenciais do Firestore não encontradas")
+            return None
+
+        db = firestore.Client(project=os.getenv('GOOGLE_PROJECT_ID'), credentials=credentials)
+        logger.info("Conexão com Firestore estabelecida com sucesso!")
+        return db
+
+    except Exception as e:
+        logger.error(f"Erro na conexão com Firestore: {e}", exc_info=True)
+        return None
+
+
+# Cliente assíncrono do Firestore para o modo asyncio
+def configurar_firestore_async():
+    try:
+        credentials = _credenciais()
+        if credentials is None:
+            logger.error("Credenciais do Firestore não encontradas")
+            return None
+
+        db_async = firestore.AsyncClient(project=os.getenv('GOOGLE_PROJECT_ID'), credentials=credentials)
+        logger.info("Cliente assíncrono do Firestore configurado")
+        return db_async
+
+    except Exception as e:
+        logger.error(f"Erro na conexão assíncrona com Firestore: {e}", exc_info=True)
+        return None
+
+
+# Lê uma coleção inteira em páginas ordenadas pelo ID do documento, em vez
+# de um único stream() que pode expirar em coleções grandes
+def ler_paginas(db, colecao: str = 'manutencoes', tamanho_pagina: int = TAMANHO_PAGINA):
+    consulta = db.collection(colecao).order_by('__name__').limit(tamanho_pagina)
+    ultimo = None
+    while True:
+        pagina = list((consulta.start_after(ultimo) if ultimo is not None else consulta).stream())
+        yield from pagina
+        if len(pagina) < tamanho_pagina:
+            return
+        ultimo = pagina[-1]
@@ -0,0 +1,193 @@
+import time
+import asyncio
+import logging
+import threading
+from typing import Any, Callable, Dict
+
+from metricas import tempos
+from streaming import tempo_espera_telegram
+
+logger = logging.getLogger(__name__)
+
+
+# Balde de tokens no formato de agendamento virtual (GCRA): em vez de contar
+# tokens, guarda o instante teórico da próxima liberação. Reservas feitas
+# em sequência recebem horários em sequência, o que mantém a ordem de chegada.
+class BaldeTokens:
+    __slots__ = ('intervalo', 'tolerancia', 'proximo')
+
+    def __init__(self, taxa: float, rajada: int = 1):
+        self.intervalo = 1.0 / taxa
+        self.tolerancia = self.intervalo * max(rajada - 1, 0)
+        self.proximo = 0.0
+
+    def liberado_em(self, agora: float) -> float:
+        return max(agora, self.proximo - self.tolerancia)
+
+    def consumir(self, instante: float):
+        self.proximo = max(self.proximo, instante) + self.intervalo
+
+    def bloquear_ate(self, instante: float):
+        self.proximo = max(self.proximo, instante + self.tolerancia)
+
+
+# Agenda as chamadas de saída ao Telegram respeitando o limite global do bot
+# e o limite por chat. Cada chamada reserva primeiro o horário do seu chat e
+# só quando ele chega toma o próximo horário global, então um chat contido
+# pelo próprio limite (ou adiado por um 429) não empurra a fila dos outros.
+# Um 429 adia só o chat pelo retry_after e a chamada é refeita.
+# A ordem dentro de um chat já é garantida por quem chama (pool por usuário
+# ou trava assíncrona), então não há uma thread despachante.
+class AgendadorEnvios:
+    def __init__(
+        self,
+        taxa_global: float = 30.0,
+        taxa_por_chat: float = 1.0,
+        rajada_por_chat: int = 3,
+        tentativas_maximas: int = 5
+    ):
+        self.taxa_por_chat = taxa_por_chat
+        self.rajada_por_chat = rajada_por_chat
+        self.tentativas_maximas = tentativas_maximas
+
+        self._lock = threading.Lock()
+        self._global = BaldeTokens(taxa_global, int(taxa_global))
+        self._chats: Dict[Any, BaldeTokens] = {}
+        self._ultima_limpeza = 0.0
+
+        self.em_espera = 0
+        self.maior_espera = 0
+        self.enviados = 0
+        self.repetidos_429 = 0
+        self.falhas = 0
+
+    def _balde_chat(self, chat_id) -> BaldeTokens:
+        balde = self._chats.get(chat_id)
+        if balde is None:
+            balde = BaldeTokens(self.taxa_por_chat, self.rajada_por_chat)
+            self._chats[chat_id] = balde
+        return balde
+
+    def _limpar_chats(self, agora: float):
+        # Baldes cujo horário já passou equivalem a baldes novos
+        if agora - self._ultima_limpeza < 60:
+            return
+        self._ultima_limpeza = agora
+        for chat_id in [c for c, b in self._chats.items() if b.proximo < agora]:
+            del self._chats[chat_id]
+
+    # Devolve quantos segundos esperar até o horário reservado no chat
+    def reservar(self, chat_id) -> float:
+        with self._lock:
+            agora = time.monotonic()
+            self._limpar_chats(agora)
+            balde_chat = self._balde_chat(chat_id)
+            instante = balde_chat.liberado_em(agora)
+            balde_chat.consumir(instante)
+            return instante - agora
+
+    # Chamado quando o horário do chat chega: devolve quantos segundos
+    # esperar pelo primeiro horário global livre a partir de agora
+    def reservar_global(self) -> float:
+        with self._lock:
+            agora = time.monotonic()
+            instante = self._global.liberado_em(agora)
+            self._global.consumir(instante)
+            return instante - agora
+
+    def adiar_chat(self, chat_id, segundos: float):
+        with self._lock:
+            self._balde_chat(chat_id).bloquear_ate(time.monotonic() + segundos)
+
+    def _entrar_fila(self):
+        with self._lock:
+            self.em_espera += 1
+            self.maior_espera = max(self.maior_espera, self.em_espera)
+
+    def _sair_fila(self, enviado: bool):
+        with self._lock:
+            self.em_espera -= 1
+            if enviado:
+                self.enviados += 1
+            else:
+                self.falhas += 1
+        if not enviado:
+            tempos.incrementar('erros', origem='telegram')
+
+    def _tratar_429(self, chat_id, erro, tentativa: int, repetir_429: bool) -> bool:
+        espera = tempo_espera_telegram(erro)
+        if espera is None:
+            return False
+        tempos.incrementar('telegram.respostas_429')
+        self.adiar_chat(chat_id, espera)
+        if not repetir_429 or tentativa >= self.tentativas_maximas:
+            return False
+        with self._lock:
+            self.repetidos_429 += 1
+        logger.warning(f"Telegram pediu {espera:g}s de espera no chat {chat_id}; reenviando")
+        return True
+
+    # repetir_429=False devolve o 429 a quem chamou (ex.: edições
+    # intermediárias de uma transmissão, que podem ser puladas)
+    def executar(self, chat_id, funcao: Callable, *args, repetir_429: bool = True, **kwargs):
+        inicio = time.perf_counter()
+        self._entrar_fila()
+        enviado = False
+        try:
+            tentativa = 0
+            while True:
+                tentativa += 1
+                espera = self.reservar(chat_id)
+                if espera > 0:
+                    time.sleep(espera)
+                espera = self.reservar_global()
+                if espera > 0:
+                    time.sleep(espera)
+                try:
+                    with tempos.medir(f"telegram.{getattr(funcao, '__name__', 'chamada')}"):
+                        resultado = funcao(*args, **kwargs)
+                    enviado = True
+                    return resultado
+                except Exception as e:
+                    if not self._tratar_429(chat_id, e, tentativa, repetir_429):
+                        raise
+        finally:
+            self._sair_fila(enviado)
+            tempos.registrar('envio.latencia', time.perf_counter() - inicio)
+
+    async def executar_async(self, chat_id, funcao: Callable, *args, repetir_429: bool = True, **kwargs):
+        inicio = time.perf_counter()
+        self._entrar_fila()
+        enviado = False
+        try:
+            tentativa = 0
+            while True:
+                tentativa += 1
+                espera = self.reservar(chat_id)
+                if espera > 0:
+                    await asyncio.sleep(espera)
+                espera = self.reservar_global()
+                if espera > 0:
+                    await asyncio.sleep(espera)
+                try:
+                    with tempos.medir(f"telegram.{getattr(funcao, '__name__', 'chamada')}"):
+                        resultado = await funcao(*args, **kwargs)
+                    enviado = True
+                    return resultado
+                except Exception as e:
+                    if not self._tratar_429(chat_id, e, tentativa, repetir_429):
+                        raise
+        finally:
+            self._sair_fila(enviado)
+            tempos.registrar('envio.latencia', time.perf_counter() - inicio)
+
+    def metricas(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'em_espera': self.em_espera,
+                'maior_espera': self.maior_espera,
+                'chats_ativos': len(self._chats),
+                'enviados': self.enviados,
+                'repetidos_429': self.repetidos_429,
+                'falhas': self.falhas,
+            }
@@ -0,0 +1,302 @@
+import re
+import time
+import logging
+import threading
+import unicodedata
+from collections import Counter
+from typing import Dict, Set, List, Optional, Any
+
+from google.cloud import firestore
+
+logger = logging.getLogger(__name__)
+
+MARCAS_CONHECIDAS = {
+    'linde', 'toyota', 'hyster', 'yale', 'still', 'jungheinrich', 'crown',
+    'clark', 'komatsu', 'mitsubishi', 'hangcha', 'heli', 'paletrans', 'skam',
+    'retrak', 'byd', 'doosan', 'caterpillar', 'cat', 'nissan', 'tcm', 'nacco',
+    'unicarriers', 'baoli', 'manitou', 'cesab', 'bt', 'raymond', 'ep'
+}
+
+# Descrições de tipo que os técnicos costumam digitar junto com o modelo
+TERMOS_GENERICOS = {
+    'empilhadeira', 'empilhadeiras', 'transpaleteira', 'transpaleteiras',
+    'paleteira', 'paleteiras', 'rebocador', 'retratil', 'selecionadora',
+    'eletrica', 'eletrico', 'manual', 'combustao', 'gas', 'glp', 'diesel',
+    'modelo', 'marca', 'versao', 'ano', 'serie', 'equipamento',
+    'de', 'da', 'do', 'com', 'e', 'a', 'o'
+}
+
+PADRAO_ANO = re.compile(r'^(19[5-9]\d|20\d\d)$')
+
+# Limite de operações por batch do Firestore
+LIMITE_LOTE_FIRESTORE = 500
+
+
+def _normalizar(texto: str) -> str:
+    texto = unicodedata.normalize('NFKD', (texto or '').lower())
+    texto = ''.join(c for c in texto if not unicodedata.combining(c))
+    return re.sub(r'[^a-z0-9]+', ' ', texto).strip()
+
+
+def _trigramas(texto: str) -> Set[str]:
+    delimitado = f'  {texto} '
+    return {delimitado[i:i + 3] for i in range(len(delimitado) - 2)}
+
+
+def decompor_equipamento(texto: str) -> Dict[str, Any]:
+    marca = None
+    ano = None
+    modelo = []
+
+    for token in _normalizar(texto).split():
+        if PADRAO_ANO.match(token):
+            ano = token
+        elif marca is None and token in MARCAS_CONHECIDAS:
+            marca = token
+        elif token not in TERMOS_GENERICOS:
+            modelo.append(token)
+
+    return {'marca': marca, 'modelo': modelo, 'ano': ano}
+
+
+def _chave_canonica(partes: Dict[str, Any]) -> str:
+    # O modelo é compactado para que "T-20 SP", "t20 sp" e "T20SP" coincidam
+    compacto = ''.join(partes['modelo'])
+    return f"{partes['marca'] or ''} {compacto}".strip()
+
+
+def _codigos_compativeis(compacto1: str, compacto2: str) -> bool:
+    # Códigos com dígitos (t20, 8fbe25...) não toleram aproximação: um precisa
+    # ser prefixo do outro sem cortar um número ("t20" ~ "t20sp", mas não "t200")
+    if not any(c.isdigit() for c in compacto1 + compacto2):
+        return True
+    curto, longo = sorted((compacto1, compacto2), key=len)
+    if not curto or not longo.startswith(curto):
+        return False
+    return len(longo) == len(curto) or not (curto[-1].isdigit() and longo[len(curto)].isdigit())
+
+
+# Registro de equipamentos canônicos. Resolve o texto livre digitado pelo
+# técnico para um ID estável usando marca/modelo normalizados e um índice
+# invertido de trigramas. A resolução só consulta a memória: modelos e
+# variantes novos entram numa fila que uma thread grava no Firestore em
+# batches, a cada janela de alguns segundos.
+class RegistroEquipamentos:
+    COLECAO = 'equipamentos'
+
+    def __init__(self, firestore_client=None, limiar_similaridade: float = 0.7,
+                 janela: float = 2.0, espera_maxima_erro: float = 60.0):
+        self.db = firestore_client
+        self.limiar_similaridade = limiar_similaridade
+        self.janela = janela
+        self.espera_maxima_erro = espera_maxima_erro
+
+        self._lock = threading.RLock()
+        self._canonicos: Dict[str, Dict[str, Any]] = {}
+        self._trigramas: Dict[str, Set[str]] = {}
+        self._resolvidos: Dict[str, str] = {}
+
+        # equipamento_id -> {'novo': bool, 'variantes': [...]} ainda não gravados
+        self._pendentes: Dict[str, Dict[str, Any]] = {}
+        self._primeiro_pendente: Optional[float] = None
+        self._condicao = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._encerrando = False
+        self.gravados = 0
+        self.falhas = 0
+
+    def __len__(self):
+        return len(self._canonicos)
+
+    def carregar(self):
+        if self.db is None:
+            return 0
+        for doc in self.db.collection(self.COLECAO).stream():
+            dados = doc.to_dict()
+            self._indexar(doc.id, dados.get('marca'), dados.get('modelo', []))
+            for variante in dados.get('variantes', []):
+                self._resolvidos[_normalizar(variante)] = doc.id
+        logger.info(f"Registro de equipamentos carregado com {len(self._canonicos)} modelos")
+        return len(self._canonicos)
+
+    def _indexar(self, equipamento_id: str, marca: Optional[str], modelo: List[str]):
+        chave = _chave_canonica({'marca': marca, 'modelo': modelo})
+        self._canonicos[equipamento_id] = {
+            'marca': marca,
+            'modelo': list(modelo),
+            'chave': chave,
+            'trigramas': _trigramas(chave),
+            'compacto': ''.join(modelo),
+        }
+        self._resolvidos[chave] = equipamento_id
+        for trigrama in self._canonicos[equipamento_id]['trigramas']:
+            self._trigramas.setdefault(trigrama, set()).add(equipamento_id)
+
+    def _melhor_candidato(self, partes: Dict[str, Any], chave: str) -> Optional[str]:
+        trigramas = _trigramas(chave)
+        contagem = Counter()
+        for trigrama in trigramas:
+            for equipamento_id in self._trigramas.get(trigrama, ()):
+                contagem[equipamento_id] += 1
+
+        compacto = ''.join(partes['modelo'])
+        melhor_id, melhor_score = None, 0.0
+        for equipamento_id, comuns in contagem.items():
+            candidato = self._canonicos[equipamento_id]
+            if partes['marca'] and candidato['marca'] and partes['marca'] != candidato['marca']:
+                continue
+            if not _codigos_compativeis(compacto, candidato['compacto']):
+                continue
+
+            score = 2 * comuns / (len(trigramas) + len(candidato['trigramas']))
+            if score > melhor_score:
+                melhor_id, melhor_score = equipamento_id, score
+
+        if melhor_score >= self.limiar_similaridade:
+            return melhor_id
+        return None
+
+    def resolver(self, texto: str, registrar: bool = True) -> Optional[str]:
+        normalizado = _normalizar(texto)
+        if not normalizado:
+            return None
+
+        with self._lock:
+            equipamento_id = self._resolvidos.get(normalizado)
+            if equipamento_id:
+                return equipamento_id
+
+            partes = decompor_equipamento(texto)
+            chave = _chave_canonica(partes)
+            if not chave:
+                return None
+
+            equipamento_id = self._resolvidos.get(chave) or self._melhor_candidato(partes, chave)
+            novo = equipamento_id is None
+            if novo:
+                if not registrar:
+                    return None
+                equipamento_id = chave.replace(' ', '-')
+                self._indexar(equipamento_id, partes['marca'], partes['modelo'])
+
+            self._resolvidos[normalizado] = equipamento_id
+
+        if registrar:
+            self._agendar(equipamento_id, texto, novo)
+        return equipamento_id
+
+    def _agendar(self, equipamento_id: str, variante: str, novo: bool):
+        if self.db is None:
+            return
+        with self._condicao:
+            if self._encerrando:
+                return
+            if not self._pendentes:
+                self._primeiro_pendente = time.monotonic()
+            pendente = self._pendentes.setdefault(equipamento_id, {'novo': False, 'variantes': []})
+            pendente['novo'] = pendente['novo'] or novo
+            if variante not in pendente['variantes']:
+                pendente['variantes'].append(variante)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._executar, name='equipamentos', daemon=True)
+                self._thread.start()
+            if len(self._pendentes) >= LIMITE_LOTE_FIRESTORE:
+                self._condicao.notify()
+
+    def _proximo_lote(self) -> Optional[Dict[str, Dict[str, Any]]]:
+        with self._condicao:
+            while True:
+                if self._pendentes:
+                    if self._encerrando or len(self._pendentes) >= LIMITE_LOTE_FIRESTORE:
+                        break
+                    restante = self._primeiro_pendente + self.janela - time.monotonic()
+                    if restante <= 0:
+                        break
+                    self._condicao.wait(restante)
+                elif self._encerrando:
+                    return None
+                else:
+                    self._condicao.wait()
+
+            lote, self._pendentes = self._pendentes, {}
+            self._primeiro_pendente = None
+            return lote
+
+    def _gravar_lote(self, lote: Dict[str, Dict[str, Any]]):
+        colecao = self.db.collection(self.COLECAO)
+        itens = list(lote.items())
+        for inicio in range(0, len(itens), LIMITE_LOTE_FIRESTORE):
+            batch = self.db.batch()
+            for equipamento_id, pendente in itens[inicio:inicio + LIMITE_LOTE_FIRESTORE]:
+                doc_ref = colecao.document(equipamento_id)
+                if pendente['novo']:
+                    canonico = self._canonicos[equipamento_id]
+                    batch.set(doc_ref, {
+                        'marca': canonico['marca'],
+                        'modelo': canonico['modelo'],
+                        'variantes': pendente['variantes'],
+                        'criado_em': firestore.SERVER_TIMESTAMP
+                    })
+                else:
+                    batch.update(doc_ref, {'variantes': firestore.ArrayUnion(pendente['variantes'])})
+            batch.commit()
+            # Os já gravados não voltam para a fila se um batch seguinte falhar
+            for equipamento_id, _ in itens[inicio:inicio + LIMITE_LOTE_FIRESTORE]:
+                del lote[equipamento_id]
+
+    def _devolver(self, lote: Dict[str, Dict[str, Any]]):
+        with self._condicao:
+            self._primeiro_pendente = time.monotonic()
+            for equipamento_id, pendente in lote.items():
+                atual = self._pendentes.setdefault(equipamento_id, {'novo': False, 'variantes': []})
+                atual['novo'] = atual['novo'] or pendente['novo']
+                atual['variantes'] = pendente['variantes'] + [
+                    v for v in atual['variantes'] if v not in pendente['variantes']
+                ]
+
+    def _executar(self):
+        espera = 1.0
+        while True:
+            lote = self._proximo_lote()
+            if lote is None:
+                break
+            quantidade = len(lote)
+            try:
+                self._gravar_lote(lote)
+            except Exception as e:
+                self._devolver(lote)
+                with self._condicao:
+                    self.gravados += quantidade - len(lote)
+                    self.falhas += 1
+                    desistir = self._encerrando
+                logger.error(f"Erro ao persistir {len(lote)} equipamentos: {e}")
+                if desistir:
+                    break
+                time.sleep(espera)
+                espera = min(espera * 2, self.espera_maxima_erro)
+                continue
+            espera = 1.0
+            with self._condicao:
+                self.gravados += quantidade
+
+    def metricas(self) -> Dict[str, Any]:
+        with self._condicao:
+            return {
+                'modelos': len(self._canonicos),
+                'pendentes': len(self._pendentes),
+                'gravados': self.gravados,
+                'falhas': self.falhas,
+            }
+
+    # Grava o que estiver pendente e encerra a thread
+    def encerrar(self, tempo_limite: float = 30.0):
+        with self._condicao:
+            self._encerrando = True
+            self._condicao.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join(tempo_limite)
+            if thread.is_alive():
+                logger.warning("Gravação de equipamentos não terminou no prazo")
+        if self._pendentes:
+            logger.warning(f"{len(self._pendentes)} equipamentos não foram gravados no Firestore")
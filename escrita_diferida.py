@@ -0,0 +1,194 @@
+import os
+import json
+import time
+import logging
+import threading
+from typing import Any, Dict, List, Optional
+
+from google.cloud import firestore
+
+logger = logging.getLogger(__name__)
+
+# Limite de operações por batch do Firestore
+LIMITE_LOTE_FIRESTORE = 500
+
+
+# Fila de gravação em segundo plano para a coleção de manutenções. Cada
+# registro recebe um ID gerado no cliente e vai para um diário local
+# (append-only) antes de ser confirmado ao chamador; uma thread agrupa os
+# pendentes em batches do Firestore, por tamanho ou por janela de tempo.
+# Como o set() com ID fixo é idempotente, reenviar o diário após uma queda
+# não duplica registros.
+class EscritaDiferida:
+    def __init__(
+        self,
+        firestore_client,
+        caminho_diario: str = 'manutencoes_pendentes.jsonl',
+        colecao: str = 'manutencoes',
+        tamanho_lote: int = LIMITE_LOTE_FIRESTORE,
+        janela: float = 2.0,
+        espera_maxima_erro: float = 60.0
+    ):
+        self.db = firestore_client
+        self.caminho_diario = caminho_diario
+        self.colecao = colecao
+        self.tamanho_lote = min(tamanho_lote, LIMITE_LOTE_FIRESTORE)
+        self.janela = janela
+        self.espera_maxima_erro = espera_maxima_erro
+
+        self._pendentes: List[Dict[str, Any]] = []
+        self._primeiro_pendente: Optional[float] = None
+        self._em_voo = 0
+        self._condicao = threading.Condition()
+        self._encerrando = False
+
+        self.gravados = 0
+        self.lotes = 0
+        self.falhas = 0
+        self.maior_lote = 0
+        self.recuperados = 0
+
+        self._recuperar_diario()
+        self._diario = open(caminho_diario, 'a', encoding='utf-8')
+        self._thread = threading.Thread(target=self._executar, name='escrita-diferida', daemon=True)
+        self._thread.start()
+
+    def _recuperar_diario(self):
+        if not os.path.exists(self.caminho_diario):
+            return
+        with open(self.caminho_diario, encoding='utf-8') as arquivo:
+            for numero, linha in enumerate(arquivo, 1):
+                linha = linha.strip()
+                if not linha:
+                    continue
+                try:
+                    self._pendentes.append(json.loads(linha))
+                except json.JSONDecodeError:
+                    # Uma linha truncada só pode ser a última, escrita durante a queda
+                    logger.warning(f"Linha {numero} do diário de escrita ilegível; ignorada")
+        if self._pendentes:
+            self.recuperados = len(self._pendentes)
+            self._primeiro_pendente = time.monotonic()
+            logger.info(f"{self.recuperados} manutenções pendentes recuperadas do diário")
+
+    # Registra a manutenção no diário e devolve o ID do documento sem
+    # esperar o Firestore
+    def enfileirar(self, dados: Dict[str, Any]) -> str:
+        doc_id = self.db.collection(self.colecao).document().id
+        registro = {'id': doc_id, 'dados': dados}
+        linha = json.dumps(registro, ensure_ascii=False) + '\n'
+
+        with self._condicao:
+            if self._encerrando:
+                raise RuntimeError("Escrita diferida encerrada")
+            self._diario.write(linha)
+            self._diario.flush()
+            os.fsync(self._diario.fileno())
+
+            self._pendentes.append(registro)
+            if self._primeiro_pendente is None:
+                self._primeiro_pendente = time.monotonic()
+            if len(self._pendentes) >= self.tamanho_lote:
+                self._condicao.notify()
+        return doc_id
+
+    def _proximo_lote(self) -> Optional[List[Dict[str, Any]]]:
+        with self._condicao:
+            while True:
+                if self._pendentes:
+                    if self._encerrando or len(self._pendentes) >= self.tamanho_lote:
+                        break
+                    restante = self._primeiro_pendente + self.janela - time.monotonic()
+                    if restante <= 0:
+                        break
+                    self._condicao.wait(restante)
+                elif self._encerrando:
+                    return None
+                else:
+                    self._condicao.wait()
+
+            lote = self._pendentes[:self.tamanho_lote]
+            self._em_voo = len(lote)
+            return lote
+
+    def _gravar_lote(self, lote: List[Dict[str, Any]]):
+        batch = self.db.batch()
+        colecao = self.db.collection(self.colecao)
+        for registro in lote:
+            batch.set(
+                colecao.document(registro['id']),
+                {**registro['dados'], 'data': firestore.SERVER_TIMESTAMP}
+            )
+        batch.commit()
+
+    def _confirmar(self, quantidade: int):
+        with self._condicao:
+            del self._pendentes[:quantidade]
+            self._em_voo = 0
+            self._primeiro_pendente = time.monotonic() if self._pendentes else None
+
+            # O diário passa a conter só o que ainda não foi gravado
+            temporario = self.caminho_diario + '.tmp'
+            with open(temporario, 'w', encoding='utf-8') as arquivo:
+                for registro in self._pendentes:
+                    arquivo.write(json.dumps(registro, ensure_ascii=False) + '\n')
+                arquivo.flush()
+                os.fsync(arquivo.fileno())
+            self._diario.close()
+            os.replace(temporario, self.caminho_diario)
+            self._diario = open(self.caminho_diario, 'a', encoding='utf-8')
+
+            self.gravados += quantidade
+            self.lotes += 1
+            self.maior_lote = max(self.maior_lote, quantidade)
+
+    def _executar(self):
+        espera = 1.0
+        while True:
+            lote = self._proximo_lote()
+            if lote is None:
+                break
+            try:
+                self._gravar_lote(lote)
+            except Exception as e:
+                with self._condicao:
+                    self.falhas += 1
+                    self._em_voo = 0
+                    desistir = self._encerrando
+                logger.error(f"Erro ao gravar lote de {len(lote)} manutenções: {e}")
+                if desistir:
+                    # Os registros continuam no diário e serão reenviados no próximo início
+                    break
+                time.sleep(espera)
+                espera = min(espera * 2, self.espera_maxima_erro)
+                continue
+
+            espera = 1.0
+            self._confirmar(len(lote))
+            logger.info(f"Lote de {len(lote)} manutenções gravado no Firestore")
+
+    def metricas(self) -> Dict[str, Any]:
+        with self._condicao:
+            return {
+                'pendentes': len(self._pendentes),
+                'em_voo': self._em_voo,
+                'gravados': self.gravados,
+                'lotes': self.lotes,
+                'maior_lote': self.maior_lote,
+                'falhas': self.falhas,
+                'recuperados': self.recuperados,
+            }
+
+    # Grava o que estiver pendente e encerra a thread
+    def encerrar(self, tempo_limite: float = 30.0):
+        with self._condicao:
+            if self._encerrando:
+                return
+            self._encerrando = True
+            self._condicao.notify()
+        self._thread.join(tempo_limite)
+        if self._thread.is_alive():
+            logger.warning("Escrita diferida não terminou no prazo; pendentes ficam no diário")
+            return
+        with self._condicao:
+            self._diario.close()
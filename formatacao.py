@@ -0,0 +1,219 @@
+import re
+import html
+import logging
+from typing import Dict, List
+
+from metricas import tempos
+
+logger = logging.getLogger(__name__)
+
+# Tags que o Telegram aceita no parse_mode HTML e que o modelo costuma emitir
+TAGS_PERMITIDAS = ('b', 'i', 'u', 'code', 'pre')
+
+RODAPE = '<i>🚨 RELATÓRIO GERADO POR SISTEMA DE DIAGNÓSTICO AUTOMATIZADO</i>'
+
+_TAG = rf"<(/?)({'|'.join(TAGS_PERMITIDAS)})>"
+_PADRAO_TAG = re.compile(_TAG)
+_PADRAO_TAG_ESCAPADA = re.compile(rf"&lt;(/?)({'|'.join(TAGS_PERMITIDAS)})&gt;")
+_PADRAO_NUMERADO = re.compile(r'\d+\.')
+
+# Tokens de uma linha já sanitizada: tag, entidade ou trecho de texto
+_PADRAO_TOKENS = re.compile(rf'{_TAG}|&#?\w+;|[^<&]+|[<&]')
+
+
+class _PilhaTags:
+    # Mantém as tags abertas e devolve o HTML que mantém o aninhamento
+    # válido: fechamentos sem abertura são descartados e fechamentos fora de
+    # ordem fecham antes as tags internas. Com achatar=True, uma tag aberta
+    # dentro de outra igual é descartada junto com o seu fechamento, o que
+    # limita a pilha às tags distintas (<b><b>x</b></b> aparece como <b>x</b>)
+    def __init__(self, achatar: bool = False):
+        self.abertas: List[str] = []
+        self.achatar = achatar
+        self.repetidas: Dict[str, int] = {}
+
+    def abrir(self, tag: str) -> str:
+        if self.achatar and tag in self.abertas:
+            self.repetidas[tag] = self.repetidas.get(tag, 0) + 1
+            return ''
+        self.abertas.append(tag)
+        return f'<{tag}>'
+
+    def fechar(self, tag: str) -> str:
+        if self.repetidas.get(tag):
+            self.repetidas[tag] -= 1
+            return ''
+        if tag not in self.abertas:
+            return ''
+        fechamentos = []
+        while True:
+            aberta = self.abertas.pop()
+            fechamentos.append(f'</{aberta}>')
+            if aberta == tag:
+                return ''.join(fechamentos)
+
+    def aplicar(self, match) -> str:
+        tag = match.group(2)
+        return self.fechar(tag) if match.group(1) else self.abrir(tag)
+
+    def fechamentos(self) -> str:
+        return ''.join(f'</{tag}>' for tag in reversed(self.abertas))
+
+    def reaberturas(self) -> str:
+        return ''.join(f'<{tag}>' for tag in self.abertas)
+
+
+# Maior custo de reabrir e fechar uma pilha achatada (todas as tags distintas)
+_CUSTO_MAXIMO_PILHA = sum(2 * len(tag) + 5 for tag in TAGS_PERMITIDAS)
+
+
+# Linhas só com tags não contam como conteúdo: o Telegram recusa mensagens vazias
+def _tem_texto(linha: str) -> bool:
+    if not linha or linha.isspace():
+        return False
+    return linha[0] != '<' or bool(_PADRAO_TAG.sub('', linha).strip())
+
+
+# Formata a resposta do modelo para o Telegram: uma passada classifica as
+# linhas (lista, procedimento numerado, texto) e monta os parágrafos; depois
+# o texto é escapado de uma vez e um único regex restaura as tags
+# permitidas, já equilibrando aberturas e fechamentos
+@tempos.cronometrar('formatacao.sanitizar_html')
+def sanitizar_html(texto):
+    try:
+        partes = []
+        bloco_vazio = True
+        apos_lista = False
+
+        for linha in texto.replace('**', '').split('\n'):
+            linha = linha.strip()
+
+            # Linha vazia encerra o bloco (parágrafo) atual
+            if not linha:
+                bloco_vazio = True
+                continue
+
+            if linha[0] in '*-•':
+                linha = f"🔹 {linha.lstrip('*-•').strip()}"
+                apos_lista = True
+            elif _PADRAO_NUMERADO.match(linha):
+                apos_lista = True
+            elif apos_lista:
+                # Texto comum depois de uma lista ou procedimento abre outro bloco
+                bloco_vazio = True
+                apos_lista = False
+
+            if partes:
+                partes.append('\n\n' if bloco_vazio else '\n')
+            bloco_vazio = False
+            partes.append(linha)
+
+        pilha = _PilhaTags()
+        texto_final = _PADRAO_TAG_ESCAPADA.sub(pilha.aplicar, html.escape(''.join(partes), quote=False))
+        return f"{texto_final}{pilha.fechamentos()}\n\n{RODAPE}"
+
+    except Exception as e:
+        logger.error(f"Erro na sanitização HTML: {e}")
+        return "Erro ao processar resposta técnica."
+
+
+# Divide um texto HTML em mensagens de até max_length caracteres, cortando
+# em quebras de linha. Tags abertas no ponto de corte são fechadas no fim de
+# uma mensagem e reabertas no início da seguinte, então cada mensagem é
+# aceita isoladamente pelo Telegram. Só linhas com tags são tokenizadas, e
+# só uma linha maior que a mensagem é cortada no meio (em um espaço).
+# Tags repetidas dentro de si mesmas são achatadas, então o prefixo reaberto
+# nunca passa de _CUSTO_MAXIMO_PILHA; se nem isso cabe em metade da
+# mensagem, as tags são removidas e o texto é cortado como texto puro. Assim
+# cada mensagem sempre avança no texto.
+@tempos.cronometrar('formatacao.dividir_mensagem')
+def dividir_mensagem(texto, max_length=4000):
+    pilha = _PilhaTags(achatar=True)
+
+    # Caso comum: o diagnóstico inteiro cabe em uma mensagem
+    if len(texto) <= max_length and '<' in texto:
+        equilibrado = _PADRAO_TAG.sub(pilha.aplicar, texto) + pilha.fechamentos()
+        if len(equilibrado) <= max_length:
+            return [equilibrado.strip()] if _tem_texto(equilibrado.strip()) else []
+        pilha = _PilhaTags(achatar=True)
+    elif len(texto) <= max_length:
+        return [texto.strip()] if texto.strip() else []
+
+    if _CUSTO_MAXIMO_PILHA > max_length // 2 and '<' in texto:
+        texto = _PADRAO_TAG.sub('', texto)
+
+    mensagens = []
+    atual: List[str] = []
+    tamanho = 0
+    tem_texto = False
+
+    def fechar_mensagem():
+        nonlocal atual, tamanho, tem_texto
+        corpo = ''.join(atual).strip()
+        if tem_texto and corpo:
+            mensagens.append(corpo + pilha.fechamentos())
+        prefixo = pilha.reaberturas()
+        atual = [prefixo] if prefixo else []
+        tamanho = len(prefixo)
+        tem_texto = False
+
+    # Tamanho dos fechamentos das tags abertas, recalculado só em linhas com tags
+    fechamentos = 0
+    for linha in texto.split('\n'):
+        abertas_antes, repetidas_antes = pilha.abertas, pilha.repetidas
+        if '<' in linha:
+            pilha.abertas = list(abertas_antes)
+            pilha.repetidas = dict(repetidas_antes)
+            linha = _PADRAO_TAG.sub(pilha.aplicar, linha)
+            fechamentos = len(pilha.fechamentos())
+        custo = len(linha) + 1 if tem_texto else len(linha)
+
+        if tem_texto and tamanho + custo + fechamentos > max_length:
+            # Fecha a mensagem com as tags abertas antes desta linha
+            abertas_depois, pilha.abertas = pilha.abertas, abertas_antes
+            fechar_mensagem()
+            pilha.abertas = abertas_depois
+            custo = len(linha)
+
+        if tamanho + custo + fechamentos <= max_length:
+            if tem_texto:
+                atual.append('\n')
+            atual.append(linha)
+            tamanho += custo
+            tem_texto = tem_texto or _tem_texto(linha)
+            continue
+
+        # Linha maior que uma mensagem inteira: refaz a linha token a token
+        pilha.abertas = list(abertas_antes)
+        pilha.repetidas = dict(repetidas_antes)
+        for match in _PADRAO_TOKENS.finditer(linha):
+            token = match.group(0)
+            if match.group(2) is not None:
+                if not match.group(1) and tamanho + 2 * len(token) + 1 + len(pilha.fechamentos()) > max_length:
+                    fechar_mensagem()
+                token = pilha.aplicar(match)
+                atual.append(token)
+                tamanho += len(token)
+                continue
+            while token:
+                disponivel = max_length - tamanho - len(pilha.fechamentos())
+                if len(token) <= disponivel or token[0] == '&' and not tem_texto:
+                    atual.append(token)
+                    tamanho += len(token)
+                    tem_texto = tem_texto or not token.isspace()
+                    break
+                if tem_texto and (token[0] == '&' or token.rfind(' ', 0, disponivel) <= 0):
+                    fechar_mensagem()
+                    continue
+                corte = token.rfind(' ', 0, disponivel)
+                if corte <= 0:
+                    corte = disponivel
+                atual.append(token[:corte])
+                tamanho += corte
+                tem_texto = True
+                token = token[corte:].lstrip(' ')
+                fechar_mensagem()
+        fechamentos = len(pilha.fechamentos())
+
+    fechar_mensagem()
+    return mensagens
@@ -0,0 +1,423 @@
+import time
+import asyncio
+import logging
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FuturoTimeoutError
+from typing import Any, Callable, Dict, List, Optional
+
+from google.api_core import exceptions as erros_google
+
+logger = logging.getLogger(__name__)
+
+# Erros causados pela requisição, não pelo modelo: trocar de modelo não ajuda
+ERROS_DA_REQUISICAO = (erros_google.InvalidArgument, erros_google.FailedPrecondition)
+
+
+class SemModeloDisponivel(RuntimeError):
+    pass
+
+
+# Disjuntor por modelo: abre após falhas consecutivas, fica aberto por um
+# tempo que dobra a cada reabertura e então libera uma única chamada de teste.
+# Um teste sem veredito até prazo_teste (chamada perdida) libera outro.
+class DisjuntorModelo:
+    def __init__(self, limiar_falhas: int = 3, tempo_abertura: float = 30.0,
+                 tempo_abertura_maximo: float = 600.0, prazo_teste: float = 120.0):
+        self.limiar_falhas = limiar_falhas
+        self.tempo_abertura_base = tempo_abertura
+        self.tempo_abertura_maximo = tempo_abertura_maximo
+        self.prazo_teste = prazo_teste
+
+        self.estado = 'fechado'
+        self.falhas = 0
+        self.tempo_abertura = tempo_abertura
+        self.reabre_em = 0.0
+        self.teste_expira_em = 0.0
+
+    def permitir(self, agora: float) -> bool:
+        if self.estado == 'fechado':
+            return True
+        if (self.estado == 'aberto' and agora >= self.reabre_em) or \
+                (self.estado == 'meio_aberto' and agora >= self.teste_expira_em):
+            self.estado = 'meio_aberto'
+            self.teste_expira_em = agora + self.prazo_teste
+            return True
+        return False
+
+    def sucesso(self):
+        self.estado = 'fechado'
+        self.falhas = 0
+        self.tempo_abertura = self.tempo_abertura_base
+
+    def falha(self, agora: float):
+        if self.estado == 'meio_aberto':
+            self.tempo_abertura = min(self.tempo_abertura * 2, self.tempo_abertura_maximo)
+            self.abrir(agora)
+            return
+        self.falhas += 1
+        if self.falhas >= self.limiar_falhas:
+            self.abrir(agora)
+
+    def abrir(self, agora: float):
+        self.estado = 'aberto'
+        self.reabre_em = agora + self.tempo_abertura
+
+    # A chamada foi abandonada (consumidor parou de ler, tarefa cancelada)
+    # sem veredito: um teste em curso volta a aberto, sem dobrar o tempo
+    def interromper(self, agora: float):
+        if self.estado == 'meio_aberto':
+            self.abrir(agora)
+
+
+# Envolve o GenerativeModel com a mesma interface (generate_content,
+# generate_content_async e count_tokens). Limita as chamadas simultâneas e
+# percorre os modelos na ordem de preferência, pulando os que estão com o
+# disjuntor aberto; quando o preferido se recupera, volta a ser usado sozinho.
+class GovernadorGemini:
+    def __init__(
+        self,
+        modelos: List[str],
+        criar_modelo: Callable[[str], Any],
+        max_em_voo: int = 8,
+        espera_maxima: float = 60.0,
+        limiar_falhas: int = 3,
+        tempo_abertura: float = 30.0,
+        indisponiveis: Optional[List[str]] = None,
+        modelo_hedge: Optional[str] = None,
+        atraso_hedge_inicial: float = 8.0,
+        amostras_minimas_hedge: int = 20
+    ):
+        if not modelos:
+            raise ValueError("É preciso ao menos um modelo")
+        if modelo_hedge is not None and modelo_hedge not in modelos:
+            raise ValueError(f"Modelo de hedge fora da lista: {modelo_hedge}")
+
+        self.nomes = list(modelos)
+        self.max_em_voo = max_em_voo
+        self.espera_maxima = espera_maxima
+
+        self._modelos = {nome: criar_modelo(nome) for nome in self.nomes}
+        self._disjuntores = {
+            nome: DisjuntorModelo(limiar_falhas, tempo_abertura) for nome in self.nomes
+        }
+        self._lock = threading.Lock()
+        self._semaforo = threading.BoundedSemaphore(max_em_voo)
+        self._semaforo_async: Optional[asyncio.Semaphore] = None
+
+        self.em_voo = 0
+        self.chamadas = {nome: 0 for nome in self.nomes}
+        self.falhas = {nome: 0 for nome in self.nomes}
+        self.trocas = 0
+        self.rejeitadas = 0
+        self.modelo_ativo = None
+
+        # Hedge: modelo rápido acionado quando o principal demora além do
+        # percentil das latências recentes
+        self.modelo_hedge = modelo_hedge
+        self.atraso_hedge_inicial = atraso_hedge_inicial
+        self.amostras_minimas_hedge = amostras_minimas_hedge
+        self._latencias = {nome: deque(maxlen=200) for nome in self.nomes}
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self.hedges_disparados = 0
+        self.hedges_vencedores = 0
+
+        # Modelos que falharam na sondagem começam com o disjuntor aberto
+        agora = time.monotonic()
+        for nome in indisponiveis or []:
+            if nome in self._disjuntores:
+                self._disjuntores[nome].abrir(agora)
+
+    # Avaliado um a um: um modelo só passa a meio-aberto quando de fato
+    # vai receber a chamada de teste
+    def _candidatos(self, modelos: Optional[List[str]] = None):
+        for nome in modelos or self.nomes:
+            with self._lock:
+                permitido = self._disjuntores[nome].permitir(time.monotonic())
+            if permitido:
+                yield nome
+
+    # O modelo respondeu, ainda que recusando a requisição: está no ar
+    def _registrar_recusa(self, nome: str):
+        with self._lock:
+            self._disjuntores[nome].sucesso()
+
+    # Chamadas restritas a um modelo (hedge) não mudam o modelo ativo
+    def _registrar_sucesso(self, nome: str, duracao: Optional[float] = None, ativo: bool = True):
+        with self._lock:
+            self._disjuntores[nome].sucesso()
+            self.chamadas[nome] += 1
+            if duracao is not None:
+                self._latencias[nome].append(duracao)
+            if ativo and nome != self.modelo_ativo:
+                if self.modelo_ativo is not None:
+                    self.trocas += 1
+                    retorno = self.nomes.index(nome) < self.nomes.index(self.modelo_ativo)
+                    logger.warning(
+                        f"Gemini: {'retorno' if retorno else 'troca'} de {self.modelo_ativo} para {nome}"
+                    )
+                self.modelo_ativo = nome
+
+    def _registrar_falha(self, nome: str, erro: Exception):
+        with self._lock:
+            disjuntor = self._disjuntores[nome]
+            disjuntor.falha(time.monotonic())
+            self.falhas[nome] += 1
+            estado = disjuntor.estado
+        logger.warning(f"Falha no modelo {nome} (disjuntor {estado}): {erro}")
+
+    def _registrar_interrupcao(self, nome: str):
+        with self._lock:
+            self._disjuntores[nome].interromper(time.monotonic())
+
+    def _sem_modelo(self, ultimo_erro: Optional[Exception]):
+        if ultimo_erro is not None:
+            raise ultimo_erro
+        raise SemModeloDisponivel("Todos os modelos Gemini estão com o disjuntor aberto")
+
+    def _entrar(self):
+        if not self._semaforo.acquire(timeout=self.espera_maxima):
+            with self._lock:
+                self.rejeitadas += 1
+            raise SemModeloDisponivel("Limite de chamadas simultâneas ao Gemini atingido")
+        with self._lock:
+            self.em_voo += 1
+
+    def _sair(self):
+        with self._lock:
+            self.em_voo -= 1
+        self._semaforo.release()
+
+    def generate_content(self, *args, stream: bool = False, modelos: Optional[List[str]] = None, **kwargs):
+        self._entrar()
+        liberar = True
+        try:
+            ultimo_erro = None
+            for nome in self._candidatos(modelos):
+                inicio = time.monotonic()
+                try:
+                    resposta = self._modelos[nome].generate_content(*args, stream=stream, **kwargs)
+                except ERROS_DA_REQUISICAO:
+                    self._registrar_recusa(nome)
+                    raise
+                except Exception as e:
+                    self._registrar_falha(nome, e)
+                    ultimo_erro = e
+                    continue
+                except BaseException:
+                    self._registrar_interrupcao(nome)
+                    raise
+                if not stream:
+                    self._registrar_sucesso(nome, time.monotonic() - inicio, modelos is None)
+                    return resposta
+                # A vaga no limite só é devolvida ao fim da transmissão
+                liberar = False
+                return self._transmitir(nome, resposta, modelos is None)
+            self._sem_modelo(ultimo_erro)
+        finally:
+            if liberar:
+                self._sair()
+
+    def _transmitir(self, nome: str, resposta, ativo: bool):
+        try:
+            for parte in resposta:
+                yield parte
+            self._registrar_sucesso(nome, ativo=ativo)
+        except ERROS_DA_REQUISICAO:
+            self._registrar_recusa(nome)
+            raise
+        except Exception as e:
+            self._registrar_falha(nome, e)
+            raise
+        # GeneratorExit (fechado ou coletado no meio) e cancelamento
+        except BaseException:
+            self._registrar_interrupcao(nome)
+            raise
+        finally:
+            self._sair()
+
+    async def _entrar_async(self):
+        # Criado sob demanda para pertencer ao loop do modo assíncrono
+        if self._semaforo_async is None:
+            self._semaforo_async = asyncio.Semaphore(self.max_em_voo)
+        try:
+            await asyncio.wait_for(self._semaforo_async.acquire(), self.espera_maxima)
+        except asyncio.TimeoutError:
+            with self._lock:
+                self.rejeitadas += 1
+            raise SemModeloDisponivel("Limite de chamadas simultâneas ao Gemini atingido")
+        with self._lock:
+            self.em_voo += 1
+
+    def _sair_async(self):
+        with self._lock:
+            self.em_voo -= 1
+        self._semaforo_async.release()
+
+    async def generate_content_async(
+        self, *args, stream: bool = False, modelos: Optional[List[str]] = None, **kwargs
+    ):
+        await self._entrar_async()
+        liberar = True
+        try:
+            ultimo_erro = None
+            for nome in self._candidatos(modelos):
+                inicio = time.monotonic()
+                try:
+                    resposta = await self._modelos[nome].generate_content_async(
+                        *args, stream=stream, **kwargs
+                    )
+                except ERROS_DA_REQUISICAO:
+                    self._registrar_recusa(nome)
+                    raise
+                except Exception as e:
+                    self._registrar_falha(nome, e)
+                    ultimo_erro = e
+                    continue
+                except BaseException:
+                    self._registrar_interrupcao(nome)
+                    raise
+                if not stream:
+                    self._registrar_sucesso(nome, time.monotonic() - inicio, modelos is None)
+                    return resposta
+                liberar = False
+                return self._transmitir_async(nome, resposta, modelos is None)
+            self._sem_modelo(ultimo_erro)
+        finally:
+            if liberar:
+                self._sair_async()
+
+    async def _transmitir_async(self, nome: str, resposta, ativo: bool):
+        try:
+            async for parte in resposta:
+                yield parte
+            self._registrar_sucesso(nome, ativo=ativo)
+        except ERROS_DA_REQUISICAO:
+            self._registrar_recusa(nome)
+            raise
+        except Exception as e:
+            self._registrar_falha(nome, e)
+            raise
+        # GeneratorExit (fechado ou coletado no meio) e cancelamento
+        except BaseException:
+            self._registrar_interrupcao(nome)
+            raise
+        finally:
+            self._sair_async()
+
+    # Contagem no modelo ativo (ou no preferido). Não ocupa vaga no limite
+    # de chamadas simultâneas, que protege a geração.
+    def count_tokens(self, *args, **kwargs):
+        return self._modelos[self.modelo_ativo or self.nomes[0]].count_tokens(*args, **kwargs)
+
+    def atraso_hedge(self, percentil: float) -> float:
+        with self._lock:
+            amostras = sorted(self._latencias.get(self.modelo_ativo) or ())
+        if len(amostras) < self.amostras_minimas_hedge:
+            return self.atraso_hedge_inicial
+        return amostras[min(len(amostras) - 1, int(round(percentil / 100 * (len(amostras) - 1))))]
+
+    def _hedge_aplicavel(self) -> bool:
+        with self._lock:
+            return self.modelo_hedge is not None and self.modelo_hedge != self.modelo_ativo
+
+    def _registrar_hedge(self, venceu: bool = False):
+        with self._lock:
+            if venceu:
+                self.hedges_vencedores += 1
+            else:
+                self.hedges_disparados += 1
+
+    # Chamada não transmitida com hedge: se o principal não trouxer uma
+    # resposta aceitável até o percentil das latências recentes, o modelo de
+    # hedge é chamado em paralelo e vale a primeira resposta aceitável. Em
+    # threads não há como interromper a chamada perdedora: ela é abandonada e
+    # seu resultado descartado. Sem resposta aceitável, devolve a do principal.
+    def gerar_com_hedge(self, *args, aceitar: Callable[[Any], bool], percentil: float = 95.0, **kwargs):
+        if not self._hedge_aplicavel():
+            return self.generate_content(*args, **kwargs)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.max_em_voo * 2, thread_name_prefix='gemini-hedge')
+
+        # Cada chamada leva uma cópia do contexto de quem pediu: o usuário
+        # cobrado pelo orçamento de tokens e o rastro do update
+        principal = self._executor.submit(
+            contextvars.copy_context().run, self.generate_content, *args, **kwargs
+        )
+        try:
+            resposta = principal.result(timeout=self.atraso_hedge(percentil))
+            if aceitar(resposta):
+                return resposta
+        except FuturoTimeoutError:
+            pass
+        except Exception as e:
+            logger.warning(f"Chamada principal ao Gemini falhou; acionando hedge: {e}")
+
+        self._registrar_hedge()
+        hedge = self._executor.submit(
+            contextvars.copy_context().run, self.generate_content,
+            *args, modelos=[self.modelo_hedge], **kwargs
+        )
+        pendentes = {principal, hedge}
+        while pendentes:
+            concluidos, pendentes = wait(pendentes, return_when=FIRST_COMPLETED)
+            for futuro in concluidos:
+                if futuro.exception() is None and aceitar(futuro.result()):
+                    for perdedor in pendentes:
+                        perdedor.cancel()
+                    if futuro is hedge:
+                        self._registrar_hedge(venceu=True)
+                    return futuro.result()
+        return principal.result()
+
+    async def gerar_com_hedge_async(
+        self, *args, aceitar: Callable[[Any], bool], percentil: float = 95.0, **kwargs
+    ):
+        if not self._hedge_aplicavel():
+            return await self.generate_content_async(*args, **kwargs)
+
+        principal = asyncio.ensure_future(self.generate_content_async(*args, **kwargs))
+        concluidos, _ = await asyncio.wait({principal}, timeout=self.atraso_hedge(percentil))
+        if concluidos and principal.exception() is None and aceitar(principal.result()):
+            return principal.result()
+
+        self._registrar_hedge()
+        hedge = asyncio.ensure_future(
+            self.generate_content_async(*args, modelos=[self.modelo_hedge], **kwargs)
+        )
+        pendentes = {principal, hedge}
+        try:
+            while pendentes:
+                concluidos, pendentes = await asyncio.wait(pendentes, return_when=asyncio.FIRST_COMPLETED)
+                for tarefa in concluidos:
+                    if tarefa.exception() is None and aceitar(tarefa.result()):
+                        if tarefa is hedge:
+                            self._registrar_hedge(venceu=True)
+                        return tarefa.result()
+            return principal.result()
+        finally:
+            for tarefa in (principal, hedge):
+                if not tarefa.done():
+                    tarefa.cancel()
+
+    def metricas(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'modelo_ativo': self.modelo_ativo,
+                'em_voo': self.em_voo,
+                'max_em_voo': self.max_em_voo,
+                'trocas': self.trocas,
+                'rejeitadas': self.rejeitadas,
+                'hedges_disparados': self.hedges_disparados,
+                'hedges_vencedores': self.hedges_vencedores,
+                'modelos': {
+                    nome: {
+                        'disjuntor': self._disjuntores[nome].estado,
+                        'chamadas': self.chamadas[nome],
+                        'falhas': self.falhas[nome],
+                    }
+                    for nome in self.nomes
+                },
+            }
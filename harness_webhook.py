@@ -0,0 +1,134 @@
+import json
+import time
+import argparse
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+# Conversa padrão de um técnico, na ordem do fluxo de atendimento
+ROTEIRO_PADRAO = [
+    '/start',
+    'Transpaleteira elétrica Linde T20 SP - 2022',
+    'A transpaleteira não levanta a carga e faz um ruído na bomba hidráulica',
+    'não',
+    'O defeito era o relé da bomba; troquei o relé e voltou a funcionar',
+    'sim',
+]
+
+
+class GeradorUpdates:
+    def __init__(self, id_inicial: int = 1):
+        self._proximo_id = id_inicial
+        self._lock = threading.Lock()
+
+    def criar(self, user_id: int, texto: str) -> Dict[str, Any]:
+        with self._lock:
+            update_id = self._proximo_id
+            self._proximo_id += 1
+
+        mensagem = {
+            'message_id': update_id,
+            'from': {
+                'id': user_id,
+                'is_bot': False,
+                'first_name': f'Tecnico {user_id}',
+                'username': f'tecnico_{user_id}',
+            },
+            'chat': {'id': user_id, 'type': 'private'},
+            'date': int(time.time()),
+            'text': texto,
+        }
+        if texto.startswith('/'):
+            mensagem['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(texto.split()[0])}]
+        return {'update_id': update_id, 'message': mensagem}
+
+
+def enviar_update(url: str, update: Dict[str, Any], segredo: Optional[str], timeout: float = 10.0):
+    corpo = json.dumps(update).encode('utf-8')
+    requisicao = urllib.request.Request(url, data=corpo, method='POST')
+    requisicao.add_header('Content-Type', 'application/json')
+    if segredo:
+        requisicao.add_header('X-Telegram-Bot-Api-Secret-Token', segredo)
+
+    inicio = time.perf_counter()
+    try:
+        with urllib.request.urlopen(requisicao, timeout=timeout) as resposta:
+            status = resposta.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except urllib.error.URLError:
+        status = None
+    return status, time.perf_counter() - inicio
+
+
+# Simula um técnico percorrendo o roteiro; as mensagens de um mesmo
+# técnico são enviadas em sequência, como no Telegram
+def simular_tecnico(url, gerador, user_id, roteiro, segredo, pausa) -> List[Dict[str, Any]]:
+    resultados = []
+    for texto in roteiro:
+        status, latencia = enviar_update(url, gerador.criar(user_id, texto), segredo)
+        resultados.append({'user_id': user_id, 'texto': texto, 'status': status, 'latencia': latencia})
+        if pausa:
+            time.sleep(pausa)
+    return resultados
+
+
+def percentil(valores: List[float], p: float) -> float:
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    posicao = min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))
+    return ordenados[posicao]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Envia updates sintéticos ao servidor de webhook local (MODO_RECEBIMENTO=webhook)"
+    )
+    parser.add_argument('--url', default='http://127.0.0.1:8080/telegram/webhook')
+    parser.add_argument('--segredo', default=None, help="Valor de WEBHOOK_SEGREDO, se configurado")
+    parser.add_argument('--tecnicos', type=int, default=10)
+    parser.add_argument('--user-id-inicial', type=int, default=900000000)
+    parser.add_argument('--pausa', type=float, default=0.0, help="Segundos entre mensagens de um técnico")
+    parser.add_argument('--saida', default=None, help="Arquivo JSON para gravar os resultados")
+    args = parser.parse_args()
+
+    gerador = GeradorUpdates()
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.tecnicos) as executor:
+        futuros = [
+            executor.submit(
+                simular_tecnico, args.url, gerador, args.user_id_inicial + i,
+                ROTEIRO_PADRAO, args.segredo, args.pausa
+            )
+            for i in range(args.tecnicos)
+        ]
+        resultados = [r for futuro in futuros for r in futuro.result()]
+    duracao = time.perf_counter() - inicio
+
+    por_status: Dict[str, int] = {}
+    for resultado in resultados:
+        chave = str(resultado['status'])
+        por_status[chave] = por_status.get(chave, 0) + 1
+
+    latencias = [r['latencia'] for r in resultados if r['status'] == 200]
+    resumo = {
+        'updates': len(resultados),
+        'duracao_s': round(duracao, 3),
+        'updates_por_s': round(len(resultados) / duracao, 1) if duracao else 0.0,
+        'status': por_status,
+        'ack_p50_ms': round(percentil(latencias, 50) * 1000, 2),
+        'ack_p95_ms': round(percentil(latencias, 95) * 1000, 2),
+        'ack_p99_ms': round(percentil(latencias, 99) * 1000, 2),
+    }
+    print(json.dumps(resumo, indent=2, ensure_ascii=False))
+
+    if args.saida:
+        with open(args.saida, 'w', encoding='utf-8') as arquivo:
+            json.dump({'resumo': resumo, 'resultados': resultados}, arquivo, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
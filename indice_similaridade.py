@@ -0,0 +1,327 @@
+import os
+import re
+import json
+import logging
+import threading
+import unicodedata
+import zlib
+from datetime import datetime
+from typing import List, Dict, Any, Optional, Iterable, Callable
+
+import numpy as np
+
+from conexao_firestore import TAMANHO_PAGINA, ler_paginas
+
+logger = logging.getLogger(__name__)
+
+TERMOS_IRRELEVANTES = {
+    'o', 'a', 'de', 'da', 'do', 'em', 'para', 'com', 'por',
+    'que', 'um', 'uma', 'e', 'ou', 'se', 'mas', 'então'
+}
+
+
+def normalizar_texto(texto: str) -> str:
+    texto = unicodedata.normalize('NFKD', (texto or '').lower())
+    texto = ''.join(c for c in texto if not unicodedata.combining(c))
+    texto = re.sub(r'[^\w\s]', ' ', texto)
+    return re.sub(r'\s+', ' ', texto).strip()
+
+
+def extrair_termos(texto_normalizado: str) -> List[str]:
+    return [
+        palavra for palavra in texto_normalizado.split()
+        if palavra not in TERMOS_IRRELEVANTES and len(palavra) > 2
+    ]
+
+
+# Índice vetorial em memória sobre a coleção `manutencoes`: cada problema vira
+# um vetor de n-gramas de caracteres e palavras-chave projetados por hashing,
+# e a busca é um único produto matriz-vetor seguido da seleção dos top-k.
+class IndiceSimilaridade:
+
+    ARQUIVO_MATRIZ = 'matriz.npy'
+    ARQUIVO_METADADOS = 'metadados.json'
+    # Avançado por quem reconstrói o índice fora do bot (compactar_manutencoes.py)
+    ARQUIVO_GERACAO = 'geracao'
+
+    def __init__(
+        self,
+        dimensao: int = 1024,
+        ngramas=(3, 4),
+        peso_palavras: float = 2.0,
+        resolver_equipamento: Optional[Callable[[str], Optional[str]]] = None
+    ):
+        self.dimensao = dimensao
+        self.ngramas = tuple(ngramas)
+        self.peso_palavras = peso_palavras
+        self.resolver_equipamento = resolver_equipamento
+
+        self._lock = threading.RLock()
+        self._matriz = np.zeros((0, dimensao), dtype=np.float32)
+        self._total = 0
+        self._ids: List[str] = []
+        self._posicoes: Dict[str, int] = {}
+        self._registros: List[Dict[str, Any]] = []
+        self._equipamentos: List[str] = []
+        self.ultima_data: Optional[str] = None
+        self.alteracoes_pendentes = 0
+        # Geração do diretório em que o índice foi carregado ou construído
+        self.geracao = 0
+
+    def __len__(self):
+        return self._total
+
+    @classmethod
+    def ler_geracao(cls, diretorio: str) -> int:
+        try:
+            with open(os.path.join(diretorio, cls.ARQUIVO_GERACAO), encoding='utf-8') as arquivo:
+                return int(arquivo.read().strip() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    @classmethod
+    def avancar_geracao(cls, diretorio: str) -> int:
+        os.makedirs(diretorio, exist_ok=True)
+        geracao = cls.ler_geracao(diretorio) + 1
+        caminho = os.path.join(diretorio, cls.ARQUIVO_GERACAO)
+        with open(caminho + '.tmp', 'w', encoding='utf-8') as arquivo:
+            arquivo.write(str(geracao))
+        os.replace(caminho + '.tmp', caminho)
+        return geracao
+
+    # O diretório foi reconstruído por outro processo: este índice ainda
+    # aponta para documentos que podem ter sido apagados
+    def desatualizado(self, diretorio: str) -> bool:
+        return self.ler_geracao(diretorio) != self.geracao
+
+    def vetorizar(self, texto: str) -> np.ndarray:
+        vetor = np.zeros(self.dimensao, dtype=np.float32)
+        normalizado = normalizar_texto(texto)
+        if not normalizado:
+            return vetor
+
+        caracteristicas: Dict[str, float] = {}
+        for termo in extrair_termos(normalizado):
+            chave = 'p:' + termo
+            caracteristicas[chave] = caracteristicas.get(chave, 0.0) + self.peso_palavras
+
+        delimitado = f' {normalizado} '
+        for n in self.ngramas:
+            for i in range(len(delimitado) - n + 1):
+                chave = delimitado[i:i + n]
+                caracteristicas[chave] = caracteristicas.get(chave, 0.0) + 1.0
+
+        for chave, frequencia in caracteristicas.items():
+            h = zlib.crc32(chave.encode('utf-8'))
+            sinal = 1.0 if (h >> 31) & 1 else -1.0
+            vetor[h % self.dimensao] += sinal * (1.0 + np.log(frequencia))
+
+        norma = np.linalg.norm(vetor)
+        if norma > 0:
+            vetor /= norma
+        return vetor
+
+    def _chave_equipamento(self, registro: Dict[str, Any]) -> str:
+        # Registros anteriores ao backfill não têm 'equipamento_id'
+        if registro.get('equipamento_id'):
+            return registro['equipamento_id']
+        equipamento = registro.get('equipamento', '')
+        if self.resolver_equipamento is not None:
+            return self.resolver_equipamento(equipamento) or equipamento
+        return equipamento
+
+    def _garantir_capacidade(self, minimo: int):
+        capacidade = self._matriz.shape[0]
+        if capacidade >= minimo and self._matriz.flags.writeable:
+            return
+        nova_capacidade = max(minimo, capacidade * 2, 64)
+        nova = np.zeros((nova_capacidade, self.dimensao), dtype=np.float32)
+        nova[:self._total] = self._matriz[:self._total]
+        self._matriz = nova
+
+    # Características de busca (caracteristicas.py) guardadas no registro e
+    # em metadados.json: os candidatos do índice chegam à pontuação prontos.
+    # Documentos ainda não migrados têm as características calculadas aqui,
+    # uma vez. Importado na chamada: caracteristicas.py importa este módulo.
+    @staticmethod
+    def _caracteristicas(registro: Dict[str, Any]) -> Dict[str, Any]:
+        from caracteristicas import CAMPOS_CARACTERISTICAS, VERSAO_CARACTERISTICAS, extrair_caracteristicas
+
+        if registro.get('caracteristicas_versao') != VERSAO_CARACTERISTICAS:
+            return extrair_caracteristicas(registro.get('problema', ''))
+        return {campo: registro.get(campo) for campo in CAMPOS_CARACTERISTICAS}
+
+    def adicionar(self, doc_id: str, registro: Dict[str, Any]) -> bool:
+        with self._lock:
+            if doc_id in self._posicoes:
+                return False
+
+            self._garantir_capacidade(self._total + 1)
+            self._matriz[self._total] = self.vetorizar(registro.get('problema', ''))
+
+            self._posicoes[doc_id] = self._total
+            self._ids.append(doc_id)
+            self._equipamentos.append(self._chave_equipamento(registro))
+            self._registros.append({
+                'equipamento': registro.get('equipamento', ''),
+                'equipamento_id': registro.get('equipamento_id'),
+                'problema': registro.get('problema', ''),
+                'solucao': registro.get('solucao', ''),
+                'ocorrencias': registro.get('ocorrencias', 1),
+                **self._caracteristicas(registro),
+            })
+            self._total += 1
+            self.alteracoes_pendentes += 1
+
+            data = registro.get('data')
+            if hasattr(data, 'isoformat'):
+                data = data.isoformat()
+            if isinstance(data, str) and (self.ultima_data is None or data > self.ultima_data):
+                self.ultima_data = data
+            return True
+
+    def adicionar_varios(self, documentos: Iterable) -> int:
+        adicionados = 0
+        for doc in documentos:
+            if self.adicionar(doc.id, doc.to_dict()):
+                adicionados += 1
+        return adicionados
+
+    def buscar(
+        self,
+        texto: str,
+        top_k: int = 5,
+        equipamento: Optional[str] = None,
+        limiar: float = 0.0
+    ) -> List[Dict[str, Any]]:
+        with self._lock:
+            if self._total == 0:
+                return []
+
+            consulta = self.vetorizar(texto)
+            scores = self._matriz[:self._total] @ consulta
+
+            if equipamento is not None:
+                mascara = np.fromiter(
+                    (eq == equipamento for eq in self._equipamentos),
+                    dtype=bool, count=self._total
+                )
+                scores = np.where(mascara, scores, -np.inf)
+
+            k = min(top_k, self._total)
+            candidatos = np.argpartition(-scores, k - 1)[:k]
+            candidatos = candidatos[np.argsort(-scores[candidatos])]
+
+            resultados = []
+            for posicao in candidatos:
+                score = float(scores[posicao])
+                if not np.isfinite(score) or score < limiar:
+                    continue
+                resultado = dict(self._registros[posicao])
+                resultado['id'] = self._ids[posicao]
+                resultado['relevancia'] = score
+                resultados.append(resultado)
+            return resultados
+
+    # Persistência: a matriz vai para um .npy aberto por memory-map no carregamento
+    def salvar(self, diretorio: str):
+        with self._lock:
+            if self.desatualizado(diretorio):
+                logger.warning("Índice em disco é de uma geração mais nova; a cópia em memória não é salva")
+                return
+            os.makedirs(diretorio, exist_ok=True)
+            caminho_matriz = os.path.join(diretorio, self.ARQUIVO_MATRIZ)
+            caminho_metadados = os.path.join(diretorio, self.ARQUIVO_METADADOS)
+
+            matriz_tmp = caminho_matriz + '.tmp'
+            destino = np.lib.format.open_memmap(
+                matriz_tmp, mode='w+', dtype=np.float32,
+                shape=(self._total, self.dimensao)
+            )
+            destino[:] = self._matriz[:self._total]
+            destino.flush()
+            del destino
+
+            metadados_tmp = caminho_metadados + '.tmp'
+            with open(metadados_tmp, 'w', encoding='utf-8') as arquivo:
+                json.dump({
+                    'dimensao': self.dimensao,
+                    'ngramas': list(self.ngramas),
+                    'peso_palavras': self.peso_palavras,
+                    'ultima_data': self.ultima_data,
+                    'ids': self._ids,
+                    'registros': self._registros,
+                }, arquivo, ensure_ascii=False)
+
+            os.replace(matriz_tmp, caminho_matriz)
+            os.replace(metadados_tmp, caminho_metadados)
+            self.alteracoes_pendentes = 0
+            logger.info(f"Índice de similaridade salvo com {self._total} registros")
+
+    @classmethod
+    def carregar(
+        cls,
+        diretorio: str,
+        resolver_equipamento: Optional[Callable[[str], Optional[str]]] = None
+    ) -> Optional['IndiceSimilaridade']:
+        caminho_matriz = os.path.join(diretorio, cls.ARQUIVO_MATRIZ)
+        caminho_metadados = os.path.join(diretorio, cls.ARQUIVO_METADADOS)
+        if not (os.path.exists(caminho_matriz) and os.path.exists(caminho_metadados)):
+            return None
+
+        try:
+            with open(caminho_metadados, encoding='utf-8') as arquivo:
+                metadados = json.load(arquivo)
+
+            indice = cls(
+                dimensao=metadados['dimensao'],
+                ngramas=metadados['ngramas'],
+                peso_palavras=metadados['peso_palavras'],
+                resolver_equipamento=resolver_equipamento
+            )
+            matriz = np.load(caminho_matriz, mmap_mode='r')
+            if matriz.shape != (len(metadados['ids']), indice.dimensao):
+                logger.warning("Índice persistido inconsistente; será reconstruído")
+                return None
+
+            # Somente leitura até a primeira inclusão, que copia para memória
+            indice._matriz = matriz
+            indice._total = matriz.shape[0]
+            indice._ids = metadados['ids']
+            indice._registros = metadados['registros']
+            indice._posicoes = {doc_id: i for i, doc_id in enumerate(indice._ids)}
+            indice._equipamentos = [indice._chave_equipamento(r) for r in indice._registros]
+            indice.ultima_data = metadados.get('ultima_data')
+            logger.info(f"Índice de similaridade carregado com {indice._total} registros")
+            return indice
+        except Exception as e:
+            logger.error(f"Erro ao carregar índice de similaridade: {e}")
+            return None
+
+
+def carregar_ou_construir(
+    firestore_client,
+    diretorio: str,
+    dimensao: int = 1024,
+    resolver_equipamento: Optional[Callable[[str], Optional[str]]] = None
+) -> IndiceSimilaridade:
+    geracao = IndiceSimilaridade.ler_geracao(diretorio)
+    indice = IndiceSimilaridade.carregar(diretorio, resolver_equipamento)
+    manutencoes_ref = firestore_client.collection('manutencoes')
+
+    if indice is None:
+        indice = IndiceSimilaridade(dimensao=dimensao, resolver_equipamento=resolver_equipamento)
+        # Em páginas: um stream() único da coleção inteira pode estourar o prazo
+        total = indice.adicionar_varios(ler_paginas(firestore_client, 'manutencoes', TAMANHO_PAGINA))
+        logger.info(f"Índice de similaridade construído com {total} registros")
+    elif indice.ultima_data:
+        # Recuperar registros gravados enquanto o índice estava em disco
+        ultima_data = datetime.fromisoformat(indice.ultima_data)
+        query = manutencoes_ref.where('data', '>', ultima_data).order_by('data')
+        novos = indice.adicionar_varios(query.stream())
+        logger.info(f"Índice de similaridade atualizado com {novos} novos registros")
+
+    indice.geracao = geracao
+    if indice.alteracoes_pendentes:
+        indice.salvar(diretorio)
+    return indice
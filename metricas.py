@@ -0,0 +1,334 @@
+import re
+import json
+import time
+import inspect
+import logging
+import functools
+import threading
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Rastro do update em processamento. Tarefas asyncio e asyncio.to_thread
+# herdam o contexto; para o ThreadPoolExecutor use contextvars.copy_context()
+_rastro_atual: ContextVar[Optional['Rastro']] = ContextVar('rastro_atual', default=None)
+
+
+# Spans de um update: cada etapa medida durante o processamento entra aqui
+# com o início relativo ao começo do update e a duração
+class Rastro:
+    def __init__(self, nome: str, **atributos):
+        self.nome = nome
+        self.atributos = atributos
+        self.inicio = time.time()
+        self._inicio_relogio = time.perf_counter()
+        self.spans: List[Dict[str, Any]] = []
+        self.duracao = 0.0
+
+    def adicionar(self, etapa: str, inicio_relogio: float, segundos: float):
+        # list.append é atômico: spans podem chegar de outras threads
+        self.spans.append({
+            'etapa': etapa,
+            'inicio_ms': round((inicio_relogio - self._inicio_relogio) * 1000, 2),
+            'duracao_ms': round(segundos * 1000, 2),
+            'thread': threading.current_thread().name,
+        })
+
+    def concluir(self):
+        self.duracao = time.perf_counter() - self._inicio_relogio
+
+    def para_dict(self) -> Dict[str, Any]:
+        return {
+            'nome': self.nome,
+            'inicio': self.inicio,
+            'duracao_ms': round(self.duracao * 1000, 2),
+            'atributos': self.atributos,
+            'spans': sorted(self.spans, key=lambda span: span['inicio_ms']),
+        }
+
+
+def _nome_metrica(texto: str) -> str:
+    return re.sub(r'[^a-zA-Z0-9_]', '_', texto)
+
+
+def _escapar_rotulo(valor) -> str:
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _rotulos(pares) -> str:
+    if not pares:
+        return ''
+    return '{' + ','.join(f'{chave}="{_escapar_rotulo(valor)}"' for chave, valor in pares) + '}'
+
+
+def _numero(valor) -> bool:
+    # bool é subclasse de int: True/False viram 1/0
+    return isinstance(valor, (int, float))
+
+
+# Tempos por etapa do atendimento: contagem, soma e máximo desde o início,
+# mais uma janela das amostras recentes para os percentis
+class RegistroTempos:
+    def __init__(self, janela: int = 1000, rastros_recentes: int = 50):
+        self.janela = janela
+        self._lock = threading.Lock()
+        self._etapas: Dict[str, Dict[str, Any]] = {}
+        self._contadores: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], int] = {}
+        self._coletores: Dict[str, Callable[[], Dict[str, Any]]] = {}
+
+        # Rastros por update: os mais lentos que o limiar vão para o arquivo
+        # (JSON por linha) e os últimos ficam em memória para o endpoint
+        self._rastros: deque = deque(maxlen=rastros_recentes)
+        self._arquivo_rastros = None
+        self._limiar_rastro = 0.0
+
+    def registrar(self, etapa: str, segundos: float):
+        with self._lock:
+            dados = self._etapas.get(etapa)
+            if dados is None:
+                dados = {'contagem': 0, 'total': 0.0, 'maximo': 0.0, 'amostras': deque(maxlen=self.janela)}
+                self._etapas[etapa] = dados
+            dados['contagem'] += 1
+            dados['total'] += segundos
+            dados['maximo'] = max(dados['maximo'], segundos)
+            dados['amostras'].append(segundos)
+
+    # Rótulos opcionais separam séries do mesmo contador, ex.:
+    # incrementar('atendimento.transicoes', de='intro', para='problem_description')
+    def incrementar(self, contador: str, quantidade: int = 1, **rotulos):
+        chave = (contador, tuple(sorted((k, str(v)) for k, v in rotulos.items())))
+        with self._lock:
+            self._contadores[chave] = self._contadores.get(chave, 0) + quantidade
+
+    @contextmanager
+    def medir(self, etapa: str):
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            segundos = time.perf_counter() - inicio
+            self.registrar(etapa, segundos)
+            rastro = _rastro_atual.get()
+            if rastro is not None:
+                rastro.adicionar(etapa, inicio, segundos)
+
+    # Decorador equivalente a envolver o corpo da função em medir(etapa);
+    # aceita funções comuns e corrotinas
+    def cronometrar(self, etapa: str):
+        def decorador(funcao):
+            if inspect.iscoroutinefunction(funcao):
+                @functools.wraps(funcao)
+                async def medida_async(*args, **kwargs):
+                    with self.medir(etapa):
+                        return await funcao(*args, **kwargs)
+                return medida_async
+
+            @functools.wraps(funcao)
+            def medida(*args, **kwargs):
+                with self.medir(etapa):
+                    return funcao(*args, **kwargs)
+            return medida
+        return decorador
+
+    def configurar_rastros(self, arquivo: Optional[str] = None, limiar: float = 0.0):
+        with self._lock:
+            if self._arquivo_rastros is not None:
+                self._arquivo_rastros.close()
+            self._arquivo_rastros = open(arquivo, 'a', encoding='utf-8') if arquivo else None
+            self._limiar_rastro = limiar
+
+    # Abre o rastro de um update; os spans medidos dentro do bloco (na mesma
+    # thread, em tarefas filhas ou em contextos copiados) são anexados a ele
+    @contextmanager
+    def rastrear(self, nome: str, **atributos):
+        rastro = Rastro(nome, **atributos)
+        token = _rastro_atual.set(rastro)
+        try:
+            yield rastro
+        finally:
+            _rastro_atual.reset(token)
+            rastro.concluir()
+            self.registrar(nome, rastro.duracao)
+            self._guardar_rastro(rastro)
+
+    def _guardar_rastro(self, rastro: Rastro):
+        with self._lock:
+            self._rastros.append(rastro)
+            if self._arquivo_rastros is None or rastro.duracao < self._limiar_rastro:
+                return
+            try:
+                self._arquivo_rastros.write(json.dumps(rastro.para_dict(), ensure_ascii=False) + '\n')
+                self._arquivo_rastros.flush()
+            except (OSError, ValueError) as e:
+                logger.error(f"Erro ao gravar rastro: {e}")
+
+    def rastros_recentes(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            rastros = list(self._rastros)
+        return [rastro.para_dict() for rastro in rastros]
+
+    # Fontes de métricas instantâneas (fila, sessões, disjuntores...), lidas
+    # a cada coleta e exportadas como gauges
+    def registrar_coletor(self, nome: str, coletor: Callable[[], Dict[str, Any]]):
+        with self._lock:
+            self._coletores[nome] = coletor
+
+    @staticmethod
+    def _percentil(ordenadas, p: float) -> float:
+        if not ordenadas:
+            return 0.0
+        return ordenadas[min(len(ordenadas) - 1, int(round(p / 100 * (len(ordenadas) - 1))))]
+
+    @staticmethod
+    def _nome_contador(chave) -> str:
+        contador, rotulos = chave
+        if not rotulos:
+            return contador
+        return f"{contador}{{{','.join(f'{k}={v}' for k, v in rotulos)}}}"
+
+    def resumo(self) -> Dict[str, Any]:
+        with self._lock:
+            etapas = {}
+            for etapa, dados in self._etapas.items():
+                ordenadas = sorted(dados['amostras'])
+                etapas[etapa] = {
+                    'contagem': dados['contagem'],
+                    'media_ms': round(dados['total'] / dados['contagem'] * 1000, 1),
+                    'p50_ms': round(self._percentil(ordenadas, 50) * 1000, 1),
+                    'p95_ms': round(self._percentil(ordenadas, 95) * 1000, 1),
+                    'p99_ms': round(self._percentil(ordenadas, 99) * 1000, 1),
+                    'maximo_ms': round(dados['maximo'] * 1000, 1),
+                }
+            contadores = {self._nome_contador(chave): valor for chave, valor in self._contadores.items()}
+            return {'etapas': etapas, 'contadores': contadores}
+
+    # Formato texto do Prometheus: etapas como summary (quantis da janela,
+    # soma e contagem desde o início), contadores como counter e os valores
+    # numéricos dos coletores como gauge
+    def exportar_prometheus(self, prefixo: str = 'bot') -> str:
+        linhas = []
+        with self._lock:
+            etapas = [
+                (etapa, sorted(dados['amostras']), dados['total'], dados['contagem'])
+                for etapa, dados in sorted(self._etapas.items())
+            ]
+            contadores = sorted(self._contadores.items())
+            coletores = list(self._coletores.items())
+
+        nome = f'{prefixo}_etapa_segundos'
+        linhas.append(f'# HELP {nome} Duração das etapas do atendimento')
+        linhas.append(f'# TYPE {nome} summary')
+        for etapa, ordenadas, total, contagem in etapas:
+            for quantil in (50, 95, 99):
+                rotulos = _rotulos((('etapa', etapa), ('quantile', quantil / 100)))
+                linhas.append(f'{nome}{rotulos} {self._percentil(ordenadas, quantil):.6f}')
+            linhas.append(f'{nome}_sum{_rotulos((("etapa", etapa),))} {total:.6f}')
+            linhas.append(f'{nome}_count{_rotulos((("etapa", etapa),))} {contagem}')
+
+        tipos_emitidos = set()
+        for (contador, rotulos), valor in contadores:
+            nome = f'{prefixo}_{_nome_metrica(contador)}_total'
+            if nome not in tipos_emitidos:
+                tipos_emitidos.add(nome)
+                linhas.append(f'# TYPE {nome} counter')
+            linhas.append(f'{nome}{_rotulos(rotulos)} {valor}')
+
+        for fonte, coletor in coletores:
+            try:
+                dados = coletor() or {}
+            except Exception as e:
+                logger.error(f"Erro no coletor de métricas '{fonte}': {e}")
+                continue
+            for chave, valor, rotulos in self._achatar(dados):
+                nome = f'{prefixo}_{_nome_metrica(fonte)}_{_nome_metrica(chave)}'
+                if nome not in tipos_emitidos:
+                    tipos_emitidos.add(nome)
+                    linhas.append(f'# TYPE {nome} gauge')
+                linhas.append(f'{nome}{_rotulos(rotulos)} {float(valor):g}')
+
+        return '\n'.join(linhas) + '\n'
+
+    # Achata até dois níveis: {'modelos': {'pro': {'chamadas': 3}}} vira
+    # modelos_chamadas{item="pro"}; listas viram item="0", item="1"...
+    @staticmethod
+    def _achatar(dados: Dict[str, Any]):
+        for chave, valor in dados.items():
+            if _numero(valor):
+                yield chave, valor, ()
+                continue
+            if isinstance(valor, (list, tuple)):
+                valor = {str(i): item for i, item in enumerate(valor)}
+            if not isinstance(valor, dict):
+                continue
+            for item, subvalor in valor.items():
+                if _numero(subvalor):
+                    yield chave, subvalor, (('item', item),)
+                elif isinstance(subvalor, dict):
+                    for campo, final in subvalor.items():
+                        if _numero(final):
+                            yield f'{chave}_{campo}', final, (('item', item),)
+
+    def fechar(self):
+        self.configurar_rastros(None)
+
+
+# Servidor HTTP só para as métricas (/metrics e /rastros), em todos os modos.
+# Fica fora da porta pública do webhook e, por padrão, só em localhost,
+# porque /rastros expõe user_id e message_id de cada update
+class ServidorMetricas:
+    def __init__(self, registro: RegistroTempos, host: str = '127.0.0.1', porta: int = 9090):
+        rotas = rotas_metricas(registro)
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                rota = rotas.get(self.path.split('?', 1)[0])
+                if rota is None:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                tipo, corpo = rota()
+                self.send_response(200)
+                self.send_header('Content-Type', tipo)
+                self.send_header('Content-Length', str(len(corpo)))
+                self.end_headers()
+                self.wfile.write(corpo)
+
+            def log_message(self, formato, *args):
+                logger.debug(f"Métricas {self.address_string()}: {formato % args}")
+
+        self._servidor = ThreadingHTTPServer((host, porta), Handler)
+        self._servidor.daemon_threads = True
+        self._thread = threading.Thread(target=self._servidor.serve_forever, name='metricas', daemon=True)
+
+    @property
+    def porta(self) -> int:
+        return self._servidor.server_address[1]
+
+    def iniciar(self):
+        self._thread.start()
+        host = self._servidor.server_address[0]
+        logger.info(f"Métricas disponíveis em http://{host}:{self.porta}/metrics")
+
+    def encerrar(self):
+        self._servidor.shutdown()
+        self._servidor.server_close()
+
+
+# Rotas GET de métricas: caminho -> função que devolve (content-type, corpo)
+def rotas_metricas(registro: RegistroTempos) -> Dict[str, Callable[[], Tuple[str, bytes]]]:
+    return {
+        '/metrics': lambda: (
+            'text/plain; version=0.0.4; charset=utf-8', registro.exportar_prometheus().encode('utf-8')
+        ),
+        '/rastros': lambda: (
+            'application/json', json.dumps(registro.rastros_recentes(), ensure_ascii=False).encode('utf-8')
+        ),
+    }
+
+
+tempos = RegistroTempos()
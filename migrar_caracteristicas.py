@@ -0,0 +1,71 @@
+import sys
+import logging
+import argparse
+
+from conexao_firestore import TAMANHO_PAGINA, configurar_firestore, ler_paginas
+from registro_logs import configurar_logging
+from caracteristicas import VERSAO_CARACTERISTICAS, extrair_caracteristicas
+
+logger = logging.getLogger(__name__)
+
+LIMITE_LOTE_FIRESTORE = 500
+
+
+# Grava as características de busca (caracteristicas.py) nos documentos de
+# 'manutencoes' anteriores a elas ou calculados com outra versão
+def executar_migracao(db, tamanho_lote=LIMITE_LOTE_FIRESTORE, simular=False, tamanho_pagina=TAMANHO_PAGINA):
+    batch = db.batch()
+    pendentes = 0
+    atualizados = 0
+    ignorados = 0
+
+    for doc in ler_paginas(db, 'manutencoes', tamanho_pagina):
+        dados = doc.to_dict()
+        if dados.get('caracteristicas_versao') == VERSAO_CARACTERISTICAS:
+            ignorados += 1
+            continue
+
+        caracteristicas = extrair_caracteristicas(dados.get('problema', ''))
+        atualizados += 1
+        if simular:
+            logger.info(f"{doc.id}: {caracteristicas['palavras_chave']}")
+            continue
+
+        batch.update(doc.reference, caracteristicas)
+        pendentes += 1
+        if pendentes >= tamanho_lote:
+            batch.commit()
+            logger.info(f"Lote de {pendentes} documentos gravado ({atualizados} até agora)")
+            batch = db.batch()
+            pendentes = 0
+
+    if pendentes:
+        batch.commit()
+
+    logger.info(
+        f"Migração para a versão {VERSAO_CARACTERISTICAS} concluída: "
+        f"{atualizados} atualizados, {ignorados} já em dia"
+    )
+    return atualizados
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pré-calcula as características de busca da coleção manutencoes")
+    parser.add_argument('--lote', type=int, default=LIMITE_LOTE_FIRESTORE,
+                        help="Documentos por batch de escrita (máx. 500)")
+    parser.add_argument('--pagina', type=int, default=TAMANHO_PAGINA, help="Documentos lidos por página")
+    parser.add_argument('--simular', action='store_true',
+                        help="Apenas mostra o que seria gravado")
+    args = parser.parse_args()
+
+    configurar_logging('sincrono', arquivo=None)
+
+    db = configurar_firestore()
+    if db is None:
+        sys.exit(1)
+
+    executar_migracao(db, min(args.lote, LIMITE_LOTE_FIRESTORE), args.simular, args.pagina)
+
+
+if __name__ == '__main__':
+    main()
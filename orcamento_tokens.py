@@ -0,0 +1,238 @@
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+
+from metricas import tempos
+
+logger = logging.getLogger(__name__)
+
+# Usuário do update em processamento; as cobranças feitas durante o
+# atendimento (inclusive em threads com o contexto copiado) caem na conta dele
+_usuario_atual: ContextVar = ContextVar('usuario_tokens', default=None)
+
+MODOS_CONTAGEM = ('api', 'calibrada', 'local')
+
+
+# A parte fixa da requisição já passa do limite: não sobra espaço para o texto variável
+class LimiteRequisicaoExcedido(Exception):
+    pass
+
+
+# Aproximação de ~4 caracteres por token
+def estimar_tokens(texto: str) -> int:
+    return (len(texto) + 3) // 4
+
+
+# Contagem de tokens antes do envio. Modo 'api': todo texto passa pelo
+# count_tokens (com memória por conteúdo). Modo 'calibrada': só os textos
+# fixos (memorizar=True) vão à API, uma vez, e o resto usa a estimativa
+# local corrigida pela razão observada nessas contagens. Modo 'local': só
+# a estimativa. Falhas da API caem na estimativa, sem interromper o envio.
+class ContadorTokens:
+    def __init__(
+        self,
+        contar_api: Optional[Callable[[str], int]] = None,
+        modo: str = 'calibrada',
+        tamanho_memoria: int = 256
+    ):
+        if modo not in MODOS_CONTAGEM:
+            raise ValueError(f"Modo de contagem desconhecido: {modo}")
+        self.contar_api = contar_api
+        self.modo = modo if contar_api is not None else 'local'
+        self.tamanho_memoria = tamanho_memoria
+
+        self._lock = threading.Lock()
+        self._memoria: 'OrderedDict[str, int]' = OrderedDict()
+        self._razao = 1.0
+        self.contagens_api = 0
+        self.falhas_api = 0
+        self.estimativas = 0
+        self.acertos_memoria = 0
+
+    # count_tokens é uma chamada de rede bloqueante; no modo 'calibrada' ela
+    # só acontece para os textos fixos, contados na inicialização
+    @property
+    def usa_api(self) -> bool:
+        return self.modo == 'api'
+
+    def estimar(self, texto: str) -> int:
+        with self._lock:
+            self.estimativas += 1
+            razao = self._razao
+        return max(1, round(estimar_tokens(texto) * razao)) if texto else 0
+
+    def contar(self, texto: str, memorizar: bool = False) -> int:
+        if not texto:
+            return 0
+        if self.modo == 'local' or (self.modo == 'calibrada' and not memorizar):
+            return self.estimar(texto)
+
+        chave = hashlib.sha1(texto.encode('utf-8')).hexdigest()
+        with self._lock:
+            tokens = self._memoria.get(chave)
+            if tokens is not None:
+                self._memoria.move_to_end(chave)
+                self.acertos_memoria += 1
+                return tokens
+
+        try:
+            tokens = int(self.contar_api(texto))
+        except Exception as e:
+            logger.warning(f"count_tokens indisponível, usando estimativa local: {e}")
+            with self._lock:
+                self.falhas_api += 1
+            return self.estimar(texto)
+
+        with self._lock:
+            self.contagens_api += 1
+            # Média móvel da razão tokens reais / estimativa
+            self._razao = 0.8 * self._razao + 0.2 * (tokens / max(1, estimar_tokens(texto)))
+            self._memoria[chave] = tokens
+            while len(self._memoria) > self.tamanho_memoria:
+                self._memoria.popitem(last=False)
+        return tokens
+
+    def metricas(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'modo': self.modo,
+                'contagens_api': self.contagens_api,
+                'falhas_api': self.falhas_api,
+                'estimativas': self.estimativas,
+                'acertos_memoria': self.acertos_memoria,
+                'razao_calibracao': round(self._razao, 3),
+            }
+
+
+# Limites de tokens por requisição e por usuário numa janela deslizante.
+# O limite por usuário é consultado antes da chamada (disponivel) e o
+# consumo de entrada e de saída é cobrado conforme acontece. O uso vai para
+# os contadores tokens.entrada / tokens.saida por etapa, com as métricas.
+class OrcamentoTokens:
+    def __init__(
+        self,
+        contador: ContadorTokens,
+        maximo_por_requisicao: int = 0,
+        maximo_por_usuario: int = 0,
+        janela: float = 3600
+    ):
+        self.contador = contador
+        self.maximo_por_requisicao = maximo_por_requisicao
+        self.maximo_por_usuario = maximo_por_usuario
+        self.janela = janela
+
+        self._lock = threading.Lock()
+        self._consumo: Dict[Any, Deque[Tuple[float, int]]] = {}
+        self._consumo_total: Dict[Any, int] = {}
+        self.bloqueios = 0
+        self.cortes = 0
+        self.recusas = 0
+
+    @contextmanager
+    def usuario(self, user_id):
+        token = _usuario_atual.set(user_id)
+        try:
+            yield
+        finally:
+            _usuario_atual.reset(token)
+
+    def _descartar_antigos(self, user_id, agora: float):
+        registros = self._consumo.get(user_id)
+        while registros and registros[0][0] <= agora - self.janela:
+            _, tokens = registros.popleft()
+            self._consumo_total[user_id] -= tokens
+        if registros is not None and not registros:
+            del self._consumo[user_id]
+            del self._consumo_total[user_id]
+
+    def consumo(self, user_id=None) -> int:
+        user_id = user_id if user_id is not None else _usuario_atual.get()
+        with self._lock:
+            self._descartar_antigos(user_id, time.monotonic())
+            return self._consumo_total.get(user_id, 0)
+
+    def disponivel(self, user_id=None) -> bool:
+        user_id = user_id if user_id is not None else _usuario_atual.get()
+        if not self.maximo_por_usuario or user_id is None:
+            return True
+        if self.consumo(user_id) < self.maximo_por_usuario:
+            return True
+        with self._lock:
+            self.bloqueios += 1
+        tempos.incrementar('tokens.bloqueios')
+        return False
+
+    def _cobrar(self, tokens: int):
+        user_id = _usuario_atual.get()
+        if not self.maximo_por_usuario or user_id is None or not tokens:
+            return
+        agora = time.monotonic()
+        with self._lock:
+            self._consumo.setdefault(user_id, deque()).append((agora, tokens))
+            self._consumo_total[user_id] = self._consumo_total.get(user_id, 0) + tokens
+            # Varredura ocasional dos usuários que pararam de consumir
+            if len(self._consumo) > 1000:
+                for outro in list(self._consumo):
+                    self._descartar_antigos(outro, agora)
+
+    # Texto variável que não cabe no limite por requisição é cortado na
+    # proporção do excesso; devolve o texto e os tokens finais da requisição.
+    # Se o corte não deixa nada do texto variável, a requisição é recusada
+    # com LimiteRequisicaoExcedido em vez de seguir sem ele.
+    def ajustar(self, etapa: str, fixos: int, variavel: str) -> Tuple[str, int]:
+        tokens_variavel = self.contador.contar(variavel)
+        total = fixos + tokens_variavel
+        if not self.maximo_por_requisicao or total <= self.maximo_por_requisicao:
+            return variavel, total
+
+        restantes = max(0, self.maximo_por_requisicao - fixos)
+        cortado = variavel[:len(variavel) * restantes // max(1, tokens_variavel)]
+        if not cortado.strip():
+            with self._lock:
+                self.recusas += 1
+            tempos.incrementar('tokens.recusas', etapa=etapa)
+            logger.warning(
+                f"Requisição de {etapa} recusada: a parte fixa (~{fixos} tokens) não deixa espaço "
+                f"para o texto variável no limite de {self.maximo_por_requisicao}"
+            )
+            raise LimiteRequisicaoExcedido(etapa)
+
+        with self._lock:
+            self.cortes += 1
+        tempos.incrementar('tokens.cortes', etapa=etapa)
+        logger.warning(
+            f"Requisição de {etapa} com ~{total} tokens acima do limite de "
+            f"{self.maximo_por_requisicao}; texto variável cortado"
+        )
+        return cortado, fixos + self.contador.contar(cortado)
+
+    def registrar_entrada(self, etapa: str, tokens: int):
+        tempos.incrementar('tokens.entrada', tokens, etapa=etapa)
+        tempos.incrementar('tokens.requisicoes', etapa=etapa)
+        self._cobrar(tokens)
+
+    # A saída não passa pela API de contagem: usa o uso informado na
+    # resposta, quando o SDK o expõe, ou a estimativa calibrada
+    def registrar_saida(self, etapa: str, texto: str, resposta=None):
+        uso = getattr(resposta, 'usage_metadata', None)
+        tokens = getattr(uso, 'candidates_token_count', None) or self.contador.estimar(texto)
+        tempos.incrementar('tokens.saida', tokens, etapa=etapa)
+        self._cobrar(tokens)
+
+    def metricas(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'maximo_por_requisicao': self.maximo_por_requisicao,
+                'maximo_por_usuario': self.maximo_por_usuario,
+                'usuarios_na_janela': len(self._consumo),
+                'bloqueios': self.bloqueios,
+                'cortes': self.cortes,
+                'recusas': self.recusas,
+                'contagem': self.contador.metricas(),
+            }
+
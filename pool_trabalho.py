@@ -0,0 +1,99 @@
+import queue
+import logging
+import threading
+from typing import Any, Callable, Dict, List
+
+logger = logging.getLogger(__name__)
+
+
+# Pool de workers em que cada chave (o user_id) sempre cai no mesmo worker:
+# as mensagens de um técnico são processadas em ordem, enquanto técnicos
+# diferentes são atendidos em paralelo.
+class PoolOrdenado:
+    def __init__(self, num_workers: int = 4, capacidade_fila: int = 0,
+                 alerta_profundidade: int = 20, nome: str = 'atendimento',
+                 bloquear_quando_cheia: bool = False):
+        if num_workers < 1:
+            raise ValueError("O pool precisa de pelo menos um worker")
+
+        self.num_workers = num_workers
+        # Bloquear propaga a pressão para quem submete (ex.: a fila do webhook)
+        self.bloquear_quando_cheia = bloquear_quando_cheia
+        self.alerta_profundidade = alerta_profundidade
+        self.nome = nome
+
+        self._filas: List[queue.Queue] = [queue.Queue(capacidade_fila) for _ in range(num_workers)]
+        self._lock = threading.Lock()
+        self._processadas = [0] * num_workers
+        self._erros = 0
+        self._rejeitadas = 0
+        self._maior_profundidade = 0
+
+        self._threads = [
+            threading.Thread(target=self._executar, args=(i,), name=f'{nome}-{i}', daemon=True)
+            for i in range(num_workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def _indice(self, chave: Any) -> int:
+        return hash(chave) % self.num_workers
+
+    def submeter(self, chave: Any, funcao: Callable, *args, **kwargs) -> bool:
+        indice = self._indice(chave)
+        fila = self._filas[indice]
+        try:
+            fila.put((funcao, args, kwargs), block=self.bloquear_quando_cheia)
+        except queue.Full:
+            with self._lock:
+                self._rejeitadas += 1
+            logger.warning(f"Fila {self.nome}-{indice} cheia; tarefa da chave {chave} rejeitada")
+            return False
+
+        profundidade = fila.qsize()
+        with self._lock:
+            self._maior_profundidade = max(self._maior_profundidade, profundidade)
+        if profundidade >= self.alerta_profundidade:
+            logger.warning(f"Fila {self.nome}-{indice} com {profundidade} tarefas pendentes")
+        return True
+
+    def _executar(self, indice: int):
+        fila = self._filas[indice]
+        while True:
+            tarefa = fila.get()
+            if tarefa is None:
+                fila.task_done()
+                break
+
+            funcao, args, kwargs = tarefa
+            try:
+                funcao(*args, **kwargs)
+            except Exception as e:
+                with self._lock:
+                    self._erros += 1
+                logger.error(f"Erro não tratado no worker {self.nome}-{indice}: {e}", exc_info=True)
+            finally:
+                with self._lock:
+                    self._processadas[indice] += 1
+                fila.task_done()
+
+    def metricas(self) -> Dict[str, Any]:
+        profundidades = [fila.qsize() for fila in self._filas]
+        with self._lock:
+            return {
+                'workers': self.num_workers,
+                'profundidade_por_worker': profundidades,
+                'profundidade_total': sum(profundidades),
+                'maior_profundidade': self._maior_profundidade,
+                'processadas': sum(self._processadas),
+                'processadas_por_worker': list(self._processadas),
+                'erros': self._erros,
+                'rejeitadas': self._rejeitadas,
+            }
+
+    def encerrar(self, aguardar: bool = True):
+        for fila in self._filas:
+            fila.put(None)
+        if aguardar:
+            for thread in self._threads:
+                thread.join()
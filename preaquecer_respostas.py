@@ -0,0 +1,201 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import bot
+from caracteristicas import caracteristicas_comparaveis, similaridade_assinaturas
+from indice_similaridade import normalizar_texto
+
+logger = logging.getLogger(__name__)
+
+LIMIAR_AGRUPAMENTO = 0.55  # mesma pontuação da busca no histórico (selecionar_relevantes)
+ARQUIVO_PROGRESSO = 'preaquecimento_progresso.json'
+
+
+# Agrupamento guloso dos problemas de um equipamento: cada registro entra no
+# grupo cujo primeiro membro mais se parece com ele, ou abre um grupo novo
+def agrupar_problemas(registros, limiar=LIMIAR_AGRUPAMENTO):
+    grupos = []
+    for registro in registros:
+        palavras, assinatura = caracteristicas_comparaveis(registro)
+        melhor, melhor_score = None, limiar
+        for grupo in grupos:
+            cobertura = len(palavras & grupo['palavras']) / len(palavras) if palavras else 0.0
+            score = similaridade_assinaturas(assinatura, grupo['assinatura']) * 0.6 + cobertura * 0.4
+            if score >= melhor_score:
+                melhor, melhor_score = grupo, score
+        if melhor is None:
+            grupos.append({'palavras': palavras, 'assinatura': assinatura, 'membros': [registro]})
+        else:
+            melhor['membros'].append(registro)
+    return grupos
+
+
+# Pares (equipamento, grupo de problemas) mais frequentes nas manutenções
+# dos últimos dias; o texto mais comum de cada grupo é o que será gerado
+def minerar_pares(db, dias=90, minimo=3, limite=50):
+    consulta = db.collection('manutencoes')
+    if dias:
+        consulta = consulta.where('data', '>=', datetime.now(timezone.utc) - timedelta(days=dias))
+
+    por_equipamento = {}
+    for doc in consulta.stream():
+        dados = doc.to_dict()
+        if not dados.get('problema') or not dados.get('equipamento'):
+            continue
+        chave = dados.get('equipamento_id') or normalizar_texto(dados['equipamento'])
+        por_equipamento.setdefault(chave, []).append(dados)
+
+    pares = []
+    for chave, registros in por_equipamento.items():
+        for grupo in agrupar_problemas(registros):
+            membros = grupo['membros']
+            if len(membros) < minimo:
+                continue
+            problema = Counter(m['problema'].strip() for m in membros).most_common(1)[0][0]
+            pares.append({
+                'chave': f"{chave}|{normalizar_texto(problema)}",
+                'equipamento': Counter(m['equipamento'].strip() for m in membros).most_common(1)[0][0],
+                'problema': problema,
+                'frequencia': len(membros),
+            })
+
+    pares.sort(key=lambda par: par['frequencia'], reverse=True)
+    return pares[:limite]
+
+
+def carregar_progresso(caminho):
+    try:
+        with open(caminho, encoding='utf-8') as arquivo:
+            return json.load(arquivo)
+    except FileNotFoundError:
+        return None
+
+
+# Troca atômica: uma interrupção no meio da gravação não perde o progresso
+def gravar_progresso(caminho, progresso):
+    temporario = f"{caminho}.tmp"
+    with open(temporario, 'w', encoding='utf-8') as arquivo:
+        json.dump(progresso, arquivo, ensure_ascii=False, indent=2)
+    os.replace(temporario, caminho)
+
+
+# Próxima ocorrência do horário HH:MM (hoje ou amanhã), em tempo de relógio
+def horario_limite(texto):
+    hora, minuto = (int(parte) for parte in texto.split(':'))
+    agora = datetime.now()
+    limite = agora.replace(hour=hora, minute=minuto, second=0, microsecond=0)
+    if limite <= agora:
+        limite += timedelta(days=1)
+    return limite.timestamp()
+
+
+# Gera os pares pendentes pelo mesmo caminho do bot (buscar_solucao_ia), com
+# no máximo `concorrencia` diagnósticos ao mesmo tempo. O cache de
+# diagnósticos do bot aponta para o armazém persistente, então só respostas
+# completas (com histórico) são gravadas; as demais ficam para a próxima
+# rodada. Depois de `parar_em` nenhum par novo começa.
+def preaquecer(pares, progresso, caminho_progresso, concorrencia=2, parar_em=None):
+    armazem = bot.cache_diagnosticos
+    concluidos = set(progresso['concluidos'])
+    lock = threading.Lock()
+    contagem = Counter()
+
+    def processar(par):
+        if parar_em is not None and time.time() >= parar_em:
+            with lock:
+                contagem['adiados'] += 1
+            return
+        chave_equipamento = bot.resolver_equipamento(par['equipamento']) or par['equipamento']
+        if armazem.obter(chave_equipamento, par['problema']) is not None:
+            situacao = 'existentes'
+        else:
+            try:
+                bot.buscar_solucao_ia(par['equipamento'], par['problema'])
+            except bot.AtendimentoRecusado:
+                pass
+            situacao = 'gerados' if armazem.obter(chave_equipamento, par['problema']) is not None else 'falhas'
+
+        with lock:
+            contagem[situacao] += 1
+            if situacao != 'falhas':
+                progresso['concluidos'].append(par['chave'])
+                gravar_progresso(caminho_progresso, progresso)
+        logger.info(f"{situacao[:-1]}: {par['equipamento']} | {par['problema'][:60]} ({par['frequencia']}x)")
+
+    pendentes = [par for par in pares if par['chave'] not in concluidos]
+    logger.info(f"{len(pendentes)} de {len(pares)} pares pendentes")
+    with ThreadPoolExecutor(max_workers=max(1, concorrencia), thread_name_prefix='preaquecer') as executor:
+        list(executor.map(processar, pendentes))
+    return dict(contagem)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Pré-gera, fora do pico, os diagnósticos dos pares (equipamento, problema) mais frequentes"
+    )
+    parser.add_argument('--pares', type=int, default=50, help="Quantos pares mais frequentes gerar")
+    parser.add_argument('--minimo', type=int, default=3, help="Ocorrências mínimas de um par")
+    parser.add_argument('--dias', type=int, default=90, help="Janela de manutenções consideradas (0 = todas)")
+    parser.add_argument('--concorrencia', type=int, default=2, help="Diagnósticos simultâneos")
+    parser.add_argument('--ate', default=None, help="Horário HH:MM em que nenhum par novo começa")
+    parser.add_argument('--progresso', default=ARQUIVO_PROGRESSO, help="Arquivo de progresso para retomar")
+    parser.add_argument('--reiniciar', action='store_true', help="Descarta o progresso e minera de novo")
+    parser.add_argument('--simular', action='store_true', help="Apenas lista os pares minerados")
+    args = parser.parse_args()
+
+    if not bot.PREAQUECIDAS_ARQUIVO:
+        logger.critical("PREAQUECIDAS_ARQUIVO vazio: não há onde gravar as respostas")
+        sys.exit(1)
+
+    bot.db = bot.configurar_firestore()
+    if bot.db is None:
+        sys.exit(1)
+
+    progresso = None if args.reiniciar else carregar_progresso(args.progresso)
+    # Rodada anterior concluída: a próxima janela minera de novo
+    if progresso is not None and len(progresso['concluidos']) >= len(progresso['pares']):
+        progresso = None
+    if progresso is None:
+        pares = minerar_pares(bot.db, args.dias, args.minimo, args.pares)
+        progresso = {'minerado_em': datetime.now(timezone.utc).isoformat(), 'pares': pares, 'concluidos': []}
+        if not args.simular:
+            gravar_progresso(args.progresso, progresso)
+    else:
+        logger.info(f"Retomando o progresso de {progresso['minerado_em']}")
+
+    if args.simular:
+        for par in progresso['pares']:
+            print(f"{par['frequencia']:5d}  {par['equipamento']} | {par['problema']}")
+        return
+
+    if not bot.configurar_gemini():
+        sys.exit(1)
+    if not bot.configurar_equipamentos():
+        logger.warning("Registro de equipamentos indisponível; chaves pelo texto do equipamento")
+    if not bot.configurar_indice():
+        logger.warning("Índice de similaridade indisponível; usando busca no Firestore")
+    bot.configurar_cache_historico()
+    bot.configurar_tokens()
+    bot.cache_diagnosticos = bot.abrir_respostas_preaquecidas()
+
+    try:
+        contagem = preaquecer(
+            progresso['pares'], progresso, args.progresso,
+            args.concorrencia, horario_limite(args.ate) if args.ate else None
+        )
+        logger.info(f"Pré-aquecimento encerrado: {contagem}")
+        logger.info(f"Orçamento de tokens: {bot.orcamento_tokens.metricas()}")
+    finally:
+        bot.encerrar_servicos()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+import re
+from typing import Any, Dict, List
+
+from orcamento_tokens import estimar_tokens
+
+# Refinamento em conversa: em vez de reenviar o modelo de diagnóstico com o
+# contexto anterior aninhado no "problema", cada rodada manda o histórico
+# compacto da conversa (como o ChatSession do start_chat mantém) mais só a
+# informação nova do técnico. A conversa fica na sessão do usuário como
+# dados simples, então sobrevive ao backend sqlite das sessões.
+
+MAX_TURNOS = 4  # rodadas mantidas por inteiro; as anteriores viram uma nota
+LIMITE_DIAGNOSTICO = 700  # caracteres do diagnóstico inicial guardados na conversa
+LIMITE_RESPOSTA = 400  # caracteres de cada solução refinada guardados
+LIMITE_LINHA = 120  # cada linha da resposta entra abreviada no resumo
+LIMITE_NOTA = 150  # caracteres de cada informação antiga guardados na nota
+
+PADRAO_TAG = re.compile(r'<[^>]+>')
+MARCA_HISTORICO = 'CONTEXTO HISTÓRICO DE MANUTENÇÕES'
+
+INSTRUCAO = """Assistente técnico de manutenção.
+Equipamento: {equipamento}
+Problema relatado: {problema}
+{nota}A cada informação nova do técnico, gere uma solução técnica ATUALIZADA e
+MAIS ESPECÍFICA no formato do diagnóstico (títulos em <b>negrito</b>, causas
+com 🔹, passos numerados), sem repetir o que não mudou."""
+
+
+def estimar_tokens_conteudos(conteudos: List[Dict[str, Any]]) -> int:
+    return sum(estimar_tokens(parte) for conteudo in conteudos for parte in conteudo['parts'])
+
+
+# Versão enxuta de uma resposta para o histórico: sem HTML, sem o bloco de
+# histórico que o bot anexa (não foi o modelo que escreveu), com cada linha
+# abreviada para que títulos, causas e passos caibam no limite
+def resumir_solucao(texto: str, limite: int = LIMITE_RESPOSTA) -> str:
+    texto = PADRAO_TAG.sub('', texto.split(MARCA_HISTORICO, 1)[0])
+    linhas = [linha.strip() for linha in texto.split('\n') if linha.strip()]
+    texto = '\n'.join(
+        linha if len(linha) <= LIMITE_LINHA else linha[:LIMITE_LINHA].rstrip() + '…' for linha in linhas
+    )
+    if len(texto) <= limite:
+        return texto
+    corte = texto.rfind('\n', 0, limite)
+    return texto[:corte if corte > limite // 2 else limite].rstrip() + ' […]'
+
+
+def iniciar_conversa(equipamento: str, problema: str, solucao: str) -> Dict[str, Any]:
+    return {
+        'equipamento': equipamento,
+        'problema': problema,
+        'diagnostico': resumir_solucao(solucao or '', LIMITE_DIAGNOSTICO),
+        'turnos': [],
+        'nota': [],
+    }
+
+
+def mensagem_tecnico(informacao: str) -> str:
+    return f"NOVA INFORMAÇÃO DO TÉCNICO:\n{informacao}"
+
+
+# Acrescenta a rodada concluída; as que passam de max_turnos saem da conversa
+# e deixam só a informação do técnico, abreviada, na nota do contexto
+def registrar_turno(
+    conversa: Dict[str, Any], informacao: str, resposta: str, max_turnos: int = MAX_TURNOS
+) -> Dict[str, Any]:
+    turnos = conversa['turnos'] + [[informacao, resumir_solucao(resposta)]]
+    nota = list(conversa['nota'])
+    while len(turnos) > max_turnos:
+        antiga, _ = turnos.pop(0)
+        nota.append(antiga[:LIMITE_NOTA])
+    return {**conversa, 'turnos': turnos, 'nota': nota[-max_turnos:]}
+
+
+def _instrucao(conversa: Dict[str, Any], nota: List[str]) -> str:
+    texto_nota = ''
+    if nota:
+        texto_nota = "Informações dadas antes pelo técnico:\n" + '\n'.join(f"- {item}" for item in nota) + '\n'
+    return INSTRUCAO.format(
+        equipamento=conversa['equipamento'], problema=conversa['problema'], nota=texto_nota
+    )
+
+
+# Conteúdos no formato do generate_content (papéis user/model alternados).
+# Acima do orçamento, as rodadas mais antigas são trocadas pela nota.
+def montar_conteudos(conversa: Dict[str, Any], informacao: str, orcamento: int = 0) -> List[Dict[str, Any]]:
+    turnos = list(conversa['turnos'])
+    nota = list(conversa['nota'])
+    while True:
+        conteudos = [
+            {'role': 'user', 'parts': [_instrucao(conversa, nota)]},
+            {'role': 'model', 'parts': [conversa['diagnostico']]},
+        ]
+        for pergunta, resposta in turnos:
+            conteudos.append({'role': 'user', 'parts': [mensagem_tecnico(pergunta)]})
+            conteudos.append({'role': 'model', 'parts': [resposta]})
+        conteudos.append({'role': 'user', 'parts': [mensagem_tecnico(informacao)]})
+
+        if not orcamento or not turnos or estimar_tokens_conteudos(conteudos) <= orcamento:
+            return conteudos
+        antiga, _ = turnos.pop(0)
+        nota.append(antiga[:LIMITE_NOTA])
@@ -0,0 +1,164 @@
+import sys
+import json
+import queue
+import atexit
+import random
+import zlib
+import logging
+import logging.handlers
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+# Campos padrão do LogRecord; o que vier além disso (extra=...) entra no JSON
+_CAMPOS_PADRAO = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+
+# Marca uma linha emitida a cada mensagem recebida; essas linhas passam pela
+# amostragem. Com user_id, a amostragem é por usuário: a conversa aparece
+# inteira no log ou não aparece.
+def por_mensagem(user_id=None) -> Dict[str, Any]:
+    return {'por_mensagem': True, 'user_id': user_id}
+
+
+class FiltroAmostragem(logging.Filter):
+    def __init__(self, taxa: float = 1.0):
+        super().__init__()
+        self.taxa = taxa
+        self._limite = int(taxa * 10000)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.taxa >= 1.0 or not getattr(record, 'por_mensagem', False):
+            return True
+        user_id = getattr(record, 'user_id', None)
+        if user_id is None:
+            return random.random() < self.taxa
+        return zlib.crc32(str(user_id).encode('utf-8')) % 10000 < self._limite
+
+
+# Um objeto JSON compacto por linha
+class FormatadorJSON(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        dados = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'nivel': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'thread': record.threadName,
+        }
+        for campo, valor in vars(record).items():
+            if campo not in _CAMPOS_PADRAO and campo != 'por_mensagem' and valor is not None:
+                dados[campo] = valor
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            dados['exc'] = record.exc_text
+        return json.dumps(dados, ensure_ascii=False, separators=(',', ':'), default=str)
+
+
+# Enfileira sem bloquear: com a fila cheia o registro é descartado e
+# contado, em vez de segurar a thread que está atendendo
+class HandlerFila(logging.handlers.QueueHandler):
+    def __init__(self, fila: queue.Queue):
+        super().__init__(fila)
+        self.descartados = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Só junta msg e args e captura o traceback; a formatação final
+        # (texto ou JSON) fica para a thread do listener
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.descartados += 1
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_handler_fila: Optional[HandlerFila] = None
+
+
+def _criar_destinos(arquivo: Optional[str], tamanho_maximo: int, backups: int, formato: str) -> List[logging.Handler]:
+    if formato == 'json':
+        formatador = FormatadorJSON()
+    else:
+        formatador = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    destinos: List[logging.Handler] = [logging.StreamHandler(sys.stdout)]
+    if arquivo:
+        if tamanho_maximo > 0:
+            destinos.append(logging.handlers.RotatingFileHandler(
+                arquivo, maxBytes=tamanho_maximo, backupCount=backups, encoding='utf-8'
+            ))
+        else:
+            destinos.append(logging.FileHandler(arquivo, encoding='utf-8'))
+    for destino in destinos:
+        destino.setFormatter(formatador)
+    return destinos
+
+
+# modo 'fila': as threads do bot só enfileiram; uma thread do QueueListener
+# formata e escreve no stdout e no arquivo rotativo. modo 'sincrono': os
+# mesmos destinos escritos direto por quem loga, como antes.
+def configurar_logging(
+    modo: str = 'fila',
+    nivel: str = 'INFO',
+    arquivo: Optional[str] = 'bot.log',
+    tamanho_maximo: int = 10 * 1024 * 1024,
+    backups: int = 5,
+    formato: str = 'texto',
+    amostragem: float = 1.0,
+    capacidade_fila: int = 10000
+):
+    global _listener, _handler_fila
+    if modo not in ('fila', 'sincrono'):
+        raise ValueError(f"Modo de log desconhecido: {modo}")
+
+    destinos = _criar_destinos(arquivo, tamanho_maximo, backups, formato)
+    filtro = FiltroAmostragem(amostragem)
+
+    raiz = logging.getLogger()
+    raiz.setLevel(nivel)
+    for handler in list(raiz.handlers):
+        raiz.removeHandler(handler)
+
+    if modo == 'sincrono':
+        for destino in destinos:
+            destino.addFilter(filtro)
+            raiz.addHandler(destino)
+        return
+
+    # A amostragem roda antes de enfileirar: linhas descartadas não custam nada
+    _handler_fila = HandlerFila(queue.Queue(capacidade_fila))
+    _handler_fila.addFilter(filtro)
+    raiz.addHandler(_handler_fila)
+    _listener = logging.handlers.QueueListener(_handler_fila.queue, *destinos, respect_handler_level=True)
+    _listener.start()
+    atexit.register(encerrar_logging)
+
+
+# Escoa a fila e para a thread do listener; chamado no encerramento do bot
+def encerrar_logging():
+    global _listener
+    if _listener is None:
+        return
+    listener, _listener = _listener, None
+    listener.stop()
+    if _handler_fila is not None and _handler_fila.descartados:
+        for destino in listener.handlers:
+            destino.handle(logging.makeLogRecord({
+                'name': __name__, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                'msg': f"{_handler_fila.descartados} registros de log descartados com a fila cheia",
+            }))
+
+
+def metricas_logging() -> Dict[str, Any]:
+    if _handler_fila is None:
+        return {}
+    return {'fila': _handler_fila.queue.qsize(), 'descartados': _handler_fila.descartados}
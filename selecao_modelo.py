@@ -0,0 +1,104 @@
+import os
+import json
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Dict, Any, List, Optional
+
+import google.generativeai as genai
+
+logger = logging.getLogger(__name__)
+
+
+# Sonda um modelo pelos metadados (models.get), sem gastar cota de geração
+def sondar_modelo(nome_modelo: str) -> Dict[str, Any]:
+    inicio = time.monotonic()
+    try:
+        info = genai.get_model(f'models/{nome_modelo}')
+        metodos = getattr(info, 'supported_generation_methods', None) or []
+        saudavel = 'generateContent' in metodos
+        erro = None if saudavel else "Modelo não suporta generateContent"
+    except Exception as e:
+        saudavel = False
+        erro = str(e)
+    return {
+        'saudavel': saudavel,
+        'latencia': round(time.monotonic() - inicio, 3),
+        'erro': erro,
+    }
+
+
+def sondar_modelos(nomes: List[str], tempo_limite: float = 10.0) -> Dict[str, Dict[str, Any]]:
+    executor = ThreadPoolExecutor(max_workers=len(nomes), thread_name_prefix='sonda-modelo')
+    futuros = {nome: executor.submit(sondar_modelo, nome) for nome in nomes}
+    wait(futuros.values(), timeout=tempo_limite)
+    # Não espera sondas travadas: quem não respondeu no prazo conta como indisponível
+    executor.shutdown(wait=False)
+
+    saude = {}
+    for nome, futuro in futuros.items():
+        if futuro.done():
+            saude[nome] = futuro.result()
+        else:
+            saude[nome] = {'saudavel': False, 'latencia': tempo_limite, 'erro': 'Tempo esgotado'}
+    return saude
+
+
+def ler_cache_modelo(caminho: str) -> Optional[Dict[str, Any]]:
+    if not os.path.exists(caminho):
+        return None
+    try:
+        with open(caminho, encoding='utf-8') as arquivo:
+            return json.load(arquivo)
+    except Exception as e:
+        logger.warning(f"Cache de modelo ilegível ({caminho}): {e}")
+        return None
+
+
+def gravar_cache_modelo(caminho: str, dados: Dict[str, Any]):
+    temporario = caminho + '.tmp'
+    try:
+        with open(temporario, 'w', encoding='utf-8') as arquivo:
+            json.dump(dados, arquivo, ensure_ascii=False, indent=2)
+        os.replace(temporario, caminho)
+    except Exception as e:
+        logger.warning(f"Não foi possível gravar o cache de modelo: {e}")
+
+
+# Escolhe o primeiro modelo saudável na ordem de preferência. Com um cache
+# válido para a mesma lista de modelos, nenhuma sonda é feita.
+def escolher_modelo(
+    nomes: List[str],
+    caminho_cache: str,
+    ttl: float,
+    tempo_limite: float = 10.0
+) -> Optional[Dict[str, Any]]:
+    cache = ler_cache_modelo(caminho_cache)
+    if (
+        cache
+        and cache.get('modelos') == list(nomes)
+        and cache.get('modelo') in nomes
+        and time.time() - cache.get('verificado_em', 0) < ttl
+    ):
+        logger.info(f"Modelo {cache['modelo']} obtido do cache (sem sondagem)")
+        return cache
+
+    inicio = time.monotonic()
+    saude = sondar_modelos(nomes, tempo_limite)
+    for nome, estado in saude.items():
+        if not estado['saudavel']:
+            logger.warning(f"Modelo {nome} indisponível: {estado['erro']}")
+
+    escolhido = next((nome for nome in nomes if saude[nome]['saudavel']), None)
+    logger.info(f"Sondagem de {len(nomes)} modelos concluída em {time.monotonic() - inicio:.2f}s")
+    if escolhido is None:
+        return None
+
+    dados = {
+        'modelo': escolhido,
+        'modelos': list(nomes),
+        'saude': saude,
+        'verificado_em': time.time(),
+    }
+    gravar_cache_modelo(caminho_cache, dados)
+    return dados
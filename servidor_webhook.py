@@ -0,0 +1,169 @@
+import json
+import hmac
+import queue
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+# Servidor HTTP embutido que recebe os updates do Telegram. Cada update é
+# confirmado na hora e colocado numa fila limitada; com a fila cheia a
+# resposta é 503 e o Telegram reenvia depois, o que serve de backpressure.
+# Há uma fila por consumidor e o update vai para a fila escolhida pelo
+# remetente (from.id), então os updates de um técnico chegam ao processamento
+# na ordem em que foram recebidos, mesmo com vários consumidores.
+class ServidorWebhook:
+    def __init__(
+        self,
+        processar: Callable[[Dict[str, Any]], None],
+        caminho: str = '/telegram/webhook',
+        host: str = '0.0.0.0',
+        porta: int = 8080,
+        token_secreto: Optional[str] = None,
+        capacidade_fila: int = 100,
+        num_consumidores: int = 2
+    ):
+        self.processar = processar
+        self.caminho = caminho
+        self.token_secreto = token_secreto
+        self.num_consumidores = num_consumidores
+
+        capacidade_por_fila = max(1, capacidade_fila // num_consumidores)
+        self._filas: List[queue.Queue] = [queue.Queue(capacidade_por_fila) for _ in range(num_consumidores)]
+        self._lock = threading.Lock()
+        self._recebidos = 0
+        self._rejeitados = 0
+        self._processados = 0
+        self._erros = 0
+
+        self._servidor = ThreadingHTTPServer((host, porta), self._criar_handler())
+        self._servidor.daemon_threads = True
+        self._consumidores = [
+            threading.Thread(target=self._consumir, args=(fila,), name=f'webhook-{i}', daemon=True)
+            for i, fila in enumerate(self._filas)
+        ]
+
+    @property
+    def porta(self) -> int:
+        return self._servidor.server_address[1]
+
+    def _criar_handler(self):
+        servidor = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _responder(self, status: int, corpo: bytes = b'', cabecalhos=None):
+                self.send_response(status)
+                for nome, valor in (cabecalhos or {}).items():
+                    self.send_header(nome, valor)
+                self.send_header('Content-Length', str(len(corpo)))
+                self.end_headers()
+                if corpo:
+                    self.wfile.write(corpo)
+
+            def do_GET(self):
+                if self.path == '/saude':
+                    corpo = json.dumps(servidor.metricas()).encode('utf-8')
+                    self._responder(200, corpo, {'Content-Type': 'application/json'})
+                else:
+                    self._responder(404)
+
+            def do_POST(self):
+                if self.path != servidor.caminho:
+                    self._responder(404)
+                    return
+
+                if servidor.token_secreto:
+                    recebido = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+                    if not hmac.compare_digest(recebido, servidor.token_secreto):
+                        self._responder(403)
+                        return
+
+                try:
+                    tamanho = int(self.headers.get('Content-Length', 0))
+                    update = json.loads(self.rfile.read(tamanho))
+                except (ValueError, json.JSONDecodeError):
+                    self._responder(400)
+                    return
+
+                if servidor.enfileirar(update):
+                    self._responder(200)
+                else:
+                    self._responder(503, cabecalhos={'Retry-After': '1'})
+
+            def log_message(self, formato, *args):
+                logger.debug(f"Webhook {self.address_string()}: {formato % args}")
+
+        return Handler
+
+    # Remetente do update (mensagem, edição, callback...); sem remetente, o
+    # update_id só distribui a carga
+    @staticmethod
+    def _chave(update: Dict[str, Any]) -> Any:
+        for campo, valor in update.items():
+            if campo != 'update_id' and isinstance(valor, dict) and isinstance(valor.get('from'), dict):
+                return valor['from'].get('id')
+        return update.get('update_id')
+
+    def enfileirar(self, update: Dict[str, Any]) -> bool:
+        fila = self._filas[hash(self._chave(update)) % len(self._filas)]
+        try:
+            fila.put_nowait(update)
+        except queue.Full:
+            with self._lock:
+                self._rejeitados += 1
+            logger.warning("Fila do webhook cheia; update devolvido ao Telegram")
+            return False
+        with self._lock:
+            self._recebidos += 1
+        return True
+
+    def _consumir(self, fila: queue.Queue):
+        while True:
+            update = fila.get()
+            if update is None:
+                fila.task_done()
+                break
+            try:
+                self.processar(update)
+                with self._lock:
+                    self._processados += 1
+            except Exception as e:
+                with self._lock:
+                    self._erros += 1
+                logger.error(f"Erro ao processar update do webhook: {e}", exc_info=True)
+            finally:
+                fila.task_done()
+
+    def metricas(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'profundidade_fila': sum(fila.qsize() for fila in self._filas),
+                'capacidade_fila': sum(fila.maxsize for fila in self._filas),
+                'recebidos': self._recebidos,
+                'rejeitados': self._rejeitados,
+                'processados': self._processados,
+                'erros': self._erros,
+            }
+
+    def iniciar(self):
+        for consumidor in self._consumidores:
+            consumidor.start()
+        logger.info(f"Servidor de webhook ouvindo na porta {self.porta}, caminho {self.caminho}")
+
+    def servir(self):
+        self._servidor.serve_forever()
+
+    # Interrompe servir() a partir de outra thread
+    def parar(self):
+        self._servidor.shutdown()
+
+    def encerrar(self):
+        self.parar()
+        self._servidor.server_close()
+        for fila in self._filas:
+            fila.put(None)
+        for consumidor in self._consumidores:
+            consumidor.join()
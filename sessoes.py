@@ -0,0 +1,371 @@
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+# Registro compacto de uma conversa. A solução não fica na sessão: guarda-se
+# só a referência para o corpo no ArmazemTextos.
+class Sessao:
+    __slots__ = ('stage', 'equipamento', 'problema', 'solucao_ref', 'extras', 'atualizado_em')
+
+    CAMPOS = ('stage', 'equipamento', 'problema')
+
+    def __init__(self, stage='intro', equipamento=None, problema=None,
+                 solucao_ref=None, extras=None, atualizado_em=0.0):
+        self.stage = stage
+        self.equipamento = equipamento
+        self.problema = problema
+        self.solucao_ref = solucao_ref
+        self.extras = extras
+        self.atualizado_em = atualizado_em
+
+
+# Corpos de solução guardados uma única vez, endereçados pelo hash do texto
+# e comprimidos acima de um tamanho mínimo. Um contador de referências
+# libera o corpo quando nenhuma sessão aponta mais para ele.
+class ArmazemTextos:
+    def __init__(self, comprimir_acima: int = 256):
+        self.comprimir_acima = comprimir_acima
+        self._corpos: Dict[str, bytes] = {}
+        self._referencias: Dict[str, int] = {}
+        self._comprimidos = set()
+
+    def __len__(self):
+        return len(self._corpos)
+
+    @staticmethod
+    def referencia(texto: str) -> str:
+        return hashlib.sha1(texto.encode('utf-8')).hexdigest()
+
+    def codificar(self, texto: str) -> Tuple[bytes, bool]:
+        dados = texto.encode('utf-8')
+        if len(dados) >= self.comprimir_acima:
+            comprimido = zlib.compress(dados, 6)
+            if len(comprimido) < len(dados):
+                return comprimido, True
+        return dados, False
+
+    def adicionar(self, texto: str) -> Tuple[str, bool]:
+        ref = self.referencia(texto)
+        novo = ref not in self._corpos
+        if novo:
+            corpo, comprimido = self.codificar(texto)
+            self.carregar(ref, corpo, comprimido)
+        self._referencias[ref] = self._referencias.get(ref, 0) + 1
+        return ref, novo
+
+    def carregar(self, ref: str, corpo: bytes, comprimido: bool):
+        self._corpos[ref] = corpo
+        self._referencias.setdefault(ref, 0)
+        if comprimido:
+            self._comprimidos.add(ref)
+
+    def reter(self, ref: str):
+        self._referencias[ref] = self._referencias.get(ref, 0) + 1
+
+    # Devolve True quando o corpo deixou de ser usado e foi descartado
+    def liberar(self, ref: str) -> bool:
+        restantes = self._referencias.get(ref, 0) - 1
+        if restantes > 0:
+            self._referencias[ref] = restantes
+            return False
+        self._referencias.pop(ref, None)
+        self._corpos.pop(ref, None)
+        self._comprimidos.discard(ref)
+        return True
+
+    def obter(self, ref: str) -> Optional[str]:
+        corpo = self._corpos.get(ref)
+        if corpo is None:
+            return None
+        if ref in self._comprimidos:
+            corpo = zlib.decompress(corpo)
+        return corpo.decode('utf-8')
+
+    def corpo(self, ref: str) -> Tuple[bytes, bool]:
+        return self._corpos[ref], ref in self._comprimidos
+
+    def bytes_armazenados(self) -> int:
+        return sum(len(corpo) for corpo in self._corpos.values())
+
+
+# Persistência opcional em SQLite para que conversas em andamento
+# sobrevivam a reinícios. Cada alteração é gravada na hora (write-through).
+class PersistenciaSQLite:
+    def __init__(self, caminho: str):
+        self._conexao = sqlite3.connect(caminho, check_same_thread=False, isolation_level=None)
+        self._conexao.execute('PRAGMA journal_mode=WAL')
+        self._conexao.execute('PRAGMA synchronous=NORMAL')
+        self._conexao.execute("""
+            CREATE TABLE IF NOT EXISTS sessoes (
+                user_id TEXT PRIMARY KEY,
+                stage TEXT NOT NULL,
+                equipamento TEXT,
+                problema TEXT,
+                solucao_ref TEXT,
+                extras TEXT,
+                atualizado_em REAL NOT NULL
+            )
+        """)
+        self._conexao.execute("""
+            CREATE TABLE IF NOT EXISTS textos (
+                ref TEXT PRIMARY KEY,
+                corpo BLOB NOT NULL,
+                comprimido INTEGER NOT NULL
+            )
+        """)
+
+    def gravar_sessao(self, user_id, sessao: Sessao):
+        self._conexao.execute(
+            'INSERT OR REPLACE INTO sessoes VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (str(user_id), sessao.stage, sessao.equipamento, sessao.problema, sessao.solucao_ref,
+             json.dumps(sessao.extras, ensure_ascii=False) if sessao.extras else None,
+             sessao.atualizado_em)
+        )
+
+    def remover_sessao(self, user_id):
+        self._conexao.execute('DELETE FROM sessoes WHERE user_id = ?', (str(user_id),))
+
+    def gravar_texto(self, ref: str, corpo: bytes, comprimido: bool):
+        self._conexao.execute(
+            'INSERT OR IGNORE INTO textos VALUES (?, ?, ?)', (ref, corpo, int(comprimido))
+        )
+
+    def remover_texto(self, ref: str):
+        self._conexao.execute('DELETE FROM textos WHERE ref = ?', (ref,))
+
+    # Descarta sessões expiradas e textos órfãos, devolvendo o restante
+    # da mais antiga para a mais recente
+    def carregar(self, limite_atividade: float):
+        self._conexao.execute('DELETE FROM sessoes WHERE atualizado_em < ?', (limite_atividade,))
+        self._conexao.execute(
+            'DELETE FROM textos WHERE ref NOT IN '
+            '(SELECT solucao_ref FROM sessoes WHERE solucao_ref IS NOT NULL)'
+        )
+        sessoes = self._conexao.execute(
+            'SELECT user_id, stage, equipamento, problema, solucao_ref, extras, atualizado_em '
+            'FROM sessoes ORDER BY atualizado_em'
+        ).fetchall()
+        textos = self._conexao.execute('SELECT ref, corpo, comprimido FROM textos').fetchall()
+        return sessoes, textos
+
+    def fechar(self):
+        self._conexao.close()
+
+
+# Estado de conversa por usuário, limitado em tamanho e tempo de inatividade.
+# Mantém a interface de dicionário usada pelo fluxo de atendimento; as
+# leituras devolvem cópias, e o acesso é protegido por lock porque os
+# handlers rodam em vários workers ao mesmo tempo.
+class EstadoUsuarios:
+    def __init__(
+        self,
+        ttl_inatividade: Optional[float] = None,
+        maximo_sessoes: int = 0,
+        persistencia: Optional[PersistenciaSQLite] = None,
+        comprimir_acima: int = 256
+    ):
+        self.ttl_inatividade = ttl_inatividade
+        self.maximo_sessoes = maximo_sessoes
+        self.persistencia = persistencia
+
+        # Ordem de acesso: a sessão inativa há mais tempo fica no início
+        self._sessoes: 'OrderedDict[Any, Sessao]' = OrderedDict()
+        self._textos = ArmazemTextos(comprimir_acima)
+        self._lock = threading.RLock()
+        self.expiradas = 0
+        self.despejadas = 0
+
+        if persistencia is not None:
+            self._restaurar()
+
+    def _restaurar(self):
+        limite = time.time() - self.ttl_inatividade if self.ttl_inatividade else 0.0
+        sessoes, textos = self.persistencia.carregar(limite)
+        for ref, corpo, comprimido in textos:
+            self._textos.carregar(ref, bytes(corpo), bool(comprimido))
+        for user_id, stage, equipamento, problema, solucao_ref, extras, atualizado_em in sessoes:
+            if solucao_ref is not None and self._textos.obter(solucao_ref) is None:
+                solucao_ref = None
+            sessao = Sessao(
+                stage, equipamento, problema, solucao_ref,
+                json.loads(extras) if extras else None, atualizado_em
+            )
+            if solucao_ref is not None:
+                self._textos.reter(solucao_ref)
+            self._sessoes[self._chave_restaurada(user_id)] = sessao
+        self._aplicar_limite()
+        logger.info(f"{len(self._sessoes)} sessões restauradas do disco")
+
+    @staticmethod
+    def _chave_restaurada(user_id: str):
+        # IDs do Telegram são inteiros; o SQLite guarda como texto
+        try:
+            return int(user_id)
+        except ValueError:
+            return user_id
+
+    def _expirada(self, sessao: Sessao, agora: float) -> bool:
+        return bool(self.ttl_inatividade) and agora - sessao.atualizado_em > self.ttl_inatividade
+
+    def _descartar(self, user_id, persistir: bool = True):
+        sessao = self._sessoes.pop(user_id, None)
+        if sessao is None:
+            return
+        self._soltar_texto(sessao.solucao_ref)
+        if persistir and self.persistencia is not None:
+            self.persistencia.remover_sessao(user_id)
+
+    def _soltar_texto(self, ref: Optional[str]):
+        if ref is not None and self._textos.liberar(ref) and self.persistencia is not None:
+            self.persistencia.remover_texto(ref)
+
+    # Só olha o início da fila de acesso, então o custo é proporcional
+    # ao número de sessões efetivamente expiradas
+    def _remover_expiradas(self, agora: float):
+        while self._sessoes:
+            user_id, sessao = next(iter(self._sessoes.items()))
+            if not self._expirada(sessao, agora):
+                break
+            self._descartar(user_id)
+            self.expiradas += 1
+
+    def _aplicar_limite(self):
+        while self.maximo_sessoes and len(self._sessoes) > self.maximo_sessoes:
+            self._descartar(next(iter(self._sessoes)))
+            self.despejadas += 1
+
+    def _ativa(self, user_id) -> Optional[Sessao]:
+        sessao = self._sessoes.get(user_id)
+        if sessao is not None and self._expirada(sessao, time.time()):
+            self._descartar(user_id)
+            self.expiradas += 1
+            return None
+        return sessao
+
+    def _para_dict(self, sessao: Sessao) -> Dict[str, Any]:
+        estado: Dict[str, Any] = {'stage': sessao.stage}
+        if sessao.equipamento is not None:
+            estado['equipamento'] = sessao.equipamento
+        if sessao.problema is not None:
+            estado['problema'] = sessao.problema
+        if sessao.solucao_ref is not None:
+            estado['solucao'] = self._textos.obter(sessao.solucao_ref)
+        if sessao.extras:
+            estado.update(sessao.extras)
+        return estado
+
+    def _gravar(self, user_id, estado: Dict[str, Any]):
+        agora = time.time()
+        self._remover_expiradas(agora)
+
+        anterior = self._sessoes.get(user_id)
+        ref_anterior = anterior.solucao_ref if anterior is not None else None
+
+        solucao = estado.get('solucao')
+        ref = None
+        if solucao is not None:
+            ref, novo = self._textos.adicionar(solucao)
+            if novo and self.persistencia is not None:
+                self.persistencia.gravar_texto(ref, *self._textos.corpo(ref))
+
+        extras = {
+            campo: valor for campo, valor in estado.items()
+            if campo not in Sessao.CAMPOS and campo != 'solucao'
+        }
+        sessao = Sessao(
+            estado.get('stage', 'intro'), estado.get('equipamento'), estado.get('problema'),
+            ref, extras or None, agora
+        )
+        self._sessoes[user_id] = sessao
+        self._sessoes.move_to_end(user_id)
+        if self.persistencia is not None:
+            self.persistencia.gravar_sessao(user_id, sessao)
+
+        # Solta a referência antiga só depois de reter a nova, para não
+        # descartar um corpo que continua em uso pela mesma sessão
+        self._soltar_texto(ref_anterior)
+        self._aplicar_limite()
+
+    def __contains__(self, user_id):
+        with self._lock:
+            return self._ativa(user_id) is not None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessoes)
+
+    def __getitem__(self, user_id) -> Dict[str, Any]:
+        with self._lock:
+            sessao = self._ativa(user_id)
+            if sessao is None:
+                raise KeyError(user_id)
+            return self._para_dict(sessao)
+
+    def __setitem__(self, user_id, estado: Dict[str, Any]):
+        with self._lock:
+            self._gravar(user_id, estado)
+
+    def __delitem__(self, user_id):
+        with self._lock:
+            if user_id not in self._sessoes:
+                raise KeyError(user_id)
+            self._descartar(user_id)
+
+    def get(self, user_id, padrao=None):
+        with self._lock:
+            sessao = self._ativa(user_id)
+            return self._para_dict(sessao) if sessao is not None else padrao
+
+    def atualizar(self, user_id, **campos):
+        with self._lock:
+            sessao = self._ativa(user_id)
+            estado = self._para_dict(sessao) if sessao is not None else {}
+            estado.update(campos)
+            self._gravar(user_id, estado)
+
+    def limpar_expiradas(self) -> int:
+        with self._lock:
+            antes = self.expiradas
+            self._remover_expiradas(time.time())
+            return self.expiradas - antes
+
+    def estatisticas(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'sessoes': len(self._sessoes),
+                'maximo_sessoes': self.maximo_sessoes,
+                'textos': len(self._textos),
+                'bytes_textos': self._textos.bytes_armazenados(),
+                'expiradas': self.expiradas,
+                'despejadas': self.despejadas,
+            }
+
+    def fechar(self):
+        with self._lock:
+            if self.persistencia is not None:
+                self.persistencia.fechar()
+                self.persistencia = None
+
+
+def criar_estado_usuarios(
+    backend: str,
+    ttl_inatividade: Optional[float],
+    maximo_sessoes: int,
+    caminho: str = 'sessoes.sqlite3'
+) -> EstadoUsuarios:
+    if backend == 'sqlite':
+        persistencia = PersistenciaSQLite(caminho)
+    elif backend == 'memoria':
+        persistencia = None
+    else:
+        raise ValueError(f"Backend de sessões desconhecido: {backend}")
+    return EstadoUsuarios(ttl_inatividade, maximo_sessoes, persistencia)
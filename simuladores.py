@@ -0,0 +1,566 @@
+import re
+import json
+import time
+import uuid
+import random
+import asyncio
+import logging
+import threading
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+from google.api_core import exceptions as erros_google
+from google.cloud import firestore
+
+logger = logging.getLogger(__name__)
+
+# Substitutos locais dos serviços externos, usados pelo benchmark de carga:
+# a API de bots do Telegram (servidor HTTP), o Gemini (latência e falhas
+# configuráveis) e o Firestore (em memória)
+
+
+# Latência log-normal: mediana fixa e cauda controlada pela dispersão,
+# parecida com o que se observa em chamadas a APIs externas
+class DistribuicaoLatencia:
+    def __init__(self, mediana: float, dispersao: float = 0.5):
+        self.mediana = mediana
+        self.dispersao = dispersao
+
+    def amostrar(self, aleatorio: random.Random) -> float:
+        if self.mediana <= 0:
+            return 0.0
+        return self.mediana * aleatorio.lognormvariate(0.0, self.dispersao)
+
+
+# ---------------------------------------------------------------- Telegram
+
+class _ManipuladorTelegram(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, formato, *args):
+        return
+
+    def _responder(self, status: int, corpo: Dict[str, Any]):
+        dados = json.dumps(corpo).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(dados)))
+        self.end_headers()
+        self.wfile.write(dados)
+
+    def _atender(self):
+        url = urlsplit(self.path)
+        metodo = url.path.rsplit('/', 1)[-1]
+        parametros = dict(parse_qsl(url.query))
+        tamanho = int(self.headers.get('Content-Length') or 0)
+        if tamanho:
+            corpo = self.rfile.read(tamanho)
+            if 'x-www-form-urlencoded' in (self.headers.get('Content-Type') or ''):
+                parametros.update(parse_qsl(corpo.decode('utf-8')))
+        status, resposta = self.server.simulador.atender(metodo, parametros)
+        self._responder(status, resposta)
+
+    do_GET = _atender
+    do_POST = _atender
+
+
+# Responde aos métodos que o bot usa (sendMessage, editMessageText,
+# deleteMessage...) com o formato da API real. Opcionalmente devolve 429
+# com retry_after, para exercitar o agendador de envios.
+class TelegramFalso:
+    def __init__(
+        self,
+        host: str = '127.0.0.1',
+        porta: int = 0,
+        latencia: float = 0.0,
+        taxa_429: float = 0.0,
+        retry_after: int = 1,
+        semente: Optional[int] = None
+    ):
+        self.latencia = DistribuicaoLatencia(latencia)
+        self.taxa_429 = taxa_429
+        self.retry_after = retry_after
+        self._aleatorio = random.Random(semente)
+        self._lock = threading.Lock()
+        self._proximo_id = 1
+        self.chamadas: Dict[str, int] = {}
+        self.respostas_429 = 0
+
+        self._servidor = ThreadingHTTPServer((host, porta), _ManipuladorTelegram)
+        self._servidor.daemon_threads = True
+        self._servidor.simulador = self
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def api_url(self) -> str:
+        # Formato de telebot.apihelper.API_URL: {0} é o token e {1} o método
+        host, porta = self._servidor.server_address[:2]
+        return f'http://{host}:{porta}/bot{{0}}/{{1}}'
+
+    def iniciar(self) -> 'TelegramFalso':
+        self._thread = threading.Thread(
+            target=self._servidor.serve_forever, name='telegram-falso', daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def parar(self):
+        self._servidor.shutdown()
+        self._servidor.server_close()
+
+    def atender(self, metodo: str, parametros: Dict[str, str]) -> Tuple[int, Dict[str, Any]]:
+        with self._lock:
+            self.chamadas[metodo] = self.chamadas.get(metodo, 0) + 1
+            espera = self.latencia.amostrar(self._aleatorio)
+            limitar = self.taxa_429 and self._aleatorio.random() < self.taxa_429
+            if limitar:
+                self.respostas_429 += 1
+            message_id = self._proximo_id
+            self._proximo_id += 1
+        if espera:
+            time.sleep(espera)
+
+        if limitar:
+            return 429, {
+                'ok': False,
+                'error_code': 429,
+                'description': f'Too Many Requests: retry after {self.retry_after}',
+                'parameters': {'retry_after': self.retry_after},
+            }
+        if metodo == 'getMe':
+            return 200, {'ok': True, 'result': {
+                'id': 1, 'is_bot': True, 'first_name': 'Bot de carga', 'username': 'bot_carga'
+            }}
+        if metodo in ('deleteMessage', 'deleteWebhook', 'setWebhook'):
+            return 200, {'ok': True, 'result': True}
+
+        chat_id = int(parametros.get('chat_id', 0))
+        if metodo == 'editMessageText':
+            message_id = int(parametros.get('message_id', message_id))
+        return 200, {'ok': True, 'result': {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'text': parametros.get('text', ''),
+        }}
+
+    def metricas(self) -> Dict[str, Any]:
+        with self._lock:
+            return {'chamadas': dict(self.chamadas), 'respostas_429': self.respostas_429}
+
+
+# ------------------------------------------------------------------ Gemini
+
+class _RespostaFalsa:
+    def __init__(self, texto: str):
+        self.text = texto
+
+
+class _ContagemFalsa:
+    def __init__(self, total_tokens: int):
+        self.total_tokens = total_tokens
+
+
+# Tokenização aproximada: palavras em pedaços de até 4 letras e cada símbolo
+_PADRAO_TOKEN = re.compile(r'\w{1,4}|[^\w\s]')
+
+
+def _texto_conteudos(conteudos) -> str:
+    if isinstance(conteudos, str):
+        return conteudos
+    return '\n'.join(
+        parte for conteudo in conteudos
+        for parte in (conteudo['parts'] if isinstance(conteudo, dict) else [conteudo])
+    )
+
+
+_SECOES = (
+    ('❗', 'PROBLEMA IDENTIFICADO'),
+    ('📋', 'ANÁLISE TÉCNICA APROFUNDADA'),
+    ('🔍', 'CAUSAS PROVÁVEIS'),
+    ('🛠️', 'PROCEDIMENTO DIAGNÓSTICO'),
+)
+_PALAVRAS = (
+    'bomba hidráulica relé contator motor tração bateria fusível sensor válvula pressão '
+    'óleo vazamento cabo conector placa controlador freio encoder chicote aterramento'
+).split()
+
+
+# Mesma interface do GenerativeModel usada pelo bot. A latência segue uma
+# log-normal; uma fração das chamadas falha com os erros que a API devolve
+# sob carga (503 e 429), e o texto imita o formato pedido no prompt.
+class GeminiFalso:
+    def __init__(
+        self,
+        nome: str,
+        latencia: float = 2.0,
+        dispersao: float = 0.5,
+        taxa_falhas: float = 0.0,
+        tamanho_resposta: Tuple[int, int] = (1500, 5000),
+        partes_stream: int = 8,
+        semente: Optional[int] = None
+    ):
+        self.nome = nome
+        self.latencia = DistribuicaoLatencia(latencia, dispersao)
+        self.taxa_falhas = taxa_falhas
+        self.tamanho_resposta = tamanho_resposta
+        self.partes_stream = partes_stream
+        self._aleatorio = random.Random(semente)
+        self._lock = threading.Lock()
+        self.chamadas = 0
+        self.falhas = 0
+
+    def _sortear(self) -> Tuple[float, Optional[Exception], int]:
+        with self._lock:
+            self.chamadas += 1
+            espera = self.latencia.amostrar(self._aleatorio)
+            erro = None
+            if self.taxa_falhas and self._aleatorio.random() < self.taxa_falhas:
+                self.falhas += 1
+                erro = self._aleatorio.choice((
+                    erros_google.ServiceUnavailable(f"{self.nome} sobrecarregado (simulado)"),
+                    erros_google.ResourceExhausted(f"Cota de {self.nome} esgotada (simulado)"),
+                ))
+            tamanho = self._aleatorio.randint(*self.tamanho_resposta)
+            semente = self._aleatorio.random()
+        return espera, erro, self._gerar_texto(tamanho, semente)
+
+    @staticmethod
+    def _gerar_texto(tamanho: int, semente: float) -> str:
+        aleatorio = random.Random(semente)
+
+        def frase(minimo=6, maximo=16):
+            return ' '.join(aleatorio.choice(_PALAVRAS) for _ in range(aleatorio.randint(minimo, maximo)))
+
+        linhas = ['🔧 DIAGNÓSTICO TÉCNICO', '']
+        total = 0
+        while total < tamanho:
+            for icone, titulo in _SECOES:
+                linhas.append(f'{icone} <b>{titulo}</b>')
+                linhas.extend(f'* {frase()}' for _ in range(3))
+                linhas.extend(f'{passo}. {frase()}' for passo in range(1, 4))
+                linhas.append('')
+                total += sum(len(linha) + 1 for linha in linhas[-8:])
+        return '\n'.join(linhas)
+
+    def count_tokens(self, conteudos, **kwargs) -> _ContagemFalsa:
+        time.sleep(self.latencia.mediana / 20)
+        return _ContagemFalsa(len(_PADRAO_TOKEN.findall(_texto_conteudos(conteudos))))
+
+    def _partes(self, texto: str) -> List[str]:
+        passo = max(1, len(texto) // self.partes_stream)
+        return [texto[i:i + passo] for i in range(0, len(texto), passo)]
+
+    def generate_content(self, prompt, stream: bool = False, **kwargs):
+        espera, erro, texto = self._sortear()
+        if not stream:
+            time.sleep(espera)
+            if erro is not None:
+                raise erro
+            return _RespostaFalsa(texto)
+        return self._transmitir(espera, erro, texto)
+
+    def _transmitir(self, espera, erro, texto):
+        # Metade da latência até o primeiro trecho, o resto distribuído
+        partes = self._partes(texto)
+        time.sleep(espera / 2)
+        if erro is not None:
+            raise erro
+        for parte in partes:
+            yield _RespostaFalsa(parte)
+            time.sleep(espera / 2 / len(partes))
+
+    async def generate_content_async(self, prompt, stream: bool = False, **kwargs):
+        espera, erro, texto = self._sortear()
+        if not stream:
+            await asyncio.sleep(espera)
+            if erro is not None:
+                raise erro
+            return _RespostaFalsa(texto)
+        return self._transmitir_async(espera, erro, texto)
+
+    async def _transmitir_async(self, espera, erro, texto):
+        partes = self._partes(texto)
+        await asyncio.sleep(espera / 2)
+        if erro is not None:
+            raise erro
+        for parte in partes:
+            yield _RespostaFalsa(parte)
+            await asyncio.sleep(espera / 2 / len(partes))
+
+
+# --------------------------------------------------------------- Firestore
+
+def _resolver_valor(valor, atual=None):
+    if valor is firestore.SERVER_TIMESTAMP:
+        return datetime.now(timezone.utc)
+    if isinstance(valor, firestore.ArrayUnion):
+        existentes = list(atual or [])
+        return existentes + [v for v in valor.values if v not in existentes]
+    return valor
+
+
+class _Snapshot:
+    def __init__(self, doc_id: str, dados: Optional[Dict[str, Any]], reference: Optional['_Documento'] = None):
+        self.id = doc_id
+        self._dados = dados
+        self.reference = reference
+
+    @property
+    def exists(self) -> bool:
+        return self._dados is not None
+
+    def to_dict(self) -> Optional[Dict[str, Any]]:
+        return dict(self._dados) if self._dados is not None else None
+
+
+class _Documento:
+    def __init__(self, banco: 'FirestoreMemoria', colecao: str, doc_id: Optional[str] = None):
+        self._banco = banco
+        self._colecao = colecao
+        self.id = doc_id or uuid.uuid4().hex[:20]
+
+    def set(self, dados: Dict[str, Any], merge: bool = False):
+        self._banco._gravar(self._colecao, self.id, dados, merge)
+
+    def update(self, dados: Dict[str, Any]):
+        self._banco._gravar(self._colecao, self.id, dados, True, exigir=True)
+
+    def get(self) -> _Snapshot:
+        return _Snapshot(self.id, self._banco._ler(self._colecao, self.id), self)
+
+    def delete(self):
+        self._banco._gravar(self._colecao, self.id, None, False)
+
+
+_OPERADORES = {
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+    'in': lambda a, b: a in b,
+    'array_contains': lambda a, b: b in (a or []),
+}
+
+
+class _Consulta:
+    def __init__(
+        self, banco: 'FirestoreMemoria', colecao: str, filtros=(), ordem=(), limite=None, cursor=None
+    ):
+        self._banco = banco
+        self._colecao = colecao
+        self._filtros = tuple(filtros)
+        self._ordem = tuple(ordem)
+        self._limite = limite
+        self._cursor = cursor
+
+    def where(self, campo: str, operador: str, valor) -> '_Consulta':
+        return _Consulta(
+            self._banco, self._colecao, self._filtros + ((campo, _OPERADORES[operador], valor),),
+            self._ordem, self._limite, self._cursor
+        )
+
+    def order_by(self, campo: str, direction: str = 'ASCENDING') -> '_Consulta':
+        return _Consulta(
+            self._banco, self._colecao, self._filtros,
+            self._ordem + ((campo, direction == 'DESCENDING'),), self._limite, self._cursor
+        )
+
+    def limit(self, quantidade: int) -> '_Consulta':
+        return _Consulta(self._banco, self._colecao, self._filtros, self._ordem, quantidade, self._cursor)
+
+    # Paginação: continua depois do documento informado, na ordem da consulta
+    def start_after(self, snapshot: _Snapshot) -> '_Consulta':
+        return _Consulta(
+            self._banco, self._colecao, self._filtros, self._ordem, self._limite,
+            (snapshot.id, snapshot.to_dict() or {})
+        )
+
+    def stream(self):
+        documentos = self._filtrar(self._banco._listar(self._colecao))
+        with self._banco._lock:
+            self._banco.leituras += len(documentos)
+        for doc_id, dados in documentos:
+            yield _Snapshot(doc_id, dados, _Documento(self._banco, self._colecao, doc_id))
+
+    def on_snapshot(self, callback) -> '_Vigia':
+        return _Vigia(self._banco, self, callback)
+
+    def _filtrar(self, documentos):
+        # Como no Firestore, filtros e ordenação excluem documentos sem o campo
+        campos = [campo for campo, _, _ in self._filtros] + [campo for campo, _ in self._ordem if campo != '__name__']
+        documentos = [
+            (doc_id, dados) for doc_id, dados in documentos
+            if all(campo in dados for campo in campos)
+            and all(teste(dados[campo], valor) for campo, teste, valor in self._filtros)
+        ]
+        if self._cursor is not None:
+            documentos = [item for item in documentos if item[0] != self._cursor[0]] + [self._cursor]
+        for campo, decrescente in reversed(self._ordem):
+            documentos.sort(
+                key=lambda item: item[0] if campo == '__name__' else item[1][campo], reverse=decrescente
+            )
+        if self._cursor is not None:
+            posicao = next(i for i, (doc_id, _) in enumerate(documentos) if doc_id == self._cursor[0])
+            documentos = documentos[posicao + 1:]
+        if self._limite is not None:
+            documentos = documentos[:self._limite]
+        return documentos
+
+
+# Listener de consulta: como no Firestore, entrega o resultado inicial e um
+# novo a cada gravação na coleção, numa thread própria. Gravações seguidas
+# viram uma única entrega, sempre com o estado mais recente.
+class _Vigia:
+    def __init__(self, banco: 'FirestoreMemoria', consulta: _Consulta, callback):
+        self._banco = banco
+        self._consulta = consulta
+        self._callback = callback
+        self._pendente = threading.Event()
+        self._ativo = True
+        self._pendente.set()
+        with banco._lock:
+            banco._vigias.append(self)
+        threading.Thread(target=self._entregar, name='vigia-firestore', daemon=True).start()
+
+    @property
+    def is_active(self) -> bool:
+        return self._ativo
+
+    def notificar(self):
+        self._pendente.set()
+
+    def _entregar(self):
+        while True:
+            self._pendente.wait()
+            self._pendente.clear()
+            if not self._ativo:
+                break
+            documentos = self._consulta._filtrar(self._banco._copiar(self._consulta._colecao))
+            snapshots = [
+                _Snapshot(doc_id, dados, _Documento(self._banco, self._consulta._colecao, doc_id))
+                for doc_id, dados in documentos
+            ]
+            self._callback(snapshots, [], datetime.now(timezone.utc))
+
+    def unsubscribe(self):
+        self._ativo = False
+        with self._banco._lock:
+            if self in self._banco._vigias:
+                self._banco._vigias.remove(self)
+        self._pendente.set()
+
+
+class _Colecao(_Consulta):
+    def document(self, doc_id: Optional[str] = None) -> _Documento:
+        return _Documento(self._banco, self._colecao, doc_id)
+
+
+class _Lote:
+    def __init__(self, banco: 'FirestoreMemoria'):
+        self._banco = banco
+        self._operacoes = []
+
+    def set(self, documento: _Documento, dados: Dict[str, Any], merge: bool = False):
+        self._operacoes.append((documento, dados, merge))
+
+    def update(self, documento: _Documento, dados: Dict[str, Any]):
+        self._operacoes.append((documento, dados, True))
+
+    def delete(self, documento: _Documento):
+        self._operacoes.append((documento, None, False))
+
+    def commit(self):
+        self._banco._atrasar()
+        with self._banco._lock:
+            for documento, dados, merge in self._operacoes:
+                self._banco._aplicar(documento._colecao, documento.id, dados, merge)
+            self._banco.escritas += len(self._operacoes)
+            self._banco.lotes += 1
+        self._banco._notificar({documento._colecao for documento, _, _ in self._operacoes})
+        self._operacoes = []
+
+
+# Subconjunto do firestore.Client usado pelo bot: coleções, documentos,
+# consultas com where/order_by/limit/start_after, listeners (on_snapshot),
+# lotes e remoções. Cada ida ao "servidor" (leitura, gravação ou commit)
+# espera a latência configurada.
+class FirestoreMemoria:
+    def __init__(self, latencia: float = 0.0, semente: Optional[int] = None):
+        self.latencia = DistribuicaoLatencia(latencia)
+        self._aleatorio = random.Random(semente)
+        self._lock = threading.RLock()
+        self._colecoes: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self._vigias: List[_Vigia] = []
+        self.leituras = 0
+        self.escritas = 0
+        self.lotes = 0
+
+    def _atrasar(self):
+        with self._lock:
+            espera = self.latencia.amostrar(self._aleatorio)
+        if espera:
+            time.sleep(espera)
+
+    # dados None remove o documento
+    def _aplicar(self, colecao: str, doc_id: str, dados: Optional[Dict[str, Any]], merge: bool):
+        documentos = self._colecoes.setdefault(colecao, {})
+        if dados is None:
+            documentos.pop(doc_id, None)
+            return
+        atual = documentos.get(doc_id) if merge else None
+        novo = dict(atual or {})
+        for campo, valor in dados.items():
+            novo[campo] = _resolver_valor(valor, novo.get(campo))
+        documentos[doc_id] = novo
+
+    def _gravar(self, colecao: str, doc_id: str, dados: Dict[str, Any], merge: bool, exigir: bool = False):
+        self._atrasar()
+        with self._lock:
+            if exigir and doc_id not in self._colecoes.get(colecao, {}):
+                raise erros_google.NotFound(f"Documento {colecao}/{doc_id} não existe")
+            self._aplicar(colecao, doc_id, dados, merge)
+            self.escritas += 1
+        self._notificar({colecao})
+
+    def _ler(self, colecao: str, doc_id: str) -> Optional[Dict[str, Any]]:
+        self._atrasar()
+        with self._lock:
+            self.leituras += 1
+            dados = self._colecoes.get(colecao, {}).get(doc_id)
+            return dict(dados) if dados is not None else None
+
+    def _copiar(self, colecao: str):
+        with self._lock:
+            return [(doc_id, dict(dados)) for doc_id, dados in self._colecoes.get(colecao, {}).items()]
+
+    # As leituras são contadas em stream(), só pelos documentos devolvidos
+    def _listar(self, colecao: str):
+        self._atrasar()
+        return self._copiar(colecao)
+
+    def _notificar(self, colecoes):
+        with self._lock:
+            vigias = [vigia for vigia in self._vigias if vigia._consulta._colecao in colecoes]
+        for vigia in vigias:
+            vigia.notificar()
+
+    def collection(self, nome: str) -> _Colecao:
+        return _Colecao(self, nome)
+
+    def batch(self) -> _Lote:
+        return _Lote(self)
+
+    def metricas(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'documentos': {nome: len(docs) for nome, docs in self._colecoes.items()},
+                'leituras': self.leituras,
+                'escritas': self.escritas,
+                'lotes': self.lotes,
+                'listeners': len(self._vigias),
+            }
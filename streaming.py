@@ -0,0 +1,105 @@
+import re
+import html
+from typing import List, Optional, Tuple
+
+# Tags e marcações que o modelo emite; durante a transmissão o texto parcial
+# é exibido sem formatação, pois tags abertas fariam o Telegram rejeitar a edição
+PADRAO_MARCACAO = re.compile(r'</?(?:b|i|u|code|pre)>|\*\*')
+
+TEXTO_AGUARDANDO = '⏳ Gerando diagnóstico...'
+CURSOR = ' ▌'
+
+Operacao = Tuple[str, int, Optional[str]]
+
+
+# Planeja os envios/edições de uma resposta transmitida aos poucos. Não faz
+# I/O: o executor (síncrono ou assíncrono) realiza cada operação e registra
+# o resultado, o que mantém a mesma lógica de throttle nos dois modos.
+class PlanoTransmissao:
+    def __init__(self, cabecalho: Optional[str] = None, limite: int = 4000, intervalo: float = 1.0):
+        self.cabecalho = cabecalho
+        self.limite = limite
+        self.intervalo = intervalo
+
+        self.ids: List[int] = []
+        self.exibido: List[str] = []
+        self.ultima_edicao = float('-inf')
+        self.bloqueado_ate = 0.0
+        self.edicoes = 0
+
+    def _compor(self, indice: int, corpo: str) -> str:
+        if indice == 0 and self.cabecalho:
+            return f"{self.cabecalho}\n\n{corpo}"
+        return corpo
+
+    def _segmentar(self, texto: str) -> List[str]:
+        # Corte guloso em quebras de linha: segmentos já completos não mudam
+        # conforme o texto cresce, então só a última mensagem é editada
+        segmentos = []
+        while texto:
+            espaco = self.limite - len(self._compor(len(segmentos), ''))
+            if len(texto) <= espaco:
+                segmentos.append(texto)
+                break
+            corte = texto.rfind('\n', 0, espaco)
+            if corte <= 0:
+                corte = espaco
+            segmentos.append(texto[:corte])
+            texto = texto[corte:].lstrip('\n')
+        return segmentos
+
+    def _operacoes(self, mensagens: List[str]) -> List[Operacao]:
+        operacoes = []
+        for indice, texto in enumerate(mensagens):
+            if indice >= len(self.exibido):
+                operacoes.append(('enviar', indice, texto))
+            elif self.exibido[indice] != texto:
+                operacoes.append(('editar', indice, texto))
+        return operacoes
+
+    def inicio(self) -> List[Operacao]:
+        return [('enviar', 0, self._compor(0, TEXTO_AGUARDANDO))]
+
+    def progresso(self, texto_bruto: str, agora: float) -> List[Operacao]:
+        if agora < self.ultima_edicao + self.intervalo or agora < self.bloqueado_ate:
+            return []
+        self.ultima_edicao = agora
+
+        visivel = html.escape(PADRAO_MARCACAO.sub('', texto_bruto), quote=False).strip()
+        if not visivel:
+            return []
+        mensagens = [self._compor(i, s) for i, s in enumerate(self._segmentar(visivel))]
+        if len(mensagens[-1]) + len(CURSOR) <= self.limite:
+            mensagens[-1] += CURSOR
+        return self._operacoes(mensagens)
+
+    def final(self, mensagens: List[str]) -> List[Operacao]:
+        mensagens = [self._compor(i, m) for i, m in enumerate(mensagens)]
+        operacoes = self._operacoes(mensagens)
+        for indice in range(len(mensagens), len(self.exibido)):
+            operacoes.append(('apagar', indice, None))
+        return operacoes
+
+    def registrar(self, operacao: Operacao, message_id: Optional[int] = None):
+        tipo, indice, texto = operacao
+        if tipo == 'enviar':
+            self.ids.append(message_id)
+            self.exibido.append(texto)
+        elif tipo == 'editar':
+            self.exibido[indice] = texto
+            self.edicoes += 1
+
+    def adiar(self, segundos: float, agora: float):
+        self.bloqueado_ate = agora + segundos
+
+
+def tempo_espera_telegram(erro) -> Optional[float]:
+    # ApiTelegramException com código 429 traz o retry_after em 'parameters'
+    if getattr(erro, 'error_code', None) != 429:
+        return None
+    parametros = (getattr(erro, 'result_json', None) or {}).get('parameters') or {}
+    return float(parametros.get('retry_after', 1))
+
+
+def edicao_sem_alteracao(erro) -> bool:
+    return getattr(erro, 'error_code', None) == 400 and 'message is not modified' in str(erro)